@@ -0,0 +1,250 @@
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+import asyncio
+import logging
+import math
+import os
+import time
+
+from pydantic_ai.models.wrapper import WrapperModel
+
+logger = logging.getLogger(__name__)
+
+# 同时处理的对话请求数（/api/query和/api/stream合计），0表示不限制
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MCP_MAX_CONCURRENT_REQUESTS", "64"))
+# 超过并发上限时最多排队的请求数，队列满时直接返回429
+REQUEST_QUEUE_SIZE = int(os.getenv("MCP_REQUEST_QUEUE_SIZE", "128"))
+# 请求排队的最长时间（秒），超时返回429
+REQUEST_QUEUE_TIMEOUT = float(os.getenv("MCP_REQUEST_QUEUE_TIMEOUT", "30"))
+# 同一个模型同时进行的模型请求数，0表示不限制
+LLM_MAX_CONCURRENCY = int(os.getenv("MCP_LLM_MAX_CONCURRENCY", "0"))
+# 单个MCP服务器同时进行的工具调用数，0表示不限制，可在服务器配置中用maxConcurrency覆盖
+SERVER_MAX_CONCURRENCY = int(os.getenv("MCP_SERVER_MAX_CONCURRENCY", "0"))
+
+
+class AdmissionRejected(Exception):
+    """排队已满或等待超时"""
+
+    def __init__(self, name: str, reason: str, retry_after: int):
+        super().__init__(f"{name}: {reason}")
+        self.name = name
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Limiter:
+    """
+    带有界等待队列的并发限制
+
+    与asyncio.Semaphore不同，等待者按先来先到的顺序获得名额，
+    队列长度和等待时间有上限，并记录排队深度和等待时间用于监控。
+    """
+
+    def __init__(self, name: str, limit: int, queue_size: int = -1, timeout: Optional[float] = None):
+        self.name = name
+        # limit <= 0表示不限制；queue_size < 0表示队列不限长度；timeout为None表示不限等待时间
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.max_queue_depth = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        # 持有名额的平均时长（指数移动平均），用于估算Retry-After
+        self._hold_avg = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        """估算排队中的请求全部获得名额所需的秒数"""
+        if self.limit <= 0 or self._hold_avg <= 0:
+            return 1
+        estimate = self._hold_avg * (self.queue_depth + 1) / self.limit
+        if self.timeout:
+            estimate = min(estimate, self.timeout)
+        return max(1, math.ceil(estimate))
+
+    async def acquire(self, timeout: Optional[float] = None) -> float:
+        """
+        获取一个名额
+
+        Args:
+            timeout: 调用方最多等待的秒数（例如请求剩余的时间），比self.timeout短时以它为准
+
+        Returns:
+            排队等待的秒数
+
+        Raises:
+            AdmissionRejected: 队列已满或等待超过self.timeout
+            asyncio.TimeoutError: 先到达调用方的timeout
+        """
+        if self.limit <= 0 or (self.in_flight < self.limit and not self._waiters):
+            self.in_flight += 1
+            self._record_wait(0.0)
+            return 0.0
+
+        if 0 <= self.queue_size <= len(self._waiters):
+            self.rejected += 1
+            raise AdmissionRejected(self.name, "队列已满", self.retry_after())
+
+        start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+        caller_first = timeout is not None and (self.timeout is None or timeout < self.timeout)
+        try:
+            done, _ = await asyncio.wait({waiter}, timeout=timeout if caller_first else self.timeout)
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        if not done:
+            self._abandon(waiter)
+            if caller_first:
+                raise asyncio.TimeoutError()
+            self.timeouts += 1
+            raise AdmissionRejected(self.name, "排队超时", self.retry_after())
+
+        waited = time.monotonic() - start
+        self._record_wait(waited)
+        return waited
+
+    def _abandon(self, waiter: asyncio.Future):
+        if waiter.done() and not waiter.cancelled():
+            # 放弃前名额已经转交过来，归还给下一个等待者
+            self.release()
+        else:
+            waiter.cancel()
+            self._waiters.remove(waiter)
+
+    def release(self, held: Optional[float] = None):
+        """
+        归还名额，有等待者时直接转交给队首
+
+        Args:
+            held: 本次持有名额的秒数，用于估算Retry-After
+        """
+        if held is not None:
+            self._hold_avg = held if self._hold_avg <= 0 else 0.9 * self._hold_avg + 0.1 * held
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight = max(0, self.in_flight - 1)
+
+    @asynccontextmanager
+    async def hold(self) -> AsyncIterator[float]:
+        """在with块内持有名额，返回排队等待的秒数"""
+        waited = await self.acquire()
+        start = time.monotonic()
+        try:
+            yield waited
+        finally:
+            self.release(time.monotonic() - start)
+
+    def _record_wait(self, waited: float):
+        self.admitted += 1
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "avg_wait_ms": self._wait_total / self.admitted * 1000 if self.admitted else 0.0,
+            "max_wait_ms": self._wait_max * 1000,
+        }
+
+
+class LimitedModel(WrapperModel):
+    """每次模型请求（包括流式请求）都先获取该模型的并发名额"""
+
+    def __init__(self, wrapped: Any, limiter: Limiter):
+        super().__init__(wrapped)
+        self.limiter = limiter
+
+    async def request(self, *args: Any, **kwargs: Any):
+        async with self.limiter.hold():
+            return await self.wrapped.request(*args, **kwargs)
+
+    @asynccontextmanager
+    async def request_stream(self, messages, model_settings, model_request_parameters):
+        async with self.limiter.hold():
+            async with self.wrapped.request_stream(messages, model_settings, model_request_parameters) as stream:
+                yield stream
+
+
+class LimitedMCPServer:
+    """每次工具调用都先获取该MCP服务器的并发名额，其余属性转发给被包装的服务器"""
+
+    def __init__(self, server: Any, limiter: Limiter):
+        self.server = server
+        self.limiter = limiter
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.server, name)
+
+    def __repr__(self) -> str:
+        return f"LimitedMCPServer({self.server!r})"
+
+    async def call_tool(self, tool_name: str, arguments: Dict[str, Any]) -> Any:
+        async with self.limiter.hold():
+            return await self.server.call_tool(tool_name, arguments)
+
+
+class AdmissionController:
+    """
+    全局、按模型和按MCP服务器的并发限制
+
+    只有全局的请求准入会拒绝请求（返回429）；模型和MCP服务器的限制发生在请求处理过程中，
+    只排队等待不拒绝，避免已经开始输出的流式响应中途失败。
+    """
+
+    def __init__(self):
+        self.requests = Limiter("requests", MAX_CONCURRENT_REQUESTS, REQUEST_QUEUE_SIZE, REQUEST_QUEUE_TIMEOUT)
+        self.models: Dict[str, Limiter] = {}
+        self.servers: Dict[str, Limiter] = {}
+
+    def wrap_model(self, model: Any) -> Any:
+        """为模型加上并发限制，同名模型共用一个限制"""
+        if LLM_MAX_CONCURRENCY <= 0:
+            return model
+        name = model.model_name
+        if name not in self.models:
+            self.models[name] = Limiter(f"model:{name}", LLM_MAX_CONCURRENCY)
+        return LimitedModel(model, self.models[name])
+
+    def configure_servers(self, servers_config: Dict[str, Dict[str, Any]]):
+        """根据配置更新各MCP服务器的并发限制，限制不变的服务器保留原有计数"""
+        servers = {}
+        for name, server_config in servers_config.items():
+            limit = int(server_config.get("maxConcurrency", SERVER_MAX_CONCURRENCY))
+            if limit <= 0:
+                continue
+            existing = self.servers.get(name)
+            servers[name] = existing if existing is not None and existing.limit == limit \
+                else Limiter(f"server:{name}", limit)
+        self.servers = servers
+
+    def wrap_server(self, name: str, server: Any) -> Any:
+        limiter = self.servers.get(name)
+        return LimitedMCPServer(server, limiter) if limiter is not None else server
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests.stats(),
+            "models": {name: limiter.stats() for name, limiter in self.models.items()},
+            "servers": {name: limiter.stats() for name, limiter in self.servers.items()},
+        }
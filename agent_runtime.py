@@ -0,0 +1,420 @@
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+import asyncio
+import json
+import logging
+import os
+import time
+
+from tool_catalog import TOOL_CATALOG_TTL, ToolCatalog, watch_tool_changes
+
+logger = logging.getLogger(__name__)
+
+# 单个MCP服务器启动的默认超时时间（秒），可在配置中用startupTimeout按服务器覆盖
+SERVER_START_TIMEOUT = float(os.getenv("MCP_SERVER_START_TIMEOUT", "60"))
+# 启动失败的服务器重试间隔：从SERVER_RETRY_BASE开始指数退避，最长SERVER_RETRY_MAX（秒）
+SERVER_RETRY_BASE = float(os.getenv("MCP_SERVER_RETRY_BASE", "5"))
+SERVER_RETRY_MAX = float(os.getenv("MCP_SERVER_RETRY_MAX", "300"))
+# 旧Agent等待进行中请求结束的最长时间（秒），超时后强制关闭
+DRAIN_TIMEOUT = float(os.getenv("MCP_DRAIN_TIMEOUT", "300"))
+
+
+# 决定是否需要重启服务器进程的配置字段，其余字段的变化不会重启服务器
+SERVER_PROCESS_KEYS = ("command", "args", "env", "url", "poolSize")
+
+
+def server_spec(server_config: Dict[str, Any]) -> str:
+    """
+    规范化服务器配置，用于判断两次配置中的同名服务器是否需要重启
+
+    Args:
+        server_config: mcpServers中单个服务器的配置
+
+    Returns:
+        规范化后的JSON字符串
+    """
+    spec = {}
+    for key in SERVER_PROCESS_KEYS:
+        if key not in server_config:
+            continue
+        value = server_config[key]
+        if key == "args":
+            value = [str(arg) for arg in (value or [])]
+        elif key == "env":
+            value = {str(k): str(v) for k, v in (value or {}).items()}
+        spec[key] = value
+    return json.dumps(spec, sort_keys=True, ensure_ascii=False)
+
+
+class ServerHandle:
+    """
+    在独立后台任务中运行的MCP服务器
+
+    MCP客户端基于anyio，进入和退出上下文必须在同一个任务中完成，
+    因此每个服务器由专属任务持有，start/stop只负责发信号并等待结果。
+    同一个服务器可以被多个Agent运行时共享，按引用计数决定何时关闭。
+
+    启动失败或异常退出的服务器会被隔离，并在后台按指数退避重试，恢复后通知监听者。
+    """
+
+    def __init__(self, name: str, server, spec: str = "", startup_timeout: float = SERVER_START_TIMEOUT,
+                 catalog_ttl: float = TOOL_CATALOG_TTL):
+        self.name = name
+        self.server = server
+        self.spec = spec
+        self.startup_timeout = startup_timeout
+        # 工具列表缓存，每次（重新）启动时刷新
+        self.catalog = ToolCatalog(catalog_ttl)
+        self.refs = 0
+        # 状态: pending / starting / running / quarantined / stopped
+        self.state = "pending"
+        self.last_error: Optional[str] = None
+        self.failures = 0
+        self.startup_time: Optional[float] = None
+        self.next_retry_at: Optional[float] = None
+        self.listeners: List[Callable[[], None]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._retry_task: Optional[asyncio.Task] = None
+        self._stop_event = asyncio.Event()
+        self._ready: Optional[asyncio.Future] = None
+
+    @property
+    def is_running(self) -> bool:
+        return bool(getattr(self.server, "is_running", False))
+
+    @property
+    def started(self) -> bool:
+        return self.state != "pending"
+
+    @property
+    def is_available(self) -> bool:
+        """服务器已启动且可以接收工具调用"""
+        return self.state == "running" and self.is_running
+
+    @property
+    def reusable(self) -> bool:
+        """配置未变化时可以被新的运行时直接复用（包括正在退避重试的服务器）"""
+        return self.state in ("starting", "running", "quarantined")
+
+    def status(self) -> Dict[str, Any]:
+        """返回服务器状态，用于/api/config/status"""
+        return {
+            "state": self.state,
+            "available": self.is_available,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "startup_time": self.startup_time,
+            "next_retry_in": max(0.0, self.next_retry_at - time.monotonic()) if self.next_retry_at else None,
+            **({"replicas": self.server.stats()} if hasattr(self.server, "stats") else {}),
+        }
+
+    def _notify(self):
+        for listener in list(self.listeners):
+            try:
+                listener()
+            except Exception as e:
+                logger.error(f"处理MCP服务器 {self.name} 状态变化时出错: {str(e)}")
+
+    async def _run(self):
+        try:
+            async with self.server:
+                self._ready.set_result(None)
+                await self._stop_event.wait()
+        except Exception as e:
+            if not self._ready.done():
+                await self._close_partial()
+                self._ready.set_exception(e)
+            elif not self._stop_event.is_set():
+                logger.error(f"MCP服务器 {self.name} 异常退出: {str(e)}")
+                self._quarantine(str(e))
+        except asyncio.CancelledError:
+            if not self._ready.done():
+                await self._close_partial()
+            raise
+
+    async def _close_partial(self):
+        """
+        关闭初始化到一半的会话
+
+        pydantic-ai在__aenter__中途失败或被取消时不会关闭已进入的子进程和流，
+        需要在同一个任务中关闭，否则会在其他任务中被回收并报cancel scope错误。
+        """
+        exit_stack = getattr(self.server, "_exit_stack", None)
+        if exit_stack is None or getattr(self.server, "is_running", False):
+            return
+        try:
+            await exit_stack.aclose()
+        except BaseException as e:
+            logger.debug(f"清理MCP服务器 {self.name} 的会话时出错(可以忽略): {str(e)}")
+
+    async def start(self, timeout: Optional[float] = None):
+        """
+        启动服务器并等待初始化完成
+
+        Raises:
+            asyncio.TimeoutError: 启动超时
+            Exception: 服务器启动失败
+        """
+        self._stop_event = asyncio.Event()
+        self._ready = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._run(), name=f"mcp-server:{self.name}")
+        try:
+            await asyncio.wait_for(asyncio.shield(self._ready), timeout or self.startup_timeout)
+        except BaseException:
+            await self._cancel_task()
+            raise
+
+    async def health_check(self):
+        """通过列出工具确认服务器会话可用，同时刷新工具列表缓存"""
+        self.catalog.invalidate()
+        await self.catalog.get(self.server.list_tools)
+
+    def _on_tools_changed(self):
+        logger.info(f"MCP服务器 {self.name} 的工具列表已变化，下次使用时重新获取")
+        self.catalog.invalidate()
+
+    async def launch(self) -> bool:
+        """
+        在启动期限内启动服务器并做健康检查，失败时隔离并在后台重试，不会抛出异常
+
+        Returns:
+            是否启动成功
+        """
+        self.state = "starting"
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self._start_and_check(), self.startup_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = "启动超时" if isinstance(e, asyncio.TimeoutError) else str(e)
+            logger.warning(f"MCP服务器 {self.name} 启动失败: {error}")
+            await self._cancel_task()
+            self._quarantine(error)
+            return False
+
+        self.startup_time = time.monotonic() - start
+        self.state = "running"
+        self.last_error = None
+        self.failures = 0
+        self.next_retry_at = None
+        logger.info(f"MCP服务器 {self.name} 已启动，耗时{self.startup_time:.2f}秒")
+        return True
+
+    async def _start_and_check(self):
+        await self.start(timeout=self.startup_timeout)
+        if not watch_tool_changes(self.server, self._on_tools_changed):
+            logger.debug(f"无法监听MCP服务器 {self.name} 的工具变更通知，按TTL刷新工具列表")
+        await self.health_check()
+
+    def _quarantine(self, error: str):
+        """隔离服务器并安排退避重试"""
+        self.state = "quarantined"
+        self.last_error = error
+        self.failures += 1
+        delay = min(SERVER_RETRY_BASE * (2 ** (self.failures - 1)), SERVER_RETRY_MAX)
+        self.next_retry_at = time.monotonic() + delay
+        if (self._retry_task is None or self._retry_task.done()
+                or self._retry_task is asyncio.current_task()):
+            self._retry_task = asyncio.create_task(self._retry_after(delay))
+        self._notify()
+
+    async def _retry_after(self, delay: float):
+        await asyncio.sleep(delay)
+        if self.state != "quarantined":
+            return
+        logger.info(f"重试启动MCP服务器 {self.name}（第{self.failures}次失败后）")
+        await self._cancel_task()
+        if await self.launch():
+            self._notify()
+
+    async def _cancel_task(self):
+        """取消后台任务，用于启动失败或卡住的服务器"""
+        task, self._task = self._task, None
+        if task is None or task.done():
+            return
+        task.cancel()
+        try:
+            await task
+        except BaseException:
+            pass
+
+    async def stop(self):
+        """通知后台任务退出服务器上下文并等待其结束，同时取消重试"""
+        self.state = "stopped"
+        self.next_retry_at = None
+        retry_task, self._retry_task = self._retry_task, None
+        if retry_task is not None and retry_task is not asyncio.current_task():
+            # 等待正在进行的重试退出，它会自行清理启动到一半的服务器
+            retry_task.cancel()
+            await asyncio.gather(retry_task, return_exceptions=True)
+        if self._task is None:
+            return
+        if self._ready is None or not self._ready.done():
+            await self._cancel_task()
+            return
+        self._stop_event.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), SERVER_START_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"关闭MCP服务器 {self.name} 超时，已强制取消")
+            await self._cancel_task()
+        except Exception as e:
+            logger.warning(f"关闭MCP服务器 {self.name} 时出错(可以忽略): {str(e)}")
+        self._task = None
+
+    def retain(self):
+        self.refs += 1
+
+    async def release(self):
+        """释放一个引用，最后一个引用释放时关闭服务器"""
+        self.refs -= 1
+        if self.refs <= 0:
+            self.refs = 0
+            await self.stop()
+
+
+class ServerRegistry:
+    """按名称跟踪正在运行的MCP服务器，配置更新时只启停有变化的服务器"""
+
+    def __init__(self):
+        self._handles: Dict[str, ServerHandle] = {}
+
+    def plan(self, servers_config: Dict[str, Dict[str, Any]],
+             factory: Callable[[str, Dict[str, Any]], Any]) -> Tuple[List[ServerHandle], Dict[str, List[str]]]:
+        """
+        对比新配置与正在运行的服务器
+
+        Args:
+            servers_config: 新配置中的mcpServers
+            factory: 根据名称和配置创建MCP服务器实例的函数，返回None表示配置无效
+
+        Returns:
+            (新配置对应的服务器列表, 变化明细)，配置未变化且未被关闭的服务器会被复用
+        """
+        handles = []
+        diff = {"added": [], "changed": [], "removed": [], "unchanged": []}
+        for name, server_config in servers_config.items():
+            spec = server_spec(server_config)
+            existing = self._handles.get(name)
+            catalog_ttl = float(server_config.get("toolCatalogTtl", TOOL_CATALOG_TTL))
+            if existing is not None and existing.spec == spec and existing.reusable:
+                existing.catalog.ttl = catalog_ttl
+                handles.append(existing)
+                diff["unchanged"].append(name)
+                continue
+            server = factory(name, server_config)
+            if server is None:
+                continue
+            handles.append(ServerHandle(
+                name, server, spec,
+                startup_timeout=float(server_config.get("startupTimeout", SERVER_START_TIMEOUT)),
+                catalog_ttl=catalog_ttl))
+            diff["changed" if existing is not None else "added"].append(name)
+        diff["removed"] = [name for name in self._handles if name not in servers_config]
+        return handles, diff
+
+    def commit(self, handles: List[ServerHandle]):
+        """新的运行时启动成功后记录其服务器"""
+        self._handles = {handle.name: handle for handle in handles}
+
+
+class AgentRuntime:
+    """
+    一个Agent实例及其MCP服务器
+
+    配置更新时先启动并检查新的运行时，再替换全局引用；
+    旧运行时进入排空状态，等进行中的请求（包括流式响应）全部结束后才释放服务器。
+
+    所有服务器并行启动，各自受启动期限约束；启动失败的服务器被隔离，
+    Agent只挂载可用的服务器，被隔离的服务器恢复后会重新创建Agent把它加入。
+    """
+
+    def __init__(self, servers: List[ServerHandle], agent_factory: Callable[[List[ServerHandle]], Any],
+                 config_version: int = 0):
+        self.servers = servers
+        self.agent_factory = agent_factory
+        self.config_version = config_version
+        self.agent = None
+        self.active_requests = 0
+        self.draining = False
+        self._idle = asyncio.Event()
+        self._idle.set()
+        for handle in servers:
+            handle.retain()
+
+    @property
+    def available_servers(self) -> List[ServerHandle]:
+        return [handle for handle in self.servers if handle.is_available]
+
+    def server_status(self) -> Dict[str, Dict[str, Any]]:
+        """各MCP服务器的状态"""
+        return {handle.name: handle.status() for handle in self.servers}
+
+    def rebuild_agent(self):
+        """按当前可用的服务器重新创建Agent，进行中的请求继续使用原来的Agent"""
+        available = self.available_servers
+        self.agent = self.agent_factory(available)
+        logger.info(f"Agent已挂载{len(available)}/{len(self.servers)}个MCP服务器")
+
+    def _on_server_change(self):
+        if not self.draining:
+            self.rebuild_agent()
+
+    async def start(self):
+        """
+        并行启动尚未运行的MCP服务器，复用的服务器不会重启
+
+        总耗时取决于最慢的成功启动的服务器，失败的服务器不会阻塞启动；
+        只有创建Agent本身失败时才会释放服务器并抛出异常。
+        """
+        try:
+            await asyncio.gather(*[
+                handle.launch() for handle in self.servers if not handle.started
+            ])
+            self.rebuild_agent()
+        except BaseException:
+            await self.release_servers()
+            raise
+        for handle in self.servers:
+            handle.listeners.append(self._on_server_change)
+
+    async def release_servers(self):
+        """释放对全部MCP服务器的引用，不再被其他运行时使用的服务器会被关闭"""
+        for handle in reversed(self.servers):
+            if self._on_server_change in handle.listeners:
+                handle.listeners.remove(self._on_server_change)
+            await handle.release()
+
+    def acquire(self):
+        """登记一个使用该运行时的请求"""
+        self.active_requests += 1
+        self._idle.clear()
+        return self.agent
+
+    def release(self):
+        """请求结束时调用，与acquire成对使用"""
+        self.active_requests -= 1
+        if self.active_requests <= 0:
+            self.active_requests = 0
+            self._idle.set()
+
+    @asynccontextmanager
+    async def use(self) -> AsyncIterator:
+        """在请求期间持有运行时，保证排空时不会关闭正在使用的服务器"""
+        agent = self.acquire()
+        try:
+            yield agent
+        finally:
+            self.release()
+
+    async def drain_and_close(self, timeout: float = DRAIN_TIMEOUT):
+        """等待进行中的请求结束后关闭全部MCP服务器"""
+        self.draining = True
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Agent运行时排空超时，仍有{self.active_requests}个请求进行中，强制关闭")
+        logger.info(f"Agent运行时已排空，耗时{time.monotonic() - start:.2f}秒，释放MCP服务器")
+        await self.release_servers()
@@ -0,0 +1,95 @@
+"""
+对话存储基准测试
+
+在临时SQLite数据库中写入大量对话，测量列表、读取和追加消息的延迟。
+
+用法:
+    python benchmarks/bench_conversation_store.py --conversations 100000
+"""
+from datetime import datetime, timedelta
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation_store import ChatMessage, Conversation, SQLiteConversationStore  # noqa: E402
+
+
+def measure(func, rounds: int):
+    """执行rounds次并返回每次耗时（毫秒）"""
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name: str, timings):
+    timings = sorted(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(f"{name:<28} p50={statistics.median(timings):8.3f}ms  p99={p99:8.3f}ms")
+
+
+def populate(store: SQLiteConversationStore, count: int, messages_per_conversation: int):
+    """批量写入测试数据"""
+    base = datetime.now() - timedelta(days=30)
+    ids = []
+    for i in range(count):
+        ts = base + timedelta(seconds=i)
+        conversation = Conversation(
+            id=str(uuid.uuid4()),
+            title=f"对话 {i}",
+            messages=[
+                ChatMessage(role="user" if j % 2 == 0 else "assistant",
+                            content=f"消息内容 {i}-{j} " * 10, timestamp=ts)
+                for j in range(messages_per_conversation)
+            ],
+            created_at=ts,
+            updated_at=ts
+        )
+        store.create(conversation)
+        ids.append(conversation.id)
+    return ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对话存储基准测试")
+    parser.add_argument("--conversations", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=4, help="每个对话的消息数")
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteConversationStore(os.path.join(tmp, "bench.db"))
+
+        start = time.perf_counter()
+        ids = populate(store, args.conversations, args.messages)
+        print(f"写入 {args.conversations} 个对话耗时 {time.perf_counter() - start:.1f}s")
+
+        report("list_summaries(50)", measure(
+            lambda: store.list_summaries(50), args.rounds))
+        _, cursor = store.list_summaries(50)
+        report("list_summaries(50, 第2页)", measure(
+            lambda: store.list_summaries(50, cursor), args.rounds))
+        report("get", measure(
+            lambda: store.get(random.choice(ids)), args.rounds))
+        report("get_recent_messages(10)", measure(
+            lambda: store.get_recent_messages(random.choice(ids), 10), args.rounds))
+        report("append_messages(1轮)", measure(
+            lambda: store.append_messages(random.choice(ids), [
+                ChatMessage(role="user", content="问题"),
+                ChatMessage(role="assistant", content="回答")
+            ], datetime.now()), args.rounds))
+
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
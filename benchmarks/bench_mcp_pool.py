@@ -0,0 +1,68 @@
+"""
+MCP服务器连接池基准测试
+
+启动本地的fake_mcp_server.py，模拟多个并发对话各自进行若干次工具调用，
+对比不同poolSize下工具调用延迟的分位数。
+
+用法:
+    python benchmarks/bench_mcp_pool.py --chats 50 --pool-sizes 1 2 4 8
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pydantic_ai.mcp import MCPServerStdio  # noqa: E402
+
+from mcp_pool import MCPServerPool  # noqa: E402
+
+FAKE_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_mcp_server.py")
+
+
+def report(name: str, timings, elapsed: float):
+    timings = sorted(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(f"{name:<12} 调用数={len(timings):<6} 吞吐={len(timings) / elapsed:8.1f}次/秒  "
+          f"p50={statistics.median(timings):8.1f}ms  p99={p99:8.1f}ms")
+
+
+async def chat(server, calls: int, timings):
+    """一个对话依次进行calls次工具调用"""
+    for i in range(calls):
+        start = time.perf_counter()
+        await server.call_tool("search", {"query": f"q{i}"})
+        timings.append((time.perf_counter() - start) * 1000)
+
+
+async def bench(pool_size: int, args):
+    replicas = [
+        MCPServerStdio(command=sys.executable, args=[FAKE_SERVER, "--delay", str(args.delay)], env=dict(os.environ))
+        for _ in range(pool_size)
+    ]
+    server = MCPServerPool("fake-search", replicas) if pool_size > 1 else replicas[0]
+    async with server:
+        await server.list_tools()
+        timings = []
+        start = time.perf_counter()
+        await asyncio.gather(*[chat(server, args.calls, timings) for _ in range(args.chats)])
+        report(f"poolSize={pool_size}", timings, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MCP服务器连接池基准测试")
+    parser.add_argument("--chats", type=int, default=50, help="并发对话数")
+    parser.add_argument("--calls", type=int, default=4, help="每个对话的工具调用次数")
+    parser.add_argument("--delay", type=float, default=0.02, help="假服务器每次调用的耗时（秒）")
+    parser.add_argument("--pool-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    for pool_size in args.pool_sizes:
+        asyncio.run(bench(pool_size, args))
+
+
+if __name__ == "__main__":
+    main()
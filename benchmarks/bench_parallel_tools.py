@@ -0,0 +1,101 @@
+"""
+同一步骤中多个工具调用的并行执行基准测试
+
+启动本地的fake_mcp_server.py，用一个假模型在一次回复中返回若干个耗时不同的slow_search调用，
+通过web_server.generate_stream执行（与/api/stream相同的工具调用包装和事件流），
+测量工具步骤的耗时（第一个tool_call事件到最后一个tool_result事件）以及tool_result事件的到达顺序。
+并行执行时步骤耗时接近最慢的一次调用，而不是所有调用耗时之和。
+
+用法:
+    python benchmarks/bench_parallel_tools.py --delays 0.8 0.2 0.5 0.3 --step-concurrency 0 2 1
+    python benchmarks/bench_parallel_tools.py --delays 0.8 0.2 --timeout 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 导入web_server前设置，避免创建数据库文件和读取真实的模型配置
+os.environ.setdefault("MCP_CONVERSATION_STORE", "memory")
+os.environ.setdefault("MCP_LLM_API_MODEL_NAME", "bench")
+os.environ.setdefault("MCP_LLM_API_KEY", "bench")
+
+from pydantic_ai import Agent  # noqa: E402
+from pydantic_ai.mcp import MCPServerStdio  # noqa: E402
+from pydantic_ai.messages import ModelRequest  # noqa: E402
+from pydantic_ai.models.function import DeltaToolCall, FunctionModel  # noqa: E402
+
+import web_server  # noqa: E402
+from stream_runs import StreamRun, TrackedMCPServer  # noqa: E402
+from tool_timeouts import TimeoutMCPServer, ToolTimeouts  # noqa: E402
+
+FAKE_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_mcp_server.py")
+
+
+def fake_model(delays):
+    """第一次请求返回len(delays)个工具调用，收到工具结果后返回一句话"""
+
+    async def stream(messages, info):
+        if len(messages) == 1 and isinstance(messages[0], ModelRequest):
+            for i, seconds in enumerate(delays):
+                args = json.dumps({"query": f"q{i}", "seconds": seconds})
+                yield {i: DeltaToolCall(name="slow_search", json_args=args, tool_call_id=f"call_{i}")}
+        else:
+            yield "完成"
+
+    return FunctionModel(stream_function=stream)
+
+
+async def step(server, delays, concurrency: int):
+    agent = Agent(fake_model(delays), mcp_servers=[server])
+    run = StreamRun(tool_concurrency=concurrency)
+    run.start(web_server.generate_stream(agent, "问题", None, [], run), lambda _: None)
+
+    first_call = last_result = None
+    order = []
+    async for chunk in run.read():
+        for line in chunk.splitlines():
+            event = json.loads(line)
+            if event["type"] == "tool_call" and first_call is None:
+                first_call = time.perf_counter()
+            elif event["type"] == "tool_result":
+                last_result = time.perf_counter()
+                order.append(int(event["tool_call_id"].split("_")[1]))
+    return last_result - first_call, order
+
+
+async def bench(args):
+    server = MCPServerStdio(command=sys.executable, args=[FAKE_SERVER], env=dict(os.environ))
+    wrapped = TrackedMCPServer(TimeoutMCPServer(server, ToolTimeouts({}, default=args.timeout)))
+    async with server:
+        await server.list_tools()
+        print(f"调用耗时={args.delays}  之和={sum(args.delays):.2f}s  最大={max(args.delays):.2f}s"
+              + (f"  超时={args.timeout:g}s" if args.timeout > 0 else ""))
+        for concurrency in args.step_concurrency:
+            timings = []
+            for _ in range(args.rounds):
+                elapsed, order = await step(wrapped, args.delays, concurrency)
+                timings.append(elapsed)
+            label = f"并发上限={concurrency or '不限'}"
+            print(f"{label:<10} 步骤耗时={min(timings):6.3f}s（{args.rounds}次中最快）  "
+                  f"tool_result顺序={order}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同一步骤中多个工具调用的并行执行基准测试")
+    parser.add_argument("--delays", type=float, nargs="+", default=[0.8, 0.2, 0.5, 0.3],
+                        help="一次回复中各工具调用的耗时（秒）")
+    parser.add_argument("--step-concurrency", type=int, nargs="+", default=[0, 2, 1],
+                        help="要对比的每步并发上限，0表示不限制")
+    parser.add_argument("--timeout", type=float, default=0, help="每次工具调用的超时时间（秒），0表示不限制")
+    parser.add_argument("--rounds", type=int, default=3, help="每种设置的重复次数")
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
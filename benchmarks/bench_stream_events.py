@@ -0,0 +1,181 @@
+"""
+流式输出管线基准测试
+
+构造一段录制好的Agent事件流（文本片段、工具调用和工具结果），用一个只回放这些事件的
+假Agent驱动web_server.generate_stream，并像流式响应一样通过StreamRun.read编码输出，
+测量每秒能处理的事件数和写入次数。
+不调用模型和MCP服务器，结果只反映流式管线本身（事件判断、文本累积、日志、合并和JSON编码）的开销。
+回放没有间隔，所有事件都会在合并窗口内到达，--batch-window下的写入次数是合并的上限。
+
+用法:
+    python benchmarks/bench_stream_events.py --deltas 5000 --rounds 20
+    python benchmarks/bench_stream_events.py --batch-window 20 --batch-bytes 4096
+    python benchmarks/bench_stream_events.py --log-level DEBUG
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 导入web_server前设置，避免创建数据库文件和读取真实的模型配置
+os.environ.setdefault("MCP_CONVERSATION_STORE", "memory")
+os.environ.setdefault("MCP_LLM_API_MODEL_NAME", "bench")
+os.environ.setdefault("MCP_LLM_API_KEY", "bench")
+
+from pydantic_ai.messages import (  # noqa: E402
+    FunctionToolCallEvent,
+    FunctionToolResultEvent,
+    ModelRequest,
+    ModelResponse,
+    PartDeltaEvent,
+    PartStartEvent,
+    TextPart,
+    TextPartDelta,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+from pydantic_ai.usage import Usage  # noqa: E402
+
+import web_server  # noqa: E402
+from stream_runs import StreamRun, encoder_name  # noqa: E402
+
+
+class ReplayNode:
+    def __init__(self, kind: str, events=()):
+        self.kind = kind
+        self.events = events
+
+    @asynccontextmanager
+    async def stream(self, ctx):
+        yield self._replay()
+
+    async def _replay(self):
+        for event in self.events:
+            yield event
+
+
+class ReplayResult:
+    def __init__(self, output: str, messages):
+        self.output = output
+        self._messages = messages
+
+    def new_messages(self):
+        return self._messages
+
+    def usage(self):
+        return Usage(requests=2, request_tokens=1000, response_tokens=2000, total_tokens=3000)
+
+
+class ReplayRun:
+    def __init__(self, nodes, result: ReplayResult):
+        self.ctx = None
+        self.result = None
+        self._nodes = nodes
+        self._final = result
+
+    async def __aiter__(self):
+        for node in self._nodes:
+            if node.kind == "end":
+                self.result = self._final
+            yield node
+
+
+class ReplayAgent:
+    """按录制的节点和事件回放的假Agent，接口与generate_stream用到的Agent方法一致"""
+
+    def __init__(self, nodes, result: ReplayResult):
+        self.nodes = nodes
+        self.result = result
+
+    @asynccontextmanager
+    async def iter(self, query, **kwargs):
+        yield ReplayRun(self.nodes, self.result)
+
+    def is_model_request_node(self, node) -> bool:
+        return node.kind == "model"
+
+    def is_call_tools_node(self, node) -> bool:
+        return node.kind == "tools"
+
+    def is_end_node(self, node) -> bool:
+        return node.kind == "end"
+
+
+def record(deltas: int, delta_size: int, tool_calls: int, result_size: int) -> ReplayAgent:
+    """构造一段典型的回答：先并行调用若干工具，再逐片段输出文本"""
+    calls = [ToolCallPart("search", {"query": f"问题{i}"}, tool_call_id=f"call_{i}") for i in range(tool_calls)]
+    returns = [ToolReturnPart("search", "结果" * (result_size // 2), tool_call_id=call.tool_call_id)
+               for call in calls]
+    tool_events = [FunctionToolCallEvent(call) for call in calls]
+    tool_events += [FunctionToolResultEvent(ret, tool_call_id=ret.tool_call_id) for ret in returns]
+
+    chunk = "流式输出的文本片段"[:delta_size].ljust(delta_size, "字")
+    text_events = [PartStartEvent(index=0, part=TextPart(chunk))]
+    text_events += [PartDeltaEvent(index=0, delta=TextPartDelta(chunk)) for _ in range(deltas - 1)]
+    output = chunk * deltas
+
+    nodes = [
+        ReplayNode("model", [PartStartEvent(index=0, part=call) for call in calls]),
+        ReplayNode("tools", tool_events),
+        ReplayNode("model", text_events),
+        ReplayNode("end"),
+    ]
+    messages = [
+        ModelRequest(parts=[UserPromptPart("问题")]),
+        ModelResponse(parts=calls),
+        ModelRequest(parts=returns),
+        ModelResponse(parts=[TextPart(output)]),
+    ]
+    return ReplayAgent(nodes, ReplayResult(output, messages))
+
+
+async def bench(agent: ReplayAgent, rounds: int, window: float, max_bytes: int):
+    events = writes = size = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        # 回放不让出事件循环，所有事件都在读取前发布，缓冲区需要容纳整个回答
+        run = StreamRun(buffer_size=None)
+        run.start(web_server.generate_stream(agent, "问题", None, [], run), lambda _: None)
+        async for chunk in run.read(window=window, max_bytes=max_bytes):
+            writes += 1
+            size += len(chunk)
+        events += run.next_seq
+        assert run.answer == agent.result.output
+    elapsed = time.perf_counter() - start
+    print(f"编码器={encoder_name()}  合并窗口={window * 1000:g}ms")
+    print(f"事件数={events:<8} 写入次数={writes:<8} 字节数={size:<10} 耗时={elapsed * 1000:8.1f}ms  "
+          f"吞吐={events / elapsed:10.0f}事件/秒  每个事件={elapsed / events * 1e6:6.2f}µs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="流式输出管线基准测试")
+    parser.add_argument("--deltas", type=int, default=5000, help="每次回答的文本片段数")
+    parser.add_argument("--delta-size", type=int, default=4, help="每个文本片段的字符数")
+    parser.add_argument("--tool-calls", type=int, default=3, help="每次回答的工具调用数")
+    parser.add_argument("--result-size", type=int, default=2000, help="每个工具结果的字符数")
+    parser.add_argument("--rounds", type=int, default=20, help="回放次数")
+    parser.add_argument("--batch-window", type=float, default=0, help="合并content事件的时间窗口（毫秒）")
+    parser.add_argument("--batch-bytes", type=int, default=4096, help="合并的文本的字节数上限")
+    parser.add_argument("--log-level", default="INFO", help="web_server的日志级别")
+    args = parser.parse_args()
+
+    # 日志输出到空设备，只计算格式化和写入的开销，不受终端速度影响
+    handler = logging.FileHandler(os.devnull)
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    logging.getLogger("web_server").setLevel(args.log_level.upper())
+
+    agent = record(args.deltas, args.delta_size, args.tool_calls, args.result_size)
+    asyncio.run(bench(agent, args.rounds, args.batch_window / 1000, args.batch_bytes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+大工具结果的截断基准测试
+
+启动本地的fake_mcp_server.py，用一个假模型在一次回复中调用若干次large_result（每次返回--chars个字符），
+通过web_server.generate_stream执行，对比不限制和按--limit截断时：
+模型下一次请求收到的工具结果字符数、tool_result事件的字节数、本轮保存到对话历史的消息大小，
+写入的完整结果文件数，以及请求期间Python分配内存的峰值（tracemalloc）和请求结束后仍被持有的内存
+（包括工具结果缓存）。每种上限先请求一次，再用相同的调用请求一次，第二次全部命中工具结果缓存。
+
+截断后MCP客户端仍要完整解码每个结果，峰值内存仍包含同时进行的调用的完整结果，
+截断只减少请求之后被历史、流式事件和缓存持有的部分；截断本身逐块写入完整结果，不再额外生成完整的文本和字节。
+
+用法:
+    python benchmarks/bench_tool_results.py --chars 2000000 --calls 3 --limit 0 20000
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 导入web_server前设置，避免创建数据库文件和读取真实的模型配置
+os.environ.setdefault("MCP_CONVERSATION_STORE", "memory")
+os.environ.setdefault("MCP_LLM_API_MODEL_NAME", "bench")
+os.environ.setdefault("MCP_LLM_API_KEY", "bench")
+
+from pydantic_ai import Agent  # noqa: E402
+from pydantic_ai.mcp import MCPServerStdio  # noqa: E402
+from pydantic_ai.messages import ModelRequest, ToolReturnPart  # noqa: E402
+from pydantic_ai.models.function import DeltaToolCall, FunctionModel  # noqa: E402
+
+import web_server  # noqa: E402
+from stream_runs import StreamRun, TrackedMCPServer  # noqa: E402
+from tool_cache import CachingMCPServer, ToolResultCache  # noqa: E402
+from tool_results import ToolResultLimits, ToolResultStore, TruncatingMCPServer  # noqa: E402
+
+FAKE_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_mcp_server.py")
+
+
+def fake_model(calls: int, chars: int, seen: dict):
+    """第一次请求返回calls个large_result调用，收到工具结果后记录结果的字符数并返回一句话"""
+
+    async def stream(messages, info):
+        if len(messages) == 1 and isinstance(messages[0], ModelRequest):
+            for i in range(calls):
+                args = json.dumps({"query": f"目录{i}", "chars": chars})
+                yield {i: DeltaToolCall(name="large_result", json_args=args, tool_call_id=f"call_{i}")}
+        else:
+            seen["model_chars"] = sum(len(part.model_response_str()) for part in messages[-1].parts
+                                      if isinstance(part, ToolReturnPart))
+            yield "完成"
+
+    return FunctionModel(stream_function=stream)
+
+
+async def request(server, calls: int, chars: int):
+    seen = {}
+    agent = Agent(fake_model(calls, chars, seen), mcp_servers=[server])
+    run = StreamRun()
+    gc.collect()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    run.start(web_server.generate_stream(agent, "列出文件", None, [], run), lambda _: None)
+    result_bytes = 0
+    async for chunk in run.read():
+        for line in chunk.splitlines():
+            if json.loads(line)["type"] == "tool_result":
+                result_bytes += len(line)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - base
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - base
+    return {
+        "elapsed": elapsed,
+        "model_chars": seen.get("model_chars", 0),
+        "event_bytes": result_bytes,
+        "history_bytes": len(run.model_messages or ""),
+        "peak": peak,
+        "retained": retained,
+    }
+
+
+async def bench(args):
+    server = MCPServerStdio(command=sys.executable, args=[FAKE_SERVER], env=dict(os.environ))
+    async with server:
+        await server.list_tools()
+        with tempfile.TemporaryDirectory() as directory:
+            store = ToolResultStore(directory)
+            print(f"每次回复{args.calls}个调用，每个结果{args.chars}个字符")
+            tracemalloc.start()
+            for limit in args.limit:
+                # 与web_server相同的顺序：缓存在截断之上，缓存保存截断后的结果
+                cache = ToolResultCache(["large_result"], max_bytes=1 << 30)
+                wrapped = TrackedMCPServer(CachingMCPServer(
+                    TruncatingMCPServer(server, ToolResultLimits({}, default=limit), store), cache))
+                for attempt in ("首次", "缓存命中"):
+                    stored = store.stored
+                    stats = await request(wrapped, args.calls, args.chars)
+                    label = f"上限={limit or '不限'} {attempt}"
+                    print(f"{label:<16} 模型收到={stats['model_chars']:>10}字符  "
+                          f"tool_result事件={stats['event_bytes']:>10}字节  对话历史={stats['history_bytes']:>10}字节  "
+                          f"写入文件={store.stored - stored}  "
+                          f"内存峰值={stats['peak'] / 1e6:7.1f}MB  请求后持有={stats['retained'] / 1e6:6.1f}MB  "
+                          f"耗时={stats['elapsed']:.2f}s")
+            tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="大工具结果的截断基准测试")
+    parser.add_argument("--chars", type=int, default=2_000_000, help="每个工具结果的字符数")
+    parser.add_argument("--calls", type=int, default=3, help="一次回复中的工具调用数")
+    parser.add_argument("--limit", type=int, nargs="+", default=[0, 20000],
+                        help="要对比的结果字符数上限，0表示不限制")
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+基准测试用的本地MCP服务器
+
+提供一个search工具，每次调用同步阻塞--delay秒，模拟一次只能处理一个请求的单线程stdio服务器；
+以及一个slow_search工具，按参数指定的秒数异步等待后返回，模拟可以并发处理请求的服务器；
+large_result工具返回指定字符数的文本，模拟网盘文件列表、网页抓取之类的大结果。
+
+用法:
+    python benchmarks/fake_mcp_server.py --delay 0.05
+"""
+import argparse
+import asyncio
+import time
+
+from mcp.server.fastmcp import FastMCP
+
+mcp = FastMCP("fake-search")
+DELAY = 0.05
+
+
+@mcp.tool()
+def search(query: str) -> str:
+    """搜索（测试用，固定延迟后返回）"""
+    time.sleep(DELAY)
+    return f"results for {query}"
+
+
+@mcp.tool()
+async def slow_search(query: str, seconds: float) -> str:
+    """搜索（测试用，等待seconds秒后返回）"""
+    await asyncio.sleep(seconds)
+    return f"results for {query} after {seconds}s"
+
+
+@mcp.tool()
+def large_result(query: str, chars: int) -> str:
+    """返回chars个字符的结果（测试用）"""
+    line = f"{query}: 文件名称与大小等信息\n"
+    return (line * (chars // len(line) + 1))[:chars]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="基准测试用的本地MCP服务器")
+    parser.add_argument("--delay", type=float, default=0.05, help="每次工具调用的耗时（秒）")
+    DELAY = parser.parse_args().delay
+    mcp.run()
@@ -0,0 +1,72 @@
+"""
+HTTP压测脚本
+
+以固定并发持续请求一个接口，统计吞吐量和延迟分位数。
+分别以MCP_WORKERS=1、2、4启动服务并运行本脚本，即可对比多进程的吞吐扩展情况：
+
+    MCP_WORKERS=4 python web_server.py
+    python benchmarks/load_test.py --url http://localhost:8000/api/conversations --concurrency 64
+
+对/api/query压测时需要配合可控的模型服务（例如本地的OpenAI兼容桩服务），否则结果主要反映上游延迟：
+
+    python benchmarks/load_test.py --url http://localhost:8000/api/query --method POST \\
+        --body '{"query": "你好", "history_turns": 0}'
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+
+async def worker(client: httpx.AsyncClient, args, deadline: float, latencies, errors):
+    body = json.loads(args.body) if args.body else None
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await client.request(args.method, args.url, json=body)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+                continue
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+async def run(args):
+    latencies, errors = [], []
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+        deadline = time.perf_counter() + args.duration
+        await asyncio.gather(*[
+            worker(client, args, deadline, latencies, errors)
+            for _ in range(args.concurrency)
+        ])
+
+    if not latencies:
+        print(f"没有成功的请求，错误: {errors[:10]}")
+        return
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"请求数: {len(latencies)}  失败: {len(errors)}")
+    print(f"吞吐量: {len(latencies) / args.duration:.1f} req/s")
+    print(f"延迟: p50={statistics.median(latencies):.2f}ms  p99={p99:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP压测")
+    parser.add_argument("--url", default="http://localhost:8000/api/conversations")
+    parser.add_argument("--method", default="GET")
+    parser.add_argument("--body", default=None, help="JSON请求体")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0, help="压测时长（秒）")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
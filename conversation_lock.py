@@ -0,0 +1,182 @@
+from typing import Any, Dict, Optional
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# 同一对话已有请求在处理时的策略：queue（排队）、reject（拒绝）、cancel（取消之前的请求）
+CONVERSATION_POLICY = os.getenv("MCP_CONVERSATION_POLICY", "queue").lower()
+# queue和cancel策略下等待前一个请求结束的最长时间（秒）
+CONVERSATION_LOCK_TIMEOUT = float(os.getenv("MCP_CONVERSATION_LOCK_TIMEOUT", "120"))
+
+POLICIES = ("queue", "reject", "cancel")
+
+
+class ConversationBusy(Exception):
+    """对话正在处理其他请求（reject策略）或等待超时"""
+
+
+class _Slot:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        # 持有和正在等待该对话的请求数，在第一次await之前更新，同时到达的请求也能看到彼此
+        self.users = 0
+        # 最新的租约（持有中或等待中），cancel策略下新请求取消的是它
+        self.lease: Optional["ConversationLease"] = None
+
+
+class ConversationLease:
+    """一次对话处理权，release可以重复调用"""
+
+    def __init__(self, locks: "ConversationLocks", conversation_id: str, slot: _Slot):
+        self._locks = locks
+        self.conversation_id = conversation_id
+        self._slot = slot
+        # 等待获取锁的任务，被取消时不等前一个请求结束
+        self._acquiring: Optional[asyncio.Future] = None
+        self.acquired = False
+        # 被取消时需要一并取消的任务，由处理请求的代码通过set_owner登记
+        self.owner: Optional[asyncio.Task] = None
+        # 本轮对话的运行（stream_runs.StreamRun），cancel策略下没有订阅者时直接取消
+        self.run: Optional[Any] = None
+        self.released = False
+        # 被同一对话的新请求取消（cancel策略），用于区分客户端断开等其他原因的取消
+        self.superseded = False
+
+    def set_owner(self, task: Optional[asyncio.Task]):
+        """
+        登记被取消时需要一并取消的任务，None表示不取消任何任务
+
+        /api/query登记处理请求的任务；流式请求的处理函数返回响应后，同一个任务还要发送响应，
+        不能被取消，只登记subscribe_stream中转发事件的任务。
+        """
+        self.owner = task
+
+    def bind_run(self, run: Any):
+        """
+        登记本轮对话的运行
+
+        运行开始后到流式响应开始转发之前，以及客户端断开等待续传期间，运行没有订阅者，
+        此时cancel直接取消运行；登记之前已被取消时立即取消。
+        """
+        self.run = run
+        if self.superseded:
+            self._cancel_run()
+
+    def cancel(self):
+        self.superseded = True
+        if not self.acquired:
+            # 还在等待前一个请求结束，不再等待
+            if self._acquiring is not None:
+                self._acquiring.cancel()
+            return
+        self._cancel_run()
+        if self.owner is not None and not self.owner.done():
+            self.owner.cancel()
+
+    def _cancel_run(self):
+        if self.run is not None and self.run.subscribers <= 0:
+            self.run.cancel("superseded")
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.owner = None
+        self.run = None
+        if self._slot.lease is self:
+            self._slot.lease = None
+        if self.acquired:
+            self._slot.lock.release()
+        self._locks._leave(self.conversation_id, self._slot)
+
+
+class ConversationLocks:
+    """
+    按对话串行化请求
+
+    同一对话的请求依次读取历史、生成回复、写入历史，避免并发请求交错写入破坏问答配对；
+    不同对话之间互不影响。
+    """
+
+    def __init__(self, policy: str = CONVERSATION_POLICY, timeout: float = CONVERSATION_LOCK_TIMEOUT):
+        if policy not in POLICIES:
+            logger.warning(f"未知的对话并发策略 {policy}，使用queue")
+            policy = "queue"
+        self.policy = policy
+        self.timeout = timeout
+        self._slots: Dict[str, _Slot] = {}
+        self.waits = 0
+        self.rejected = 0
+        self.cancelled = 0
+
+    async def acquire(self, conversation_id: str, timeout: Optional[float] = None) -> ConversationLease:
+        """
+        获取对话的处理权
+
+        Args:
+            conversation_id: 对话ID
+            timeout: 调用方最多等待的秒数（例如请求剩余的时间），比self.timeout短时以它为准
+
+        Returns:
+            处理结束后需要release的租约
+
+        Raises:
+            ConversationBusy: reject策略下对话正忙，或等待超过self.timeout
+            asyncio.TimeoutError: 先到达调用方的timeout
+        """
+        slot = self._slots.get(conversation_id)
+        if slot is None:
+            slot = self._slots[conversation_id] = _Slot()
+
+        # 从这里到登记租约之间没有await，同时到达的请求按到达顺序看到彼此
+        if slot.users > 0:
+            if self.policy == "reject":
+                self.rejected += 1
+                raise ConversationBusy("该对话正在处理其他请求")
+            if self.policy == "cancel" and slot.lease is not None and not slot.lease.superseded:
+                logger.info(f"对话 {conversation_id} 有新请求，取消之前的请求")
+                slot.lease.cancel()
+                self.cancelled += 1
+            self.waits += 1
+
+        lease = ConversationLease(self, conversation_id, slot)
+        slot.lease = lease
+        slot.users += 1
+        caller_first = timeout is not None and (self.timeout is None or timeout < self.timeout)
+        acquiring = lease._acquiring = asyncio.ensure_future(slot.lock.acquire())
+        try:
+            await asyncio.wait_for(acquiring, timeout if caller_first else self.timeout)
+        except BaseException as e:
+            # 等待被中断时锁可能已经到手，一并释放
+            lease.acquired = acquiring.done() and not acquiring.cancelled() and acquiring.exception() is None
+            lease.release()
+            if isinstance(e, asyncio.TimeoutError):
+                if caller_first:
+                    raise
+                raise ConversationBusy("等待该对话的上一个请求结束超时")
+            if isinstance(e, asyncio.CancelledError) and lease.superseded and acquiring.cancelled():
+                raise ConversationBusy("该请求已被同一对话的新请求取消")
+            raise
+        lease.acquired = True
+        lease._acquiring = None
+        if lease.superseded:
+            # 获得锁的同时被更新的请求取消
+            lease.release()
+            raise ConversationBusy("该请求已被同一对话的新请求取消")
+        return lease
+
+    def _leave(self, conversation_id: str, slot: _Slot):
+        slot.users -= 1
+        if slot.users <= 0 and self._slots.get(conversation_id) is slot:
+            del self._slots[conversation_id]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "policy": self.policy,
+            "active": len(self._slots),
+            "waits": self.waits,
+            "rejected": self.rejected,
+            "cancelled": self.cancelled,
+        }
@@ -0,0 +1,832 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
+import base64
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from pydantic import BaseModel, Field, PrivateAttr
+
+logger = logging.getLogger(__name__)
+
+# 对话存储后端配置
+CONVERSATION_STORE_BACKEND = os.getenv("MCP_CONVERSATION_STORE", "sqlite")
+CONVERSATION_DB_PATH = os.getenv("MCP_CONVERSATION_DB_PATH", "conversations.db")
+
+# 对话缓存配置（条目数为0时不启用缓存）
+CONVERSATION_CACHE_SIZE = int(os.getenv("MCP_CONVERSATION_CACHE_SIZE", "1000"))
+CONVERSATION_CACHE_MAX_BYTES = int(os.getenv("MCP_CONVERSATION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CONVERSATION_CACHE_TTL = float(os.getenv("MCP_CONVERSATION_CACHE_TTL", "1800"))
+
+# 多进程部署时其他进程也会写入数据库，缓存命中后需要与数据库校验
+WORKERS = int(os.getenv("MCP_WORKERS", "1"))
+# 是否校验缓存，默认在多进程部署时启用；其他服务实例共用同一个数据库文件时需要显式开启
+CONVERSATION_CACHE_SHARED = (os.getenv("MCP_CONVERSATION_CACHE_SHARED")
+                             or ("true" if WORKERS > 1 else "false")).lower() in ("1", "true", "yes")
+
+# 估算内存占用时每条消息和每个对话的固定开销（对象头、时间戳等）
+_MESSAGE_OVERHEAD_BYTES = 200
+_CONVERSATION_OVERHEAD_BYTES = 500
+
+
+class ChatMessage(BaseModel):
+    """聊天消息模型"""
+    role: str  # "user" 或 "assistant"
+    content: str
+    timestamp: datetime = Field(default_factory=datetime.now)
+    # 助手消息附带本轮完整的PydanticAI消息（含工具调用和结果）的JSON，只用于构建历史，不返回给前端
+    model_messages: Optional[str] = Field(default=None, exclude=True)
+    # 消息（助手消息包括本轮的工具调用和结果）的token数，写入时计算并随消息保存
+    tokens: Optional[int] = Field(default=None, exclude=True)
+    # 反序列化后的PydanticAI消息，缓存在对象上避免每次请求重复解析
+    _decoded: Optional[list] = PrivateAttr(default=None)
+
+
+class Conversation(BaseModel):
+    """对话模型"""
+    id: str
+    title: str
+    messages: List[ChatMessage] = []
+    created_at: datetime = Field(default_factory=datetime.now)
+    updated_at: datetime = Field(default_factory=datetime.now)
+
+
+class HistorySummary(BaseModel):
+    """对话较早部分的滚动摘要，构建历史时代替被摘要的消息"""
+    content: str
+    covered: int  # 摘要覆盖了对话开头的多少条消息
+    tokens: int = 0
+    updated_at: datetime = Field(default_factory=datetime.now)
+
+
+class ConversationSummary(BaseModel):
+    """对话摘要模型，不包含消息内容"""
+    id: str
+    title: str
+    created_at: datetime
+    updated_at: datetime
+    message_count: int = 0
+
+
+def _to_db_time(value: datetime) -> str:
+    """统一时间格式，保证按字符串排序与按时间排序一致"""
+    return value.isoformat(timespec="microseconds")
+
+
+def encode_cursor(summary: ConversationSummary) -> str:
+    """将一页最后一条摘要的位置编码为不透明的游标"""
+    raw = f"{_to_db_time(summary.updated_at)}|{summary.id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    """
+    解析游标
+
+    Returns:
+        (更新时间, 对话ID)
+
+    Raises:
+        ValueError: 游标格式错误
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        updated_at, conversation_id = raw.split("|", 1)
+        datetime.fromisoformat(updated_at)
+    except Exception:
+        raise ValueError(f"无效的分页游标: {cursor}")
+    return updated_at, conversation_id
+
+
+class ConversationStore(ABC):
+    """对话存储接口，所有存储后端都需要实现以下方法"""
+
+    @abstractmethod
+    def create(self, conversation: Conversation) -> None:
+        """保存一个新对话（包含其已有消息）"""
+
+    @abstractmethod
+    def exists(self, conversation_id: str) -> bool:
+        """判断对话是否存在"""
+
+    @abstractmethod
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        """获取完整对话，不存在时返回None"""
+
+    @abstractmethod
+    def get_summary(self, conversation_id: str) -> Optional[ConversationSummary]:
+        """获取对话摘要（标题、时间和消息数），不加载消息"""
+
+    @abstractmethod
+    def list_summaries(self, limit: int, cursor: Optional[str] = None) -> Tuple[List[ConversationSummary], Optional[str]]:
+        """
+        按更新时间倒序分页列出对话摘要
+
+        Args:
+            limit: 每页数量
+            cursor: 上一页返回的游标，为空时从最新的对话开始
+
+        Returns:
+            (本页摘要列表, 下一页游标)，没有更多数据时游标为None
+
+        Raises:
+            ValueError: 游标无效
+        """
+
+    @abstractmethod
+    def get_recent_messages(self, conversation_id: str, limit: int) -> List[ChatMessage]:
+        """按时间顺序返回对话最近的limit条消息"""
+
+    @abstractmethod
+    def get_messages_after(self, conversation_id: str, offset: int) -> List[ChatMessage]:
+        """按时间顺序返回对话中前offset条之后的所有消息"""
+
+    @abstractmethod
+    def append_messages(self, conversation_id: str, messages: List[ChatMessage],
+                        updated_at: datetime, title: Optional[str] = None) -> None:
+        """追加消息并更新修改时间，可同时更新标题"""
+
+    @abstractmethod
+    def update_title(self, conversation_id: str, title: str, updated_at: datetime) -> Optional[Conversation]:
+        """更新对话标题，不存在时返回None"""
+
+    @abstractmethod
+    def get_history_summary(self, conversation_id: str) -> Optional[HistorySummary]:
+        """获取对话较早部分的摘要，没有时返回None"""
+
+    @abstractmethod
+    def save_history_summary(self, conversation_id: str, summary: HistorySummary) -> None:
+        """保存（替换）对话的摘要，对话已被删除时忽略"""
+
+    @abstractmethod
+    def delete(self, conversation_id: str) -> bool:
+        """删除对话，返回是否删除成功"""
+
+    @abstractmethod
+    def clear(self) -> None:
+        """删除所有对话"""
+
+    def close(self) -> None:
+        """释放存储资源"""
+
+
+class MemoryConversationStore(ConversationStore):
+    """基于进程内字典的存储，重启后数据丢失，主要用于开发和测试"""
+
+    def __init__(self):
+        self._conversations: Dict[str, Conversation] = {}
+        # 最近使用索引：从旧到新排列，每次更新时移动到末尾，无需每次列表时排序
+        self._recency: "OrderedDict[str, None]" = OrderedDict()
+        self._history_summaries: Dict[str, HistorySummary] = {}
+
+    def _touch(self, conversation_id: str) -> None:
+        self._recency[conversation_id] = None
+        self._recency.move_to_end(conversation_id)
+
+    def create(self, conversation: Conversation) -> None:
+        self._conversations[conversation.id] = conversation
+        self._touch(conversation.id)
+
+    def exists(self, conversation_id: str) -> bool:
+        return conversation_id in self._conversations
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        return self._conversations.get(conversation_id)
+
+    def get_summary(self, conversation_id: str) -> Optional[ConversationSummary]:
+        conversation = self._conversations.get(conversation_id)
+        if not conversation:
+            return None
+        return ConversationSummary(
+            id=conversation.id,
+            title=conversation.title,
+            created_at=conversation.created_at,
+            updated_at=conversation.updated_at,
+            message_count=len(conversation.messages)
+        )
+
+    def list_summaries(self, limit: int, cursor: Optional[str] = None) -> Tuple[List[ConversationSummary], Optional[str]]:
+        position = decode_cursor(cursor) if cursor else None
+        summaries = []
+        for conversation_id in reversed(self._recency):
+            conversation = self._conversations[conversation_id]
+            if position and (_to_db_time(conversation.updated_at), conversation_id) >= position:
+                continue
+            summaries.append(self.get_summary(conversation_id))
+            if len(summaries) > limit:
+                break
+        if len(summaries) > limit:
+            summaries = summaries[:limit]
+            return summaries, encode_cursor(summaries[-1])
+        return summaries, None
+
+    def get_recent_messages(self, conversation_id: str, limit: int) -> List[ChatMessage]:
+        conversation = self._conversations.get(conversation_id)
+        if not conversation or limit <= 0:
+            return []
+        return conversation.messages[-limit:]
+
+    def get_messages_after(self, conversation_id: str, offset: int) -> List[ChatMessage]:
+        conversation = self._conversations.get(conversation_id)
+        if not conversation:
+            return []
+        return conversation.messages[offset:]
+
+    def append_messages(self, conversation_id: str, messages: List[ChatMessage],
+                        updated_at: datetime, title: Optional[str] = None) -> None:
+        conversation = self._conversations[conversation_id]
+        conversation.messages.extend(messages)
+        conversation.updated_at = updated_at
+        if title is not None:
+            conversation.title = title
+        self._touch(conversation_id)
+
+    def update_title(self, conversation_id: str, title: str, updated_at: datetime) -> Optional[Conversation]:
+        conversation = self._conversations.get(conversation_id)
+        if not conversation:
+            return None
+        conversation.title = title
+        conversation.updated_at = updated_at
+        self._touch(conversation_id)
+        return conversation
+
+    def get_history_summary(self, conversation_id: str) -> Optional[HistorySummary]:
+        return self._history_summaries.get(conversation_id)
+
+    def save_history_summary(self, conversation_id: str, summary: HistorySummary) -> None:
+        if conversation_id in self._conversations:
+            self._history_summaries[conversation_id] = summary
+
+    def delete(self, conversation_id: str) -> bool:
+        self._recency.pop(conversation_id, None)
+        self._history_summaries.pop(conversation_id, None)
+        return self._conversations.pop(conversation_id, None) is not None
+
+    def clear(self) -> None:
+        self._conversations = {}
+        self._recency = OrderedDict()
+        self._history_summaries = {}
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    基于SQLite的持久化存储
+
+    对话元数据和消息分表存放，消息表只追加不改写，
+    追加一轮对话只需要一次小事务，无需重新序列化整个对话。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS conversations (
+        id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        message_count INTEGER NOT NULL DEFAULT 0
+    );
+    DROP INDEX IF EXISTS idx_conversations_updated_at;
+    CREATE INDEX IF NOT EXISTS idx_conversations_recency
+        ON conversations (updated_at, id);
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        model_messages TEXT,
+        tokens INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_messages_conversation_id
+        ON messages (conversation_id, id);
+    CREATE TABLE IF NOT EXISTS history_summaries (
+        conversation_id TEXT PRIMARY KEY,
+        content TEXT NOT NULL,
+        covered INTEGER NOT NULL,
+        tokens INTEGER NOT NULL,
+        updated_at TEXT NOT NULL
+    );
+    """
+
+    def __init__(self, db_path: str = CONVERSATION_DB_PATH):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        # WAL模式下读写互不阻塞，NORMAL同步级别在WAL下仍能保证崩溃一致性
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        with self._conn:
+            self._conn.executescript(self.SCHEMA)
+            self._migrate()
+        logger.info(f"已打开对话数据库: {db_path}")
+
+    def _migrate(self) -> None:
+        """为旧版本创建的数据库补充新增的列"""
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(messages)")}
+        if "model_messages" not in columns:
+            self._conn.execute("ALTER TABLE messages ADD COLUMN model_messages TEXT")
+        if "tokens" not in columns:
+            self._conn.execute("ALTER TABLE messages ADD COLUMN tokens INTEGER")
+
+    @staticmethod
+    def _row_to_message(row: sqlite3.Row) -> ChatMessage:
+        return ChatMessage(
+            role=row["role"],
+            content=row["content"],
+            timestamp=datetime.fromisoformat(row["timestamp"]),
+            model_messages=row["model_messages"],
+            tokens=row["tokens"]
+        )
+
+    @staticmethod
+    def _row_to_conversation(row: sqlite3.Row, messages: List[ChatMessage]) -> Conversation:
+        return Conversation(
+            id=row["id"],
+            title=row["title"],
+            messages=messages,
+            created_at=datetime.fromisoformat(row["created_at"]),
+            updated_at=datetime.fromisoformat(row["updated_at"])
+        )
+
+    @staticmethod
+    def _row_to_summary(row: sqlite3.Row) -> ConversationSummary:
+        return ConversationSummary(
+            id=row["id"],
+            title=row["title"],
+            created_at=datetime.fromisoformat(row["created_at"]),
+            updated_at=datetime.fromisoformat(row["updated_at"]),
+            message_count=row["message_count"]
+        )
+
+    def _insert_messages(self, conversation_id: str, messages: List[ChatMessage]) -> None:
+        self._conn.executemany(
+            "INSERT INTO messages (conversation_id, role, content, timestamp, model_messages, tokens) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(conversation_id, m.role, m.content, _to_db_time(m.timestamp), m.model_messages, m.tokens)
+             for m in messages]
+        )
+
+    def create(self, conversation: Conversation) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO conversations (id, title, created_at, updated_at, message_count) VALUES (?, ?, ?, ?, ?)",
+                (conversation.id, conversation.title, _to_db_time(conversation.created_at),
+                 _to_db_time(conversation.updated_at), len(conversation.messages))
+            )
+            if conversation.messages:
+                self._insert_messages(conversation.id, conversation.messages)
+
+    def exists(self, conversation_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+        return row is not None
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            message_rows = self._conn.execute(
+                "SELECT role, content, timestamp, model_messages, tokens FROM messages WHERE conversation_id = ? ORDER BY id",
+                (conversation_id,)
+            ).fetchall()
+        return self._row_to_conversation(row, [self._row_to_message(m) for m in message_rows])
+
+    def get_summary(self, conversation_id: str) -> Optional[ConversationSummary]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return self._row_to_summary(row)
+
+    def list_summaries(self, limit: int, cursor: Optional[str] = None) -> Tuple[List[ConversationSummary], Optional[str]]:
+        # 基于(updated_at, id)复合索引的键集分页，翻页成本与页数无关
+        if cursor:
+            updated_at, conversation_id = decode_cursor(cursor)
+            sql = ("SELECT * FROM conversations WHERE (updated_at, id) < (?, ?) "
+                   "ORDER BY updated_at DESC, id DESC LIMIT ?")
+            params = (updated_at, conversation_id, limit + 1)
+        else:
+            sql = "SELECT * FROM conversations ORDER BY updated_at DESC, id DESC LIMIT ?"
+            params = (limit + 1,)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        summaries = [self._row_to_summary(row) for row in rows[:limit]]
+        next_cursor = encode_cursor(summaries[-1]) if len(rows) > limit else None
+        return summaries, next_cursor
+
+    def get_recent_messages(self, conversation_id: str, limit: int) -> List[ChatMessage]:
+        if limit <= 0:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content, timestamp, model_messages, tokens FROM messages WHERE conversation_id = ? "
+                "ORDER BY id DESC LIMIT ?",
+                (conversation_id, limit)
+            ).fetchall()
+        return [self._row_to_message(m) for m in reversed(rows)]
+
+    def get_messages_after(self, conversation_id: str, offset: int) -> List[ChatMessage]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content, timestamp, model_messages, tokens FROM messages WHERE conversation_id = ? "
+                "ORDER BY id LIMIT -1 OFFSET ?",
+                (conversation_id, offset)
+            ).fetchall()
+        return [self._row_to_message(m) for m in rows]
+
+    def append_messages(self, conversation_id: str, messages: List[ChatMessage],
+                        updated_at: datetime, title: Optional[str] = None) -> None:
+        with self._lock, self._conn:
+            self._insert_messages(conversation_id, messages)
+            if title is not None:
+                self._conn.execute(
+                    "UPDATE conversations SET updated_at = ?, message_count = message_count + ?, title = ? "
+                    "WHERE id = ?",
+                    (_to_db_time(updated_at), len(messages), title, conversation_id)
+                )
+            else:
+                self._conn.execute(
+                    "UPDATE conversations SET updated_at = ?, message_count = message_count + ? WHERE id = ?",
+                    (_to_db_time(updated_at), len(messages), conversation_id)
+                )
+
+    def update_title(self, conversation_id: str, title: str, updated_at: datetime) -> Optional[Conversation]:
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE conversations SET title = ?, updated_at = ? WHERE id = ?",
+                (title, _to_db_time(updated_at), conversation_id)
+            )
+        if cursor.rowcount == 0:
+            return None
+        return self.get(conversation_id)
+
+    def get_history_summary(self, conversation_id: str) -> Optional[HistorySummary]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM history_summaries WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return HistorySummary(
+            content=row["content"],
+            covered=row["covered"],
+            tokens=row["tokens"],
+            updated_at=datetime.fromisoformat(row["updated_at"])
+        )
+
+    def save_history_summary(self, conversation_id: str, summary: HistorySummary) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO history_summaries (conversation_id, content, covered, tokens, updated_at) "
+                "SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM conversations WHERE id = ?)",
+                (conversation_id, summary.content, summary.covered, summary.tokens,
+                 _to_db_time(summary.updated_at), conversation_id)
+            )
+
+    def delete(self, conversation_id: str) -> bool:
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "DELETE FROM conversations WHERE id = ?", (conversation_id,))
+            self._conn.execute(
+                "DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            self._conn.execute(
+                "DELETE FROM history_summaries WHERE conversation_id = ?", (conversation_id,))
+        return cursor.rowcount > 0
+
+    def clear(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM messages")
+            self._conn.execute("DELETE FROM conversations")
+            self._conn.execute("DELETE FROM history_summaries")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def _estimate_message_size(message: ChatMessage) -> int:
+    size = len(message.content.encode("utf-8")) + _MESSAGE_OVERHEAD_BYTES
+    if message.model_messages:
+        size += len(message.model_messages)
+    return size
+
+
+def _estimate_conversation_size(conversation: Conversation) -> int:
+    return (len(conversation.title.encode("utf-8")) + _CONVERSATION_OVERHEAD_BYTES
+            + sum(_estimate_message_size(m) for m in conversation.messages))
+
+
+class CachedConversationStore(ConversationStore):
+    """
+    带LRU/TTL淘汰的对话缓存
+
+    包装一个持久化存储，读取未命中时从后端加载完整对话，写入时同时写后端并更新缓存（write-through）。
+    缓存同时受条目数、估算字节数和空闲时间限制，避免长时间运行后内存持续增长。
+
+    未缓存完整对话时（例如只读取了最近消息的窗口），对话摘要单独缓存，同样受条目数和空闲时间限制。
+
+    shared为True时（后端是其他进程也可能写入的数据库文件），命中后会用对话摘要校验缓存，
+    其他进程追加的消息只按增量补齐，不重新加载整个对话；对话摘要每次从后端读取。
+    """
+
+    def __init__(self, backend: ConversationStore, max_entries: int = CONVERSATION_CACHE_SIZE,
+                 max_bytes: int = CONVERSATION_CACHE_MAX_BYTES, ttl: float = CONVERSATION_CACHE_TTL,
+                 shared: bool = False):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.shared = shared
+        self._lock = threading.Lock()
+        # conversation_id -> (对话, 估算字节数, 最后访问时间)，从旧到新排列
+        self._entries: "OrderedDict[str, Tuple[Conversation, int, float]]" = OrderedDict()
+        self._bytes = 0
+        # conversation_id -> (对话摘要, 最后访问时间)，只保存未缓存完整对话的摘要
+        self._summaries: "OrderedDict[str, Tuple[ConversationSummary, float]]" = OrderedDict()
+        # 写入次数，从后端读取摘要期间有写入时不缓存读到的摘要
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, conversation_id: str) -> None:
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def _evict(self, now: float) -> None:
+        """淘汰过期条目，再按LRU顺序淘汰直到满足容量限制"""
+        while self._entries:
+            conversation_id, (_, _, last_access) = next(iter(self._entries.items()))
+            if now - last_access > self.ttl:
+                self._remove(conversation_id)
+                self.expirations += 1
+            elif len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(conversation_id)
+                self.evictions += 1
+            else:
+                break
+        while self._summaries:
+            conversation_id, (_, last_access) = next(iter(self._summaries.items()))
+            if now - last_access <= self.ttl and len(self._summaries) <= self.max_entries:
+                break
+            del self._summaries[conversation_id]
+
+    def _put(self, conversation: Conversation) -> None:
+        now = time.monotonic()
+        self._remove(conversation.id)
+        self._summaries.pop(conversation.id, None)
+        size = _estimate_conversation_size(conversation)
+        self._entries[conversation.id] = (conversation, size, now)
+        self._bytes += size
+        self._evict(now)
+
+    def _lookup(self, conversation_id: str) -> Optional[Conversation]:
+        """查找缓存并刷新访问时间，不统计命中率"""
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        conversation, size, last_access = entry
+        if now - last_access > self.ttl:
+            self._remove(conversation_id)
+            self.expirations += 1
+            return None
+        self._entries[conversation_id] = (conversation, size, now)
+        self._entries.move_to_end(conversation_id)
+        return conversation
+
+    def _refresh(self, conversation: Conversation) -> Optional[Conversation]:
+        """与后端摘要比对，补齐其他进程追加的消息；对话已被删除或无法增量补齐时返回None"""
+        summary = self.backend.get_summary(conversation.id)
+        cached = len(conversation.messages)
+        if summary is None or summary.message_count < cached:
+            return None
+        if summary.message_count > cached:
+            # 一次查询读取缓存之后的全部消息：读取摘要后其他进程可能又追加了消息，
+            # 按数量读取最近的消息会错位；数量与摘要不一致时放弃缓存，重新加载
+            messages = self.backend.get_messages_after(conversation.id, cached)
+            if cached + len(messages) != summary.message_count:
+                return None
+            with self._lock:
+                entry = self._entries.get(conversation.id)
+                if entry is not None and entry[0] is conversation:
+                    conversation.messages.extend(messages)
+                    added = sum(_estimate_message_size(m) for m in messages)
+                    self._entries[conversation.id] = (conversation, entry[1] + added, entry[2])
+                    self._bytes += added
+                    self._evict(time.monotonic())
+        conversation.title = summary.title
+        conversation.updated_at = summary.updated_at
+        return conversation
+
+    def _cached(self, conversation_id: str) -> Optional[Conversation]:
+        """读取缓存中的对话（shared时先校验），统计命中率；未命中或缓存失效时返回None"""
+        with self._lock:
+            conversation = self._lookup(conversation_id)
+            if conversation is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        if not self.shared:
+            return conversation
+        conversation = self._refresh(conversation)
+        if conversation is None:
+            with self._lock:
+                self._remove(conversation_id)
+        return conversation
+
+    def _load(self, conversation_id: str) -> Optional[Conversation]:
+        """读取对话，未命中时从后端加载并放入缓存"""
+        conversation = self._cached(conversation_id)
+        if conversation is not None:
+            return conversation
+
+        conversation = self.backend.get(conversation_id)
+        if conversation is not None:
+            with self._lock:
+                self._put(conversation)
+        return conversation
+
+    def stats(self) -> Dict[str, float]:
+        """返回缓存命中、未命中、淘汰计数和当前容量"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "summaries": len(self._summaries),
+            }
+
+    def create(self, conversation: Conversation) -> None:
+        self.backend.create(conversation)
+        with self._lock:
+            self._put(conversation)
+
+    def exists(self, conversation_id: str) -> bool:
+        if not self.shared:
+            with self._lock:
+                if self._lookup(conversation_id) is not None:
+                    return True
+        return self.backend.exists(conversation_id)
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        return self._load(conversation_id)
+
+    def get_summary(self, conversation_id: str) -> Optional[ConversationSummary]:
+        if self.shared:
+            return self.backend.get_summary(conversation_id)
+        with self._lock:
+            conversation = self._lookup(conversation_id)
+            if conversation is not None:
+                return ConversationSummary(
+                    id=conversation.id,
+                    title=conversation.title,
+                    created_at=conversation.created_at,
+                    updated_at=conversation.updated_at,
+                    message_count=len(conversation.messages)
+                )
+            entry = self._summaries.get(conversation_id)
+            now = time.monotonic()
+            if entry is not None and now - entry[1] <= self.ttl:
+                self._summaries[conversation_id] = (entry[0], now)
+                self._summaries.move_to_end(conversation_id)
+                return entry[0].model_copy()
+            writes = self._writes
+
+        summary = self.backend.get_summary(conversation_id)
+        if summary is not None:
+            with self._lock:
+                if conversation_id not in self._entries and writes == self._writes:
+                    self._summaries[conversation_id] = (summary.model_copy(), time.monotonic())
+                    self._summaries.move_to_end(conversation_id)
+                    self._evict(time.monotonic())
+        return summary
+
+    def list_summaries(self, limit: int, cursor: Optional[str] = None) -> Tuple[List[ConversationSummary], Optional[str]]:
+        return self.backend.list_summaries(limit, cursor)
+
+    def get_recent_messages(self, conversation_id: str, limit: int) -> List[ChatMessage]:
+        if limit <= 0:
+            return []
+        conversation = self._cached(conversation_id)
+        if conversation is None:
+            # 未命中时只从后端读取最近的limit条，不为了一个窗口加载整个对话，也不缓存不完整的对话
+            return self.backend.get_recent_messages(conversation_id, limit)
+        return conversation.messages[-limit:]
+
+    def get_messages_after(self, conversation_id: str, offset: int) -> List[ChatMessage]:
+        return self.backend.get_messages_after(conversation_id, offset)
+
+    def append_messages(self, conversation_id: str, messages: List[ChatMessage],
+                        updated_at: datetime, title: Optional[str] = None) -> None:
+        self.backend.append_messages(conversation_id, messages, updated_at, title=title)
+        with self._lock:
+            self._writes += 1
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                cached = self._summaries.get(conversation_id)
+                if cached is not None:
+                    summary = cached[0]
+                    summary.message_count += len(messages)
+                    summary.updated_at = updated_at
+                    if title is not None:
+                        summary.title = title
+                return
+            if self.shared:
+                # 其他进程可能同时追加，交给下次读取时按增量补齐
+                entry[0].updated_at = updated_at
+                return
+            conversation, size, _ = entry
+            conversation.messages.extend(messages)
+            conversation.updated_at = updated_at
+            if title is not None:
+                conversation.title = title
+            added = sum(_estimate_message_size(m) for m in messages)
+            self._entries[conversation_id] = (conversation, size + added, time.monotonic())
+            self._entries.move_to_end(conversation_id)
+            self._bytes += added
+            self._evict(time.monotonic())
+
+    def update_title(self, conversation_id: str, title: str, updated_at: datetime) -> Optional[Conversation]:
+        conversation = self.backend.update_title(conversation_id, title, updated_at)
+        with self._lock:
+            self._writes += 1
+            self._summaries.pop(conversation_id, None)
+            if conversation is None:
+                self._remove(conversation_id)
+            else:
+                self._put(conversation)
+        return conversation
+
+    def get_history_summary(self, conversation_id: str) -> Optional[HistorySummary]:
+        return self.backend.get_history_summary(conversation_id)
+
+    def save_history_summary(self, conversation_id: str, summary: HistorySummary) -> None:
+        self.backend.save_history_summary(conversation_id, summary)
+
+    def delete(self, conversation_id: str) -> bool:
+        with self._lock:
+            self._writes += 1
+            self._remove(conversation_id)
+            self._summaries.pop(conversation_id, None)
+        return self.backend.delete(conversation_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries = OrderedDict()
+            self._bytes = 0
+            self._summaries = OrderedDict()
+            self._writes += 1
+        self.backend.clear()
+
+    def close(self) -> None:
+        self.backend.close()
+
+
+def create_conversation_store(backend: str = CONVERSATION_STORE_BACKEND) -> ConversationStore:
+    """
+    根据配置创建对话存储后端
+
+    Args:
+        backend: 存储后端名称，支持"sqlite"和"memory"
+
+    Returns:
+        对话存储实例
+    """
+    if backend == "memory":
+        if WORKERS > 1:
+            logger.warning("内存对话存储无法在多个工作进程间共享，各进程将看到不同的对话")
+        logger.info("使用内存对话存储，重启后对话将丢失")
+        return MemoryConversationStore()
+    if backend != "sqlite":
+        logger.warning(f"未知的对话存储后端'{backend}'，使用sqlite")
+    store = SQLiteConversationStore(CONVERSATION_DB_PATH)
+    if CONVERSATION_CACHE_SIZE > 0:
+        logger.info(
+            f"启用对话缓存: 最多{CONVERSATION_CACHE_SIZE}个对话, {CONVERSATION_CACHE_MAX_BYTES}字节, 空闲{CONVERSATION_CACHE_TTL}秒过期"
+            + ("，命中时与数据库校验" if CONVERSATION_CACHE_SHARED else ""))
+        return CachedConversationStore(store, shared=CONVERSATION_CACHE_SHARED)
+    return store
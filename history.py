@@ -0,0 +1,165 @@
+from dataclasses import replace
+from typing import List, Optional, Tuple
+import logging
+import os
+
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    ModelResponse,
+    RetryPromptPart,
+    SystemPromptPart,
+    TextPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+
+from conversation_store import ChatMessage
+from tokenizer import MESSAGE_OVERHEAD_TOKENS, count_tokens
+
+logger = logging.getLogger(__name__)
+
+# 请求未指定history_token_budget时使用的历史token预算，0表示按history_turns选取历史
+HISTORY_TOKEN_BUDGET = int(os.getenv("MCP_HISTORY_TOKEN_BUDGET", "0"))
+
+
+def encode_turn(messages: List[ModelMessage]) -> str:
+    """
+    将一轮对话产生的PydanticAI消息（result.new_messages()）序列化为紧凑的JSON
+
+    系统提示符每次请求都会重新提供，不随历史保存。
+    """
+    compact = []
+    for message in messages:
+        if isinstance(message, ModelRequest):
+            parts = [part for part in message.parts if not isinstance(part, SystemPromptPart)]
+            if not parts:
+                continue
+            message = replace(message, parts=parts)
+        compact.append(message)
+    return ModelMessagesTypeAdapter.dump_json(compact).decode("utf-8")
+
+
+def decode_turn(user: ChatMessage, assistant: ChatMessage) -> List[ModelMessage]:
+    """
+    还原一轮对话的PydanticAI消息
+
+    有保存原生消息时包含工具调用和工具结果，解析结果缓存在消息对象上；
+    旧数据或解析失败时只用问答文本重建。
+    """
+    if assistant.model_messages:
+        if assistant._decoded is None:
+            try:
+                assistant._decoded = ModelMessagesTypeAdapter.validate_json(assistant.model_messages)
+            except Exception as e:
+                logger.warning(f"解析保存的模型消息失败，只使用文本历史: {str(e)}")
+                assistant._decoded = []
+        if assistant._decoded:
+            return assistant._decoded
+    return [
+        ModelRequest(parts=[UserPromptPart(user.content)]),
+        ModelResponse(parts=[TextPart(assistant.content)]),
+    ]
+
+
+def _part_text(part) -> str:
+    if isinstance(part, (TextPart, SystemPromptPart)):
+        return part.content
+    if isinstance(part, ToolCallPart):
+        return part.tool_name + part.args_as_json_str()
+    if isinstance(part, ToolReturnPart):
+        return part.model_response_str()
+    if isinstance(part, RetryPromptPart):
+        return part.model_response()
+    return ""
+
+
+def message_tokens(message: ChatMessage) -> int:
+    """
+    消息计入历史的token数，结果保存在message.tokens上
+
+    用户消息按问题文本计数；助手消息有原生消息时按本轮的回复、工具调用和工具结果计数
+    （用户问题已计入对应的用户消息）。新消息在写入前计算并随消息保存，
+    旧数据只在第一次读取时计算。
+    """
+    if message.tokens is not None:
+        return message.tokens
+    if message.role == "assistant" and message.model_messages:
+        model_messages = decode_turn(ChatMessage(role="user", content=""), message)
+        tokens = sum(
+            count_tokens(_part_text(part)) + MESSAGE_OVERHEAD_TOKENS
+            for model_message in model_messages
+            for part in model_message.parts
+            if not isinstance(part, UserPromptPart)
+        )
+    else:
+        tokens = count_tokens(message.content) + MESSAGE_OVERHEAD_TOKENS
+    message.tokens = tokens
+    return tokens
+
+
+def window_by_tokens(messages: List[ChatMessage], budget: int) -> Tuple[List[ChatMessage], bool]:
+    """
+    从最近的完整问答轮次开始向前选取，直到下一轮放不进token预算
+
+    Args:
+        messages: 按时间排序的最近消息
+        budget: 历史可用的token数
+
+    Returns:
+        (选中的消息, 是否因预算用完而停止)；第二项为False表示messages已全部放入，
+        调用方可以读取更早的消息继续选取
+    """
+    selected: List[ChatMessage] = []
+    used = 0
+    index = len(messages) - 1
+    while index > 0:
+        assistant, user = messages[index], messages[index - 1]
+        if assistant.role != "assistant" or user.role != "user":
+            index -= 1
+            continue
+        cost = message_tokens(user) + message_tokens(assistant)
+        if used + cost > budget:
+            selected.reverse()
+            return selected, True
+        used += cost
+        selected.extend((assistant, user))
+        index -= 2
+    selected.reverse()
+    return selected, False
+
+
+def to_model_messages(messages: List[ChatMessage], system_prompt: Optional[str] = None,
+                      summary: Optional[str] = None) -> List[ModelMessage]:
+    """
+    将按时间排序的聊天消息转换为PydanticAI的消息历史
+
+    只保留完整的问答轮次；传入的消息历史不为空时PydanticAI不会再添加系统提示符，
+    因此在开头补充当前的系统提示符，较早对话的摘要紧随其后。
+
+    Args:
+        messages: 最近的聊天消息
+        system_prompt: 本次请求使用的系统提示符
+        summary: 被压缩的较早对话的摘要
+
+    Returns:
+        PydanticAI消息列表
+    """
+    history: List[ModelMessage] = []
+    pending_user: Optional[ChatMessage] = None
+    for message in messages:
+        if message.role == "user":
+            pending_user = message
+        elif message.role == "assistant" and pending_user is not None:
+            history.extend(decode_turn(pending_user, message))
+            pending_user = None
+    prefix = []
+    if system_prompt:
+        prefix.append(SystemPromptPart(system_prompt))
+    if summary:
+        prefix.append(SystemPromptPart(f"以下是之前对话的摘要：\n{summary}"))
+    if (history or summary) and prefix:
+        history.insert(0, ModelRequest(parts=prefix))
+    return history
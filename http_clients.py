@@ -0,0 +1,128 @@
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+from urllib.parse import urlsplit
+import importlib.util
+import logging
+import os
+
+import httpx
+from mcp.client.sse import sse_client
+from pydantic_ai.mcp import MCPServerHTTP
+
+logger = logging.getLogger(__name__)
+
+# 每个上游（LLM接口、远程MCP服务器）共用一个连接池，以下参数对所有上游生效
+HTTP_MAX_CONNECTIONS = int(os.getenv("MCP_HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("MCP_HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("MCP_HTTP_KEEPALIVE_EXPIRY", "60"))
+# 启用HTTP/2需要安装h2（pip install httpx[http2]）
+HTTP2 = os.getenv("MCP_HTTP2", "false").lower() in ("1", "true", "yes")
+HTTP_CONNECT_TIMEOUT = float(os.getenv("MCP_HTTP_CONNECT_TIMEOUT", "10"))
+# 读超时需要覆盖模型生成最长回复的时间
+HTTP_READ_TIMEOUT = float(os.getenv("MCP_HTTP_READ_TIMEOUT", "600"))
+HTTP_WRITE_TIMEOUT = float(os.getenv("MCP_HTTP_WRITE_TIMEOUT", "30"))
+HTTP_POOL_TIMEOUT = float(os.getenv("MCP_HTTP_POOL_TIMEOUT", "30"))
+
+DEFAULT_LLM_BASE_URL = "https://api.openai.com/v1"
+
+
+def upstream_key(url: str) -> str:
+    """按scheme、主机和端口区分上游，同一主机上的多个路径共用连接池"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+class HTTPClientPool:
+    """
+    按上游复用的httpx.AsyncClient
+
+    客户端在进程内长期存在，不随Agent重启重建，
+    重启后新的Agent和MCP服务器继续使用已建立的keep-alive连接，避免重复的TCP/TLS握手。
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self.http2 = HTTP2
+        if self.http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("MCP_HTTP2已启用但未安装h2，使用HTTP/1.1（pip install httpx[http2]）")
+            self.http2 = False
+
+    def get(self, url: str) -> httpx.AsyncClient:
+        """
+        获取url所属上游的共享客户端，不存在时创建
+
+        Args:
+            url: 上游的任意URL
+
+        Returns:
+            共享的httpx.AsyncClient，调用方不能关闭它
+        """
+        key = upstream_key(url)
+        client = self._clients.get(key)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                http2=self.http2,
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(
+                    connect=HTTP_CONNECT_TIMEOUT,
+                    read=HTTP_READ_TIMEOUT,
+                    write=HTTP_WRITE_TIMEOUT,
+                    pool=HTTP_POOL_TIMEOUT
+                ),
+                follow_redirects=True
+            )
+            self._clients[key] = client
+            logger.info(f"为上游 {key} 创建HTTP连接池")
+        return client
+
+    def stats(self) -> Dict[str, Any]:
+        """连接池配置和已创建的上游"""
+        return {
+            "upstreams": sorted(self._clients),
+            "http2": self.http2,
+            "max_connections": HTTP_MAX_CONNECTIONS,
+            "max_keepalive_connections": HTTP_MAX_KEEPALIVE,
+        }
+
+    async def aclose(self):
+        """应用关闭时关闭全部客户端"""
+        clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            await client.aclose()
+
+
+class PooledMCPServerHTTP(MCPServerHTTP):
+    """
+    使用共享连接池的MCPServerHTTP，SSE长连接和消息POST都复用同一个客户端
+
+    需要mcp>=1.9.2（sse_client从这个版本开始接受httpx_client_factory）。
+    """
+
+    def __init__(self, url: str, client_pool: HTTPClientPool, **kwargs):
+        super().__init__(url=url, **kwargs)
+        self._client_pool = client_pool
+
+    @asynccontextmanager
+    async def client_streams(self) -> AsyncIterator:
+        if self.headers:
+            # 共享客户端不带服务器的自定义请求头，这类服务器仍为每次连接单独创建客户端
+            async with super().client_streams() as streams:
+                yield streams
+            return
+
+        client = self._client_pool.get(self.url)
+
+        @asynccontextmanager
+        async def borrow_client(headers: Optional[Dict[str, str]] = None, timeout=None, auth=None):
+            # sse_client会在退出时关闭客户端，这里只借出不关闭
+            yield client
+
+        async with sse_client(
+            url=self.url, timeout=self.timeout, sse_read_timeout=self.sse_read_timeout,
+            httpx_client_factory=borrow_client
+        ) as streams:
+            yield streams
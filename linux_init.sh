@@ -121,7 +121,7 @@ npx playwright install
 # 配置pip使用腾讯云镜像源并安装Python依赖
 print_yellow "正在安装Python依赖..."
 pip3 install -i https://pypi.tuna.tsinghua.edu.cn/simple pip -U
-pip3 install -i https://pypi.tuna.tsinghua.edu.cn/simple fastapi uvicorn python-dotenv pydantic-ai httpx
+pip3 install -i https://pypi.tuna.tsinghua.edu.cn/simple fastapi uvicorn python-dotenv pydantic-ai "mcp>=1.9.2" httpx
 pip3 install -i https://pypi.tuna.tsinghua.edu.cn/simple uvx
 # 添加uv
 print_yellow "正在配置uv..."
@@ -0,0 +1,99 @@
+from contextlib import AsyncExitStack
+from typing import Any, Dict, List, Sequence
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MCPServerPool:
+    """
+    同一个stdio MCP服务器的多个副本进程
+
+    单个stdio服务器只有一条管道，并发的工具调用会在上面排队。
+    连接池启动poolSize个相同的子进程，每次工具调用分配给进行中请求最少的副本。
+    对Agent而言它和单个MCP服务器一样：提供is_running、list_tools、call_tool和异步上下文管理。
+    """
+
+    def __init__(self, name: str, replicas: Sequence[Any]):
+        if not replicas:
+            raise ValueError("连接池至少需要一个副本")
+        self.name = name
+        self.replicas = list(replicas)
+        self.outstanding = [0] * len(self.replicas)
+        self.calls = [0] * len(self.replicas)
+        self.is_running = False
+        self._exit_stack: AsyncExitStack = None
+        # 进行中请求数相同时轮流选择，避免总是落在第一个副本上
+        self._rotation = itertools.count()
+
+    def __repr__(self) -> str:
+        return f"MCPServerPool(name={self.name!r}, size={len(self.replicas)})"
+
+    async def __aenter__(self) -> "MCPServerPool":
+        # 副本在同一个任务中依次进入，退出时也必须在该任务中按相反顺序退出
+        exit_stack = AsyncExitStack()
+        try:
+            for replica in self.replicas:
+                try:
+                    await exit_stack.enter_async_context(replica)
+                except BaseException:
+                    await self._close_partial(replica)
+                    raise
+        except BaseException:
+            await exit_stack.aclose()
+            raise
+        self._exit_stack = exit_stack
+        self.is_running = True
+        logger.info(f"MCP服务器 {self.name} 已启动{len(self.replicas)}个副本")
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.is_running = False
+        exit_stack, self._exit_stack = self._exit_stack, None
+        if exit_stack is not None:
+            await exit_stack.aclose()
+
+    async def _close_partial(self, replica: Any):
+        """pydantic-ai在初始化中途失败时不会关闭已启动的子进程，这里补充关闭"""
+        exit_stack = getattr(replica, "_exit_stack", None)
+        if exit_stack is None or getattr(replica, "is_running", False):
+            return
+        try:
+            await exit_stack.aclose()
+        except BaseException as e:
+            logger.debug(f"清理MCP服务器 {self.name} 的副本时出错(可以忽略): {str(e)}")
+
+    def _pick(self) -> int:
+        """选择进行中请求最少的可用副本"""
+        running = [i for i, replica in enumerate(self.replicas) if replica.is_running]
+        if not running:
+            raise RuntimeError(f"MCP服务器 {self.name} 没有可用的副本")
+        offset = next(self._rotation)
+        return min(
+            running,
+            key=lambda i: (self.outstanding[i], (i - offset) % len(self.replicas))
+        )
+
+    async def list_tools(self) -> List[Any]:
+        return await self.replicas[self._pick()].list_tools()
+
+    async def call_tool(self, tool_name: str, arguments: Dict[str, Any]) -> Any:
+        index = self._pick()
+        self.outstanding[index] += 1
+        self.calls[index] += 1
+        try:
+            return await self.replicas[index].call_tool(tool_name, arguments)
+        finally:
+            self.outstanding[index] -= 1
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """各副本的运行状态、进行中请求数和累计调用次数"""
+        return [
+            {
+                "running": bool(replica.is_running),
+                "outstanding": self.outstanding[i],
+                "calls": self.calls[i],
+            }
+            for i, replica in enumerate(self.replicas)
+        ]
@@ -0,0 +1,142 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import hashlib
+import json
+import os
+import time
+import unicodedata
+
+from pydantic import BaseModel
+from pydantic_ai.messages import ModelMessage, ModelMessagesTypeAdapter
+
+# 响应缓存的最大条目数，0表示不启用
+RESPONSE_CACHE_SIZE = int(os.getenv("MCP_RESPONSE_CACHE_SIZE", "0"))
+# 缓存的回答的有效期（秒）
+RESPONSE_CACHE_TTL = float(os.getenv("MCP_RESPONSE_CACHE_TTL", "600"))
+# 缓存占用的估算字节数上限
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("MCP_RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# 问题末尾可以忽略的标点和空白
+_TRAILING = "?!.,~。，、…　 "
+
+
+class CachedResponse(BaseModel):
+    """缓存的一轮回答"""
+    answer: str
+    # 本轮的PydanticAI消息（encode_turn的结果），命中时写入对话历史
+    model_messages: Optional[str] = None
+    usage: Optional[Dict[str, Any]] = None
+
+
+def normalize_query(query: str) -> str:
+    """统一全角半角、大小写和空白，去掉末尾的标点，只有这些差别的问题视为同一个问题"""
+    text = unicodedata.normalize("NFKC", query).casefold()
+    return " ".join(text.split()).rstrip(_TRAILING)
+
+
+def _strip_timestamps(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: _strip_timestamps(v) for k, v in value.items() if k != "timestamp"}
+    if isinstance(value, list):
+        return [_strip_timestamps(v) for v in value]
+    return value
+
+
+def history_fingerprint(history: List[ModelMessage]) -> str:
+    """消息历史的摘要值，忽略每次构建历史时都会变化的时间戳"""
+    if not history:
+        return ""
+    data = _strip_timestamps(ModelMessagesTypeAdapter.dump_python(history, mode="json"))
+    raw = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def response_key(query: str, system_prompt: Optional[str], history: List[ModelMessage],
+                 model_name: str, settings: Dict[str, Any], config_version: int) -> str:
+    """
+    响应缓存的键
+
+    由规范化后的问题、系统提示符、消息历史、模型和模型参数组成；
+    配置版本变化（工具可能变化）后之前的回答不再命中。
+    """
+    raw = json.dumps(
+        [normalize_query(query), system_prompt or "", history_fingerprint(history),
+         model_name, settings, config_version],
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    完全相同的问题的回答缓存
+
+    按TTL过期，并按条目数和估算字节数做LRU淘汰。
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL,
+                 max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # key -> (回答, 估算字节数, 过期时间)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: str) -> CachedResponse:
+        """
+        读取缓存的回答
+
+        Raises:
+            KeyError: 未命中或已过期
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            raise KeyError(key)
+        response, _, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            raise KeyError(key)
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def put(self, key: str, response: CachedResponse):
+        size = len(response.answer.encode("utf-8")) + len(response.model_messages or "")
+        if not self.enabled or size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (response, size, time.monotonic() + self.ttl)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,173 @@
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional
+from datetime import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 工作进程数，大于1时各进程通过SQLite共享状态
+WORKERS = int(os.getenv("MCP_WORKERS", "1"))
+SHARED_STATE_PATH = os.getenv("MCP_SHARED_STATE_PATH", "shared_state.db")
+# 工作进程检查配置版本的间隔（秒）
+CONFIG_POLL_INTERVAL = float(os.getenv("MCP_CONFIG_POLL_INTERVAL", "1.0"))
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"无法序列化类型: {type(value).__name__}")
+
+
+class SharedState(ABC):
+    """进程间共享的键值状态，值为可JSON序列化的对象"""
+
+    @abstractmethod
+    def get(self, key: str, default: Any = None) -> Any:
+        """读取键值，不存在时返回default"""
+
+    @abstractmethod
+    def set(self, key: str, value: Any) -> None:
+        """写入键值"""
+
+    @abstractmethod
+    def set_if(self, key: str, value: Any, field: str, expected: Any) -> bool:
+        """
+        仅当当前值的field字段等于expected时写入
+
+        Returns:
+            是否写入成功
+        """
+
+    @abstractmethod
+    def incr(self, key: str) -> int:
+        """原子地将整数值加1并返回新值"""
+
+    @abstractmethod
+    def get_prefix(self, prefix: str) -> Dict[str, Any]:
+        """读取所有以prefix开头的键值"""
+
+    def close(self) -> None:
+        """释放资源"""
+
+
+class MemorySharedState(SharedState):
+    """单进程内的共享状态"""
+
+    def __init__(self):
+        self._data: Dict[str, Any] = {}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._data.get(key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        self._data[key] = value
+
+    def set_if(self, key: str, value: Any, field: str, expected: Any) -> bool:
+        current = self._data.get(key) or {}
+        if current.get(field) != expected:
+            return False
+        self._data[key] = value
+        return True
+
+    def incr(self, key: str) -> int:
+        self._data[key] = self._data.get(key, 0) + 1
+        return self._data[key]
+
+    def get_prefix(self, prefix: str) -> Dict[str, Any]:
+        return {k: v for k, v in self._data.items() if k.startswith(prefix)}
+
+
+class SQLiteSharedState(SharedState):
+    """
+    基于本地SQLite文件的共享状态，供同一主机上的多个工作进程使用
+
+    读改写操作使用BEGIN IMMEDIATE事务，保证多进程并发时的原子性。
+    """
+
+    def __init__(self, db_path: str = SHARED_STATE_PATH):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS shared_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def _read(self, key: str) -> Optional[Any]:
+        row = self._conn.execute(
+            "SELECT value FROM shared_state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, key: str, value: Any) -> None:
+        self._conn.execute(
+            "INSERT INTO shared_state (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, json.dumps(value, ensure_ascii=False, default=_json_default))
+        )
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            value = self._read(key)
+        return default if value is None else value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._write(key, value)
+
+    def set_if(self, key: str, value: Any, field: str, expected: Any) -> bool:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                current = self._read(key) or {}
+                matched = current.get(field) == expected
+                if matched:
+                    self._write(key, value)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return matched
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                value = (self._read(key) or 0) + 1
+                self._write(key, value)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return value
+
+    def get_prefix(self, prefix: str) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value FROM shared_state WHERE substr(key, 1, ?) = ?",
+                (len(prefix), prefix)
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def create_shared_state(workers: int = WORKERS) -> SharedState:
+    """
+    根据工作进程数创建共享状态
+
+    Args:
+        workers: 工作进程数
+
+    Returns:
+        单进程时返回内存实现，多进程时返回SQLite实现
+    """
+    if workers > 1:
+        logger.info(f"多进程模式({workers}个工作进程)，共享状态保存在: {SHARED_STATE_PATH}")
+        return SQLiteSharedState(SHARED_STATE_PATH)
+    return MemorySharedState()
@@ -7,6 +7,9 @@ const CONVERSATIONS_API_ENDPOINT = '/api/conversations';
 // 全局变量
 let currentConversationId = null;
 let conversations = [];
+let conversationsCursor = null; // 对话列表下一页游标
+let isLoadingConversations = false;
+const CONVERSATIONS_PAGE_SIZE = 50;
 let isProcessing = false;
 let chatMessages = null;
 let userInput = null;
@@ -15,6 +18,7 @@ let isWaitingForResponse = false;
 let sendButton = null;
 let historyTurnsSelect = null;
 let currentStreamController = null; // 添加AbortController跟踪当前流式请求
+let currentRunId = null; // 当前流式请求在服务端的运行ID，用于停止生成
 
 // 更新Markdown内容
 function updateMarkdownContent(element, content) {
@@ -91,14 +95,15 @@ function scrollToBottom() {
     }
 }
 
-// 加载对话列表
+// 加载对话列表（第一页）
 async function fetchConversations() {
     try {
-        const response = await fetch(CONVERSATIONS_API_ENDPOINT);
+        const response = await fetch(`${CONVERSATIONS_API_ENDPOINT}?limit=${CONVERSATIONS_PAGE_SIZE}`);
         if (!response.ok) throw new Error(`服务器错误: ${response.status}`);
 
         const data = await response.json();
         conversations = data.conversations || [];
+        conversationsCursor = data.next_cursor || null;
 
         updateConversationsList();
         return data;
@@ -113,6 +118,30 @@ async function fetchConversations() {
     }
 }
 
+// 加载下一页对话列表
+async function loadMoreConversations() {
+    if (!conversationsCursor || isLoadingConversations) return;
+
+    isLoadingConversations = true;
+    try {
+        const params = new URLSearchParams({ limit: CONVERSATIONS_PAGE_SIZE, cursor: conversationsCursor });
+        const response = await fetch(`${CONVERSATIONS_API_ENDPOINT}?${params}`);
+        if (!response.ok) throw new Error(`服务器错误: ${response.status}`);
+
+        const data = await response.json();
+        // 翻页期间对话可能被更新到顶部，按ID去重
+        const knownIds = new Set(conversations.map(c => c.id));
+        conversations = conversations.concat((data.conversations || []).filter(c => !knownIds.has(c.id)));
+        conversationsCursor = data.next_cursor || null;
+
+        updateConversationsList();
+    } catch (error) {
+        console.error('加载更多对话失败:', error);
+    } finally {
+        isLoadingConversations = false;
+    }
+}
+
 // 渲染对话列表
 function updateConversationsList() {
     const conversationsList = document.getElementById('conversations-list');
@@ -175,14 +204,23 @@ function updateConversationsList() {
     });
 }
 
+// 取消当前的流式请求，并通知服务端停止生成（仅断开连接时服务端会保留运行一段时间以便续传）
+function abortCurrentStream() {
+    if (currentStreamController) {
+        currentStreamController.abort();
+        currentStreamController = null;
+    }
+    if (currentRunId) {
+        fetch(`${STREAM_API_ENDPOINT}/${currentRunId}/cancel`, { method: 'POST' }).catch(() => {});
+        currentRunId = null;
+    }
+}
+
 // 打开指定对话
 async function openConversation(conversationId) {
     try {
         // 如果当前有进行中的流式请求，取消它
-        if (currentStreamController) {
-            currentStreamController.abort();
-            currentStreamController = null;
-        }
+        abortCurrentStream();
 
         currentConversationId = conversationId;
 
@@ -389,6 +427,16 @@ document.addEventListener('DOMContentLoaded', async () => {
         confirmYesButton.addEventListener('click', handleConfirmAction);
     }
 
+    // 对话列表滚动到底部时加载下一页
+    const sidebarContent = document.querySelector('.sidebar-content');
+    if (sidebarContent) {
+        sidebarContent.addEventListener('scroll', () => {
+            if (sidebarContent.scrollTop + sidebarContent.clientHeight >= sidebarContent.scrollHeight - 50) {
+                loadMoreConversations();
+            }
+        });
+    }
+
     try {
         // 加载对话历史
         await fetchConversations();
@@ -452,10 +500,7 @@ async function handleSendMessage() {
         const historyTurns = historyTurnsSelect ? parseInt(historyTurnsSelect.value) : 5;
 
         // 如果当前有进行中的流式请求，取消它
-        if (currentStreamController) {
-            currentStreamController.abort();
-            currentStreamController = null;
-        }
+        abortCurrentStream();
 
         // 根据流式开关设置使用不同处理方式
         if (isStreaming) {
@@ -652,8 +697,8 @@ function createToolCard(toolName, args, toolCallId) {
         }
     }
 
-    // 更新工具结果方法
-    function updateResult(resultData) {
+    // 更新工具结果方法，truncatedInfo为被截断的结果的{result_id, size}
+    function updateResult(resultData, truncatedInfo) {
         try {
             let resultStr;
             if (typeof resultData === 'string') {
@@ -697,6 +742,16 @@ function createToolCard(toolName, args, toolCallId) {
                 });
                 resultSection.appendChild(copyBtn);
             }
+
+            // 结果被截断时只显示预览，提供完整结果的链接
+            if (truncatedInfo) {
+                const fullLink = document.createElement('a');
+                fullLink.className = 'full-result-link';
+                fullLink.href = `/api/tool-results/${encodeURIComponent(truncatedInfo.result_id)}`;
+                fullLink.target = '_blank';
+                fullLink.textContent = `查看完整结果（${truncatedInfo.size}个字符）`;
+                resultSection.appendChild(fullLink);
+            }
         } catch (err) {
             resultSection.innerHTML = DOMPurify.sanitize('<b>返回结果：</b><pre>无法解析结果数据</pre>');
             console.error('解析工具结果失败:', err);
@@ -743,9 +798,9 @@ function createToolCardManager() {
         },
 
         // 更新卡片结果
-        updateCardResult(toolCallId, result) {
+        updateCardResult(toolCallId, result, truncatedInfo) {
             if (cards[toolCallId]) {
-                cards[toolCallId].updateResult(result);
+                cards[toolCallId].updateResult(result, truncatedInfo);
             } else {
                 console.warn(`尝试更新不存在的工具卡片: ${toolCallId}`);
             }
@@ -864,6 +919,12 @@ async function handleStreamRequest(query, historyTurns) {
                 try {
                     const data = JSON.parse(line);
 
+                    // 记录运行ID，停止生成时使用
+                    if (data.type === 'start') {
+                        currentRunId = data.run_id || null;
+                        continue;
+                    }
+
                     // 处理工具调用事件
                     if (data.type === 'tool_call') {
                         const { tool_name, args, tool_call_id } = data;
@@ -874,7 +935,8 @@ async function handleStreamRequest(query, historyTurns) {
                     // 处理工具结果事件
                     if (data.type === 'tool_result') {
                         const { tool_call_id, result } = data;
-                        toolCardManager.updateCardResult(tool_call_id, result);
+                        const truncatedInfo = data.truncated ? { result_id: data.result_id, size: data.size } : null;
+                        toolCardManager.updateCardResult(tool_call_id, result, truncatedInfo);
                         continue;
                     }
 
@@ -897,6 +959,11 @@ async function handleStreamRequest(query, historyTurns) {
                         // 最终内容直接更新到当前消息，不创建新消息
                         updateMarkdownContent(mdContainer, buffer);
                     }
+                    else if (data.type === 'error' && data.reason === 'deadline') {
+                        // 超过截止时间：保留已生成的部分回答并附上说明
+                        buffer += `\n\n> ⚠️ ${data.error || '请求超过截止时间'}，以上为部分结果`;
+                        updateStreamingContent(mdContainer, buffer);
+                    }
                     else if (data.type === 'error') {
                         stopCursorBlink();
                         if (mdContainer.contains(cursorElement)) {
@@ -912,6 +979,9 @@ async function handleStreamRequest(query, historyTurns) {
             }
         }
 
+        // 运行已经结束，不再需要取消
+        currentRunId = null;
+
         // 确保最终内容已显示并移除光标
         if (!hasFinalContent) {
             stopCursorBlink();
@@ -0,0 +1,520 @@
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Set
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+from tokenizer import count_tokens
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 相同的请求（响应缓存键相同）在生成过程中到达时订阅同一个运行，不重复调用模型和工具
+COALESCE_REQUESTS = os.getenv("MCP_COALESCE_REQUESTS", "false").lower() in ("1", "true", "yes")
+# 合并连续content事件的时间窗口（毫秒），0表示每个事件单独发送
+STREAM_BATCH_WINDOW_MS = float(os.getenv("MCP_STREAM_BATCH_WINDOW_MS", "0"))
+# 合并的文本达到该字节数时立即发送
+STREAM_BATCH_MAX_BYTES = int(os.getenv("MCP_STREAM_BATCH_MAX_BYTES", "4096"))
+# 每个运行保留的最近事件数（环形缓冲区），用于中途加入的订阅者和断线续传
+STREAM_BUFFER_EVENTS = int(os.getenv("MCP_STREAM_BUFFER_EVENTS", "4096"))
+# 运行结束后保留事件的时间（秒），期间仍可续传
+STREAM_RETENTION = float(os.getenv("MCP_STREAM_RETENTION", "60"))
+# 流式请求的客户端断开后等待续传的时间（秒），期间没有订阅者回来才取消运行，0表示立即取消
+STREAM_RESUME_GRACE = float(os.getenv("MCP_STREAM_RESUME_GRACE", "10"))
+# 一次运行中同时进行的工具调用数上限，0表示不限制；运行中的步骤依次执行，即每个步骤的并发上限
+TOOL_STEP_CONCURRENCY = int(os.getenv("MCP_TOOL_STEP_CONCURRENCY", "0"))
+# 请求的默认截止时间和允许请求设置的最长截止时间（秒，从收到请求开始计算），0表示不限制；
+# 默认值为0时没有设置deadline的请求不限制时间，请求自己设置的deadline仍不超过最长截止时间
+REQUEST_DEADLINE = float(os.getenv("MCP_REQUEST_DEADLINE", "300"))
+REQUEST_DEADLINE_MAX = float(os.getenv("MCP_REQUEST_DEADLINE_MAX", "900"))
+
+# 超过截止时间时error事件和504响应中的说明
+DEADLINE_ERROR = "请求超过截止时间"
+
+
+# 当前正在执行的运行；工具调用任务由PydanticAI在运行的上下文中创建，可以据此登记到运行上
+current_run: ContextVar[Optional["StreamRun"]] = ContextVar("current_run", default=None)
+
+
+def request_deadline(seconds: Optional[float] = None) -> Optional[float]:
+    """
+    根据请求指定的秒数计算截止时间
+
+    Args:
+        seconds: 请求指定的秒数，超过REQUEST_DEADLINE_MAX时按最大值计算；None时使用REQUEST_DEADLINE
+
+    Returns:
+        截止时间（time.monotonic()的值），不限制时返回None
+    """
+    if seconds is None:
+        if REQUEST_DEADLINE <= 0:
+            return None
+        seconds = REQUEST_DEADLINE
+    if REQUEST_DEADLINE_MAX > 0:
+        seconds = min(seconds, REQUEST_DEADLINE_MAX)
+    return time.monotonic() + seconds if seconds > 0 else None
+
+
+def time_remaining(deadline: Optional[float]) -> Optional[float]:
+    """距截止时间的秒数，没有截止时间时返回None，已经过期时返回0"""
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0.0)
+
+
+async def read_until(chunks: AsyncIterator[bytes], deadline: Optional[float]) -> AsyncIterator[bytes]:
+    """
+    转发chunks直到截止时间
+
+    Raises:
+        asyncio.TimeoutError: 到达截止时间时chunks尚未结束
+    """
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), time_remaining(deadline))
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        await chunks.aclose()
+
+
+def encoder_name() -> str:
+    """当前使用的JSON编码器，用于监控"""
+    return "orjson" if orjson is not None else "json"
+
+
+def encode_event(event: Dict[str, Any]) -> bytes:
+    """
+    编码为一行NDJSON，安装了orjson时使用orjson
+
+    工具结果等内容中无法直接序列化的对象转换为字符串，避免单个事件中断整个响应。
+    """
+    if orjson is not None:
+        return orjson.dumps(event, default=str) + b"\n"
+    return (json.dumps(event, default=str) + "\n").encode("utf-8")
+
+
+class StreamRun:
+    """
+    一次实际执行的Agent运行及其产生的流式事件
+
+    运行在独立的任务中执行，与发起请求的连接解耦。每个事件带有递增的序号seq，最近的事件保存在
+    有界的环形缓冲区中，订阅者可以从任意仍在缓冲区中的序号开始读取（中途加入或断线续传）。
+    所有订阅者都离开后（流式请求断开时等待一段时间供续传）或通过run_id显式取消时运行被取消，
+    模型的流式响应随之关闭，进行中的工具调用也一并取消。
+    事件以字典保存，由各订阅者按自己的发送方式合并和编码。
+    """
+
+    def __init__(self, key: Optional[str] = None, buffer_size: Optional[int] = STREAM_BUFFER_EVENTS,
+                 tool_concurrency: int = TOOL_STEP_CONCURRENCY, deadline: Optional[float] = None):
+        self.key = key
+        # 截止时间（time.monotonic()的值），到期时取消运行，包括进行中的模型请求和工具调用
+        self.deadline = deadline
+        self.run_id = uuid.uuid4().hex
+        self.events: Deque[Dict[str, Any]] = deque(maxlen=buffer_size)
+        # 下一个事件的序号，即已发布的事件总数
+        self.next_seq = 0
+        # 回答文本按片段累积，读取时才拼接
+        self._chunks: List[str] = []
+        self._answer: Optional[str] = ""
+        # 正常完成时本轮的结果
+        self.model_messages: Optional[str] = None
+        self.usage: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.done = False
+        self.cancelled = False
+        # 取消的原因：disconnect（订阅者全部断开）、superseded（被同一对话的新请求取消）、
+        # request（显式取消）、deadline（超过截止时间）或shutdown（服务关闭）
+        self.cancel_reason: Optional[str] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        # 进行中的工具调用任务，运行被取消时一并取消
+        self.tool_tasks: Set[asyncio.Task] = set()
+        self.cancelled_tool_calls = 0
+        self.tool_slots: Optional[asyncio.Semaphore] = \
+            asyncio.Semaphore(tool_concurrency) if tool_concurrency > 0 else None
+        self._changed = asyncio.Event()
+        self._grace: Optional[asyncio.TimerHandle] = None
+        self._deadline_timer: Optional[asyncio.TimerHandle] = None
+        self._started = False
+        self._done_callbacks: List[Callable[["StreamRun"], None]] = []
+
+    @property
+    def first_seq(self) -> int:
+        """缓冲区中最早的事件的序号"""
+        return self.next_seq - len(self.events)
+
+    @property
+    def answer(self) -> str:
+        """已生成的回答文本"""
+        if self._answer is None:
+            self._answer = "".join(self._chunks)
+            self._chunks = [self._answer]
+        return self._answer
+
+    @answer.setter
+    def answer(self, text: str):
+        self._chunks = [text]
+        self._answer = text
+
+    def append_text(self, text: str):
+        self._chunks.append(text)
+        self._answer = None
+
+    def _notify(self):
+        # 唤醒所有正在等待的订阅者，之后的等待使用新的Event
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, event: Dict[str, Any]):
+        event["seq"] = self.next_seq
+        self.next_seq += 1
+        self.events.append(event)
+        self._notify()
+
+    def start(self, events: AsyncIterator[Dict[str, Any]], on_finish: Callable[["StreamRun"], None]):
+        """
+        在后台任务中消费events并发布其中的每个事件
+
+        Args:
+            events: 生成流式事件的异步生成器
+            on_finish: 运行结束（完成、失败或被取消）后调用，用于释放资源
+        """
+        self.task = asyncio.create_task(self._drive(events, on_finish))
+        if self.deadline is not None:
+            self._deadline_timer = asyncio.get_running_loop().call_later(
+                max(self.deadline - time.monotonic(), 0), self.cancel, "deadline")
+
+    async def _drive(self, events: AsyncIterator[Dict[str, Any]], on_finish: Callable[["StreamRun"], None]):
+        current_run.set(self)
+        self._started = True
+        try:
+            if self.cancelled:
+                raise asyncio.CancelledError()
+            async for event in events:
+                self.publish(event)
+        except asyncio.CancelledError:
+            if not self.cancelled:
+                # 不是通过cancel()取消的，例如服务关闭时事件循环取消了所有任务
+                self.cancelled = True
+                self.cancel_reason = "shutdown"
+            logger.info("运行 %s 已取消（%s）", self.run_id, self.cancel_reason)
+            if self.cancel_reason == "deadline":
+                # 已发送的文本和工具结果即为部分结果，回答仍会写入对话历史
+                self.publish({"type": "error", "reason": "deadline", "error": DEADLINE_ERROR})
+            else:
+                self.publish({"type": "cancelled", "reason": self.cancel_reason})
+        finally:
+            await events.aclose()
+            # PydanticAI并行执行工具调用，步骤被取消时不会取消尚未完成的调用
+            for task in self.tool_tasks:
+                task.cancel()
+                self.cancelled_tool_calls += 1
+            self.done = True
+            self._notify()
+            if self._grace is not None:
+                self._grace.cancel()
+            if self._deadline_timer is not None:
+                self._deadline_timer.cancel()
+            for callback in [on_finish] + self._done_callbacks:
+                try:
+                    callback(self)
+                except Exception as e:
+                    logger.error(f"运行结束后的清理出错: {str(e)}")
+
+    def outlives(self, deadline: Optional[float]) -> bool:
+        """
+        运行是否可能在deadline之后才结束
+
+        合并的请求各有自己的截止时间，运行只按开始它的请求的截止时间取消；
+        返回True时订阅者需要自己在deadline停止等待。
+        """
+        return deadline is not None and (self.deadline is None or self.deadline > deadline)
+
+    def when_done(self, callback: Callable[["StreamRun"], None]):
+        """运行结束后调用callback，已经结束时立即调用"""
+        if self.done:
+            callback(self)
+        else:
+            self._done_callbacks.append(callback)
+
+    def attach(self):
+        self.subscribers += 1
+        if self._grace is not None:
+            self._grace.cancel()
+            self._grace = None
+
+    def detach(self, reason: str = "disconnect", grace: float = 0.0):
+        """
+        订阅者离开，最后一个订阅者在运行结束前离开时取消运行
+
+        Args:
+            reason: 取消的原因
+            grace: 大于0时等待这么多秒，期间有订阅者加入（续传）则不取消
+        """
+        self.subscribers -= 1
+        if self.subscribers > 0 or self.done:
+            return
+        if grace > 0:
+            self._grace = asyncio.get_running_loop().call_later(grace, self.cancel, reason)
+        else:
+            self.cancel(reason)
+
+    def cancel(self, reason: str) -> bool:
+        """
+        取消运行，不论还有多少订阅者
+
+        Returns:
+            运行是否被本次调用取消（已经结束或已被取消时返回False）
+        """
+        if self.done or self.cancelled or self.task is None:
+            return False
+        self.cancelled = True
+        self.cancel_reason = reason
+        if self._started:
+            self.task.cancel()
+        # 任务还没开始执行时取消会跳过_drive中的清理（on_finish不会被调用），由_drive开始时检查cancelled
+        return True
+
+    async def read(self, start: int = 0, window: float = STREAM_BATCH_WINDOW_MS / 1000,
+                   max_bytes: int = STREAM_BATCH_MAX_BYTES) -> AsyncIterator[bytes]:
+        """
+        从序号start开始读取并编码为NDJSON，直到运行结束
+
+        window大于0时，第一个content事件之后window秒内到达的content事件合并为一个（带最后一个的序号），
+        合并的文本达到max_bytes时提前发送；其他事件到达时连同已合并的文本立即发送，
+        已经积压的多个事件合并为一次写入。要读取的事件已被环形缓冲区淘汰时先发送gap事件，
+        从最早的可用事件继续。
+
+        Args:
+            start: 第一个要读取的事件序号
+            window: 合并content事件的时间窗口（秒）
+            max_bytes: 合并的文本的字节数上限
+        """
+        loop = asyncio.get_running_loop()
+        seq = start
+        while True:
+            while seq >= self.next_seq:
+                if self.done:
+                    return
+                await self._changed.wait()
+
+            if window <= 0:
+                if seq < self.first_seq:
+                    yield encode_event({"type": "gap", "from": seq, "to": self.first_seq})
+                    seq = self.first_seq
+                yield encode_event(self.events[seq - self.first_seq])
+                seq += 1
+                continue
+
+            out: List[bytes] = []
+            text: List[str] = []
+            text_bytes = 0
+            deadline = None
+            while True:
+                if seq < self.first_seq:
+                    if text:
+                        out.append(encode_event({"type": "content", "content": "".join(text), "seq": seq - 1}))
+                        text, text_bytes = [], 0
+                    out.append(encode_event({"type": "gap", "from": seq, "to": self.first_seq}))
+                    seq = self.first_seq
+                while seq < self.next_seq:
+                    event = self.events[seq - self.first_seq]
+                    seq += 1
+                    if event["type"] == "content":
+                        text.append(event["content"])
+                        text_bytes += len(event["content"].encode("utf-8"))
+                        if deadline is None:
+                            deadline = loop.time() + window
+                        if text_bytes >= max_bytes:
+                            out.append(encode_event({"type": "content", "content": "".join(text), "seq": seq - 1}))
+                            text, text_bytes = [], 0
+                    else:
+                        if text:
+                            out.append(encode_event({"type": "content", "content": "".join(text), "seq": seq - 2}))
+                            text, text_bytes = [], 0
+                        out.append(encode_event(event))
+                remaining = deadline - loop.time() if deadline is not None else 0
+                if out or not text or remaining <= 0 or self.done:
+                    break
+                try:
+                    await asyncio.wait_for(self._changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            if text:
+                out.append(encode_event({"type": "content", "content": "".join(text), "seq": seq - 1}))
+            yield b"".join(out)
+
+    async def wait(self):
+        """等待运行结束"""
+        while not self.done:
+            await self._changed.wait()
+
+
+class Subscription:
+    """
+    一个请求对运行的订阅
+
+    通过ASGI的receive通道监听客户端断开，断开后立即离开运行，不等下一次写入失败才发现；
+    最后一个订阅者离开时运行被取消，因断开离开时先等待grace秒供客户端续传。
+    """
+
+    def __init__(self, run: StreamRun, grace: float = 0.0):
+        self.run = run
+        self.grace = grace
+        self.active = True
+        self._watcher: Optional[asyncio.Task] = None
+        run.attach()
+
+    def watch(self, receive: Callable[[], Awaitable[Dict[str, Any]]]):
+        """在后台等待http.disconnect消息"""
+        self._watcher = asyncio.create_task(self._watch(receive))
+
+    async def _watch(self, receive: Callable[[], Awaitable[Dict[str, Any]]]):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+        if self.active and not self.run.done:
+            logger.info("客户端已断开，离开运行 %s", self.run.run_id)
+        self.close()
+
+    def close(self, reason: str = "disconnect"):
+        """离开运行，重复调用无效"""
+        if self._watcher is not None and self._watcher is not asyncio.current_task():
+            self._watcher.cancel()
+        if self.active:
+            self.active = False
+            self.run.detach(reason, self.grace if reason == "disconnect" else 0.0)
+
+
+class TrackedMCPServer:
+    """
+    把工具调用登记到当前运行上，其余属性转发给被包装的服务器
+
+    PydanticAI把模型一次返回的多个工具调用作为并行的任务执行（可以跨多个服务器），结果按完成顺序返回；
+    这里按MCP_TOOL_STEP_CONCURRENCY限制同一运行同时进行的调用数，运行被取消时进行中的调用一并取消。
+    """
+
+    def __init__(self, server: Any):
+        self.server = server
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.server, name)
+
+    def __repr__(self) -> str:
+        return f"TrackedMCPServer({self.server!r})"
+
+    async def call_tool(self, tool_name: str, arguments: Dict[str, Any]) -> Any:
+        run = current_run.get()
+        task = asyncio.current_task()
+        if run is None or task is None:
+            return await self.server.call_tool(tool_name, arguments)
+        run.tool_tasks.add(task)
+        try:
+            if run.tool_slots is None:
+                return await self.server.call_tool(tool_name, arguments)
+            async with run.tool_slots:
+                return await self.server.call_tool(tool_name, arguments)
+        finally:
+            run.tool_tasks.discard(task)
+
+
+class StreamRunRegistry:
+    """
+    登记进行中的运行
+
+    按run_id查找运行（用于续传和显式取消），运行结束后保留retention秒再淘汰；
+    按响应缓存键合并相同的请求（single-flight），并统计取消的运行节省的token。
+    """
+
+    def __init__(self, enabled: bool = COALESCE_REQUESTS, retention: float = STREAM_RETENTION):
+        self.enabled = enabled
+        self.retention = retention
+        self._inflight: Dict[str, StreamRun] = {}
+        self._runs: Dict[str, StreamRun] = {}
+        self.started = 0
+        self.coalesced = 0
+        self.resumed = 0
+        self.cancelled: Dict[str, int] = {}
+        self.cancelled_tool_calls = 0
+        # 取消前已经生成的token数，以及按完成的运行的平均回答长度估算的节省token数
+        self.tokens_generated_before_cancel = 0
+        self.tokens_saved = 0
+        self._completed = 0
+        self._completed_tokens = 0
+
+    def join(self, key: Optional[str]) -> Optional[StreamRun]:
+        """返回相同请求进行中的运行，没有时返回None"""
+        if not self.enabled or key is None:
+            return None
+        run = self._inflight.get(key)
+        # 缓冲区已经淘汰过事件的运行无法提供完整的事件流
+        if run is None or run.done or run.cancelled or run.first_seq > 0:
+            return None
+        self.coalesced += 1
+        return run
+
+    def get(self, run_id: str) -> Optional[StreamRun]:
+        """按run_id查找进行中或刚结束（仍在保留期内）的运行"""
+        return self._runs.get(run_id)
+
+    def resume(self, run_id: str) -> Optional[StreamRun]:
+        """查找要续传的运行，找到时计入续传次数"""
+        run = self._runs.get(run_id)
+        if run is not None:
+            self.resumed += 1
+        return run
+
+    def add(self, run: StreamRun):
+        self.started += 1
+        self._runs[run.run_id] = run
+        if self.enabled and run.key is not None:
+            self._inflight[run.key] = run
+
+    def finish(self, run: StreamRun):
+        if self.retention > 0:
+            asyncio.get_running_loop().call_later(self.retention, self._runs.pop, run.run_id, None)
+        else:
+            self._runs.pop(run.run_id, None)
+        if run.key is not None and self._inflight.get(run.key) is run:
+            del self._inflight[run.key]
+
+        if run.cancelled:
+            self.cancelled[run.cancel_reason] = self.cancelled.get(run.cancel_reason, 0) + 1
+            self.cancelled_tool_calls += run.cancelled_tool_calls
+            generated = count_tokens(run.answer)
+            self.tokens_generated_before_cancel += generated
+            if self._completed:
+                self.tokens_saved += max(self._completed_tokens // self._completed - generated, 0)
+        elif run.usage and run.usage.get("response_tokens"):
+            self._completed += 1
+            self._completed_tokens += run.usage["response_tokens"]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "coalescing": self.enabled,
+            "in_flight": len(self._inflight),
+            "running": sum(1 for run in self._runs.values() if not run.done),
+            "retained": sum(1 for run in self._runs.values() if run.done),
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "resumed": self.resumed,
+            "cancelled": dict(self.cancelled),
+            "cancelled_tool_calls": self.cancelled_tool_calls,
+            "tokens_generated_before_cancel": self.tokens_generated_before_cancel,
+            "tokens_saved_estimate": self.tokens_saved,
+            "encoder": encoder_name(),
+            "batch_window_ms": STREAM_BATCH_WINDOW_MS,
+            "tool_step_concurrency": TOOL_STEP_CONCURRENCY,
+        }
@@ -0,0 +1,146 @@
+from typing import Any, Dict, List, Optional
+import asyncio
+import logging
+import os
+
+from pydantic_ai import Agent
+
+from conversation_store import ChatMessage, ConversationStore, HistorySummary
+from history import message_tokens
+from tokenizer import MESSAGE_OVERHEAD_TOKENS, count_tokens
+
+logger = logging.getLogger(__name__)
+
+# 对话中未被摘要的部分（加上已有摘要）超过该token数时在后台压缩较早的轮次，0表示不压缩
+SUMMARY_TOKEN_THRESHOLD = int(os.getenv("MCP_SUMMARY_TOKEN_THRESHOLD", "0"))
+# 压缩时保留原文的最近轮数
+SUMMARY_KEEP_TURNS = int(os.getenv("MCP_SUMMARY_KEEP_TURNS", "4"))
+# 生成摘要的最大token数
+SUMMARY_MAX_TOKENS = int(os.getenv("MCP_SUMMARY_MAX_TOKENS", "512"))
+
+# 每条消息放入摘要提示词的最大字符数
+SUMMARY_MESSAGE_CHARS = 2000
+
+SUMMARY_PROMPT = """你负责压缩对话历史。请根据已有的摘要和新增的对话写出一份更新后的摘要：
+保留用户的目标和偏好、已经确认的事实、工具查询得到的关键结果以及尚未解决的问题，省略寒暄和重复的内容。
+只输出摘要本身，不要添加任何说明。"""
+
+
+def _clip(text: str) -> str:
+    if len(text) <= SUMMARY_MESSAGE_CHARS:
+        return text
+    return text[:SUMMARY_MESSAGE_CHARS] + "……"
+
+
+class ConversationSummarizer:
+    """
+    对话历史的滚动摘要
+
+    每轮对话写入后在后台检查对话长度，超过阈值时用配置的模型把较早的轮次
+    （连同已有的摘要）压缩成一条摘要并保存，之后构建历史时用摘要代替这些轮次。
+    压缩不在请求路径上执行，不影响用户请求的延迟；模型可以替换为任意PydanticAI模型。
+    """
+
+    def __init__(self, store: ConversationStore, threshold: int = SUMMARY_TOKEN_THRESHOLD,
+                 keep_turns: int = SUMMARY_KEEP_TURNS, max_tokens: int = SUMMARY_MAX_TOKENS):
+        self.store = store
+        self.threshold = threshold
+        self.keep_turns = keep_turns
+        self.max_tokens = max_tokens
+        # 生成摘要使用的模型，由Agent运行时创建后设置
+        self.model: Any = None
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.compactions = 0
+        self.failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0 and self.model is not None
+
+    def schedule(self, conversation_id: str):
+        """在后台检查并压缩对话，同一对话同一时间只有一个压缩任务"""
+        if not self.enabled or conversation_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(conversation_id))
+        self._tasks[conversation_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(conversation_id, None))
+
+    async def _run(self, conversation_id: str):
+        try:
+            await self.compact(conversation_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"压缩对话 {conversation_id} 的历史失败: {str(e)}")
+
+    async def compact(self, conversation_id: str) -> Optional[HistorySummary]:
+        """
+        对话超过阈值时把保留轮次之前的消息压缩进摘要
+
+        Returns:
+            新保存的摘要；未超过阈值、没有可压缩的轮次或压缩期间对话有新消息时返回None
+        """
+        conversation = self.store.get_summary(conversation_id)
+        if conversation is None:
+            return None
+        previous = self.store.get_history_summary(conversation_id)
+        covered = previous.covered if previous else 0
+        messages = self.store.get_recent_messages(conversation_id, conversation.message_count - covered)
+        # 消息只追加不修改，条数不变说明读到的正好是摘要之后的全部消息
+        current = self.store.get_summary(conversation_id)
+        if current is None or current.message_count != conversation.message_count:
+            return None
+
+        total = (previous.tokens if previous else 0) + sum(message_tokens(m) for m in messages)
+        if total < self.threshold:
+            return None
+
+        # 保留最近的轮次原文，切分点落在用户消息上，保证剩余部分从完整的轮次开始
+        cut = len(messages) - self.keep_turns * 2
+        while cut > 0 and messages[cut].role != "user":
+            cut -= 1
+        if cut <= 0:
+            return None
+
+        content = await self._summarize(previous, messages[:cut])
+        summary = HistorySummary(
+            content=content,
+            covered=covered + cut,
+            tokens=count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        )
+        self.store.save_history_summary(conversation_id, summary)
+        self.compactions += 1
+        logger.info(f"对话 {conversation_id} 的前{summary.covered}条消息已压缩为{summary.tokens}个token的摘要")
+        return summary
+
+    async def _summarize(self, previous: Optional[HistorySummary], messages: List[ChatMessage]) -> str:
+        sections = []
+        if previous:
+            sections.append(f"已有的摘要：\n{previous.content}")
+        lines = [f"{'用户' if m.role == 'user' else '助手'}：{_clip(m.content)}" for m in messages]
+        sections.append("新增的对话：\n" + "\n".join(lines))
+
+        agent = Agent(self.model, system_prompt=SUMMARY_PROMPT)
+        result = await agent.run(
+            "\n\n".join(sections),
+            model_settings={"max_tokens": self.max_tokens, "temperature": 0.2}
+        )
+        return result.output.strip()
+
+    async def aclose(self):
+        """取消进行中的压缩任务"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "keep_turns": self.keep_turns,
+            "running": len(self._tasks),
+            "compactions": self.compactions,
+            "failures": self.failures,
+        }
@@ -0,0 +1,177 @@
+"""
+同一对话并发请求的测试
+
+ConversationLocks的三种策略，以及cancel策略下同一对话同时到达的两个流式请求：
+第一个请求被取消时只取消它的运行，不取消正在发送响应的请求任务。
+
+用法:
+    python -m unittest discover tests
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 导入web_server前设置，避免创建数据库文件和读取真实的模型配置
+os.environ.setdefault("MCP_CONVERSATION_STORE", "memory")
+os.environ.setdefault("MCP_LLM_API_MODEL_NAME", "test")
+os.environ.setdefault("MCP_LLM_API_KEY", "test")
+
+import httpx  # noqa: E402
+from pydantic_ai.messages import ModelResponse, TextPart  # noqa: E402
+from pydantic_ai.models.function import FunctionModel  # noqa: E402
+
+import web_server  # noqa: E402
+from admission import Limiter  # noqa: E402
+from conversation_lock import ConversationBusy, ConversationLocks  # noqa: E402
+
+
+def slow_model(words: int = 10, delay: float = 0.05):
+    async def answer(messages, info):
+        await asyncio.sleep(words * delay)
+        return ModelResponse(parts=[TextPart("回答")])
+
+    async def stream(messages, info):
+        for i in range(words):
+            await asyncio.sleep(delay)
+            yield f"w{i} "
+
+    return FunctionModel(answer, stream_function=stream)
+
+
+class ConversationLocksTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_queue_waits_for_previous_request(self):
+        locks = ConversationLocks(policy="queue")
+        first = await locks.acquire("c")
+        second = asyncio.create_task(locks.acquire("c"))
+        await asyncio.sleep(0)
+        self.assertFalse(second.done())
+        first.release()
+        (await second).release()
+        self.assertEqual(locks.stats()["waits"], 1)
+        self.assertEqual(locks.stats()["active"], 0)
+
+    async def test_simultaneous_requests_see_each_other(self):
+        # 两个请求在同一轮事件循环中到达，第二个不能因为第一个还没拿到锁而绕过策略
+        locks = ConversationLocks(policy="reject")
+        results = await asyncio.gather(locks.acquire("c"), locks.acquire("c"), return_exceptions=True)
+        self.assertEqual(sum(isinstance(result, ConversationBusy) for result in results), 1)
+        self.assertEqual(locks.stats()["rejected"], 1)
+        next(result for result in results if not isinstance(result, Exception)).release()
+        self.assertEqual(locks.stats()["active"], 0)
+
+    async def test_simultaneous_requests_cancel_previous(self):
+        locks = ConversationLocks(policy="cancel")
+        results = await asyncio.gather(locks.acquire("c"), locks.acquire("c"), return_exceptions=True)
+        # 先到的请求还没拿到锁就被取消，不再等待
+        self.assertIsInstance(results[0], ConversationBusy)
+        self.assertEqual(locks.stats()["cancelled"], 1)
+        results[1].release()
+        self.assertEqual(locks.stats()["active"], 0)
+
+    async def test_cancel_running_request(self):
+        locks = ConversationLocks(policy="cancel")
+        first = await locks.acquire("c")
+        owner = asyncio.create_task(asyncio.sleep(10))
+        first.set_owner(owner)
+        second = asyncio.create_task(locks.acquire("c"))
+        await asyncio.sleep(0)
+        self.assertTrue(first.superseded)
+        await asyncio.sleep(0)
+        self.assertTrue(owner.cancelled())
+        first.release()
+        (await second).release()
+        self.assertEqual(locks.stats()["active"], 0)
+
+    async def test_wait_timeout_leaves_slot(self):
+        locks = ConversationLocks(policy="queue", timeout=0.05)
+        first = await locks.acquire("c")
+        with self.assertRaises(ConversationBusy):
+            await locks.acquire("c")
+        with self.assertRaises(asyncio.TimeoutError):
+            await locks.acquire("c", timeout=0.01)
+        first.release()
+        self.assertEqual(locks.stats()["active"], 0)
+
+
+class CancelPolicyStreamTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        directory = tempfile.mkdtemp()
+        config_path = os.path.join(directory, "mcp_server_config.json")
+        with open(config_path, "w", encoding="utf-8") as f:
+            json.dump({"mcpServers": {}}, f)
+        patches = [
+            mock.patch.object(web_server, "MCP_CONFIG_PATH", config_path),
+            mock.patch.object(web_server, "mcp_config", {}),
+            mock.patch.object(web_server, "conversation_locks", ConversationLocks(policy="cancel")),
+            mock.patch.object(web_server, "create_model", slow_model),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        await web_server.initialize_agent()
+        self.addAsyncCleanup(self.close_runtime)
+
+    async def close_runtime(self):
+        await web_server.agent_runtime.drain_and_close(timeout=1)
+        web_server.agent_runtime = None
+
+    async def stream(self, client: httpx.AsyncClient, query: str, conversation_id: str, delay: float = 0.0):
+        await asyncio.sleep(delay)
+        response = await client.post("/api/stream", json={"query": query, "conversation_id": conversation_id})
+        if response.status_code != 200:
+            return response.status_code, []
+        return response.status_code, [json.loads(line) for line in response.text.splitlines()]
+
+    async def run_streams(self, second_delay: float):
+        conversation_id = web_server.ensure_conversation(None)
+        # ASGITransport会抛出应用中未处理的异常，例如发送响应的任务被取消
+        transport = httpx.ASGITransport(app=web_server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            first, second = await asyncio.gather(
+                self.stream(client, "第一个问题", conversation_id),
+                self.stream(client, "第二个问题", conversation_id, second_delay))
+
+        self.assertEqual(second[0], 200)
+        self.assertEqual(second[1][-1]["type"], "end")
+        messages = web_server.conversation_store.get(conversation_id).messages
+        self.assertEqual([(m.role, m.content) for m in messages][-2:],
+                         [("user", "第二个问题"), ("assistant", "".join(f"w{i} " for i in range(10)))])
+        self.assertEqual(web_server.conversation_locks.stats()["cancelled"], 1)
+        self.assertEqual(web_server.conversation_locks.stats()["active"], 0)
+        return first
+
+    async def test_simultaneous_streams(self):
+        first = await self.run_streams(0.0)
+        # 第一个请求还在等待对话时被取消返回409，已经开始时以cancelled事件结束
+        self.assertTrue(first[0] == 409 or first[1][-1] == {"type": "cancelled", "reason": "superseded"}, first)
+
+    async def test_second_stream_takes_over(self):
+        status, events = await self.run_streams(0.2)
+        self.assertEqual(status, 200)
+        self.assertEqual(events[-1], {"type": "cancelled", "reason": "superseded"})
+        self.assertEqual(events[1]["type"], "content")
+
+    async def test_takeover_while_queued_for_admission(self):
+        # 第一个请求持有对话、排队等待并发名额时被取消：拿到名额后运行立即取消并归还名额
+        limiter = Limiter("requests", 1)
+        with mock.patch.object(web_server.admission, "requests", limiter):
+            transport = httpx.ASGITransport(app=web_server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+                other = asyncio.create_task(self.stream(client, "其他对话", web_server.ensure_conversation(None)))
+                await asyncio.sleep(0.05)
+                first = await self.run_streams(0.1)
+                self.assertEqual((await other)[1][-1]["type"], "end")
+        self.assertEqual(first[1][-1], {"type": "cancelled", "reason": "superseded"})
+        self.assertEqual(limiter.in_flight, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+"""
+对话历史滚动摘要的测试
+
+用PydanticAI的FunctionModel代替真实模型，检查压缩的触发条件、摘要替换被压缩的轮次后
+build_message_history的输出，以及模型出错时历史保持不变。
+
+用法:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from datetime import datetime
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 导入web_server前设置，避免创建数据库文件和读取真实的模型配置
+os.environ.setdefault("MCP_CONVERSATION_STORE", "memory")
+os.environ.setdefault("MCP_LLM_API_MODEL_NAME", "test")
+os.environ.setdefault("MCP_LLM_API_KEY", "test")
+
+from pydantic_ai.messages import ModelRequest, ModelResponse, SystemPromptPart, TextPart, UserPromptPart  # noqa: E402
+from pydantic_ai.models.function import FunctionModel  # noqa: E402
+
+import web_server  # noqa: E402
+from conversation_store import ChatMessage, Conversation, MemoryConversationStore  # noqa: E402
+from summarizer import ConversationSummarizer  # noqa: E402
+
+# 每条消息计入历史的token数，直接写在消息上，不依赖分词器
+MESSAGE_TOKENS = 10
+
+
+def make_turns(start: int, count: int) -> list:
+    messages = []
+    for i in range(start, start + count):
+        messages.append(ChatMessage(role="user", content=f"问题{i}", tokens=MESSAGE_TOKENS))
+        messages.append(ChatMessage(role="assistant", content=f"回答{i}", tokens=MESSAGE_TOKENS))
+    return messages
+
+
+def make_conversation(store: MemoryConversationStore, turns: int, conversation_id: str = "c") -> str:
+    now = datetime.now()
+    store.create(Conversation(id=conversation_id, title="测试", created_at=now, updated_at=now,
+                              messages=make_turns(0, turns)))
+    return conversation_id
+
+
+def summary_model(prompts: list, reply: str = "摘要内容"):
+    """记录收到的摘要提示词并返回固定摘要的模型"""
+
+    def summarize(messages, info):
+        prompts.append(messages[-1].parts[-1].content)
+        return ModelResponse(parts=[TextPart(reply)])
+
+    return FunctionModel(summarize)
+
+
+def failing_model():
+    def summarize(messages, info):
+        raise RuntimeError("模型不可用")
+
+    return FunctionModel(summarize)
+
+
+def history_texts(history) -> list:
+    """build_message_history结果中的系统提示、用户问题和回答文本"""
+    texts = []
+    for message in history:
+        for part in message.parts:
+            if isinstance(part, (SystemPromptPart, UserPromptPart, TextPart)):
+                texts.append(part.content)
+    return texts
+
+
+class SummarizerTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.store = MemoryConversationStore()
+        self.prompts = []
+
+    def summarizer(self, threshold: int, keep_turns: int = 2, model=None) -> ConversationSummarizer:
+        summarizer = ConversationSummarizer(self.store, threshold=threshold, keep_turns=keep_turns)
+        summarizer.model = model or summary_model(self.prompts)
+        return summarizer
+
+    async def test_below_threshold_does_not_summarize(self):
+        cid = make_conversation(self.store, turns=5)
+        summarizer = self.summarizer(threshold=5 * 2 * MESSAGE_TOKENS + 1)
+
+        self.assertIsNone(await summarizer.compact(cid))
+        self.assertEqual(self.prompts, [])
+        self.assertIsNone(self.store.get_history_summary(cid))
+
+    async def test_summarizes_at_threshold_and_keeps_recent_turns(self):
+        cid = make_conversation(self.store, turns=5)
+        summarizer = self.summarizer(threshold=5 * 2 * MESSAGE_TOKENS, keep_turns=2)
+
+        summary = await summarizer.compact(cid)
+
+        # 保留最近2轮原文，前3轮（6条消息）压缩进摘要
+        self.assertIsNotNone(summary)
+        self.assertEqual(summary.covered, 6)
+        self.assertEqual(summary.content, "摘要内容")
+        self.assertEqual(self.store.get_history_summary(cid), summary)
+        self.assertEqual(len(self.prompts), 1)
+        self.assertIn("问题2", self.prompts[0])
+        self.assertNotIn("问题3", self.prompts[0])
+        self.assertEqual(summarizer.compactions, 1)
+
+    async def test_next_summary_includes_previous_summary(self):
+        cid = make_conversation(self.store, turns=5)
+        summarizer = self.summarizer(threshold=5 * 2 * MESSAGE_TOKENS, keep_turns=2)
+        await summarizer.compact(cid)
+        self.store.append_messages(cid, make_turns(5, 3), datetime.now())
+
+        summary = await summarizer.compact(cid)
+
+        self.assertEqual(summary.covered, 6 + 6)
+        self.assertIn("已有的摘要：\n摘要内容", self.prompts[-1])
+        self.assertIn("问题5", self.prompts[-1])
+        self.assertNotIn("问题1", self.prompts[-1])
+
+    async def test_build_message_history_replaces_summarized_turns(self):
+        cid = make_conversation(self.store, turns=5)
+        summarizer = self.summarizer(threshold=5 * 2 * MESSAGE_TOKENS, keep_turns=2)
+        await summarizer.compact(cid)
+
+        with mock.patch.object(web_server, "conversation_store", self.store):
+            by_turns = web_server.build_message_history(cid, 10, "系统提示", token_budget=0)
+            by_budget = web_server.build_message_history(cid, 10, "系统提示", token_budget=1000)
+
+        for history in (by_turns, by_budget):
+            texts = history_texts(history)
+            self.assertIsInstance(history[0], ModelRequest)
+            self.assertEqual(texts[:2], ["系统提示", "以下是之前对话的摘要：\n摘要内容"])
+            # 被压缩的轮次不再出现，保留的轮次按原文出现
+            self.assertEqual(texts[2:], ["问题3", "回答3", "问题4", "回答4"])
+
+    async def test_failure_leaves_history_unchanged(self):
+        cid = make_conversation(self.store, turns=5)
+        with mock.patch.object(web_server, "conversation_store", self.store):
+            before = history_texts(web_server.build_message_history(cid, 10, "系统提示", token_budget=0))
+
+        summarizer = self.summarizer(threshold=5 * 2 * MESSAGE_TOKENS, model=failing_model())
+        summarizer.schedule(cid)
+        await summarizer._tasks[cid]
+
+        self.assertEqual(summarizer.failures, 1)
+        self.assertEqual(summarizer.compactions, 0)
+        self.assertIsNone(self.store.get_history_summary(cid))
+        with mock.patch.object(web_server, "conversation_store", self.store):
+            after = history_texts(web_server.build_message_history(cid, 10, "系统提示", token_budget=0))
+        self.assertEqual(after, before)
+        self.assertIn("问题0", after)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+"""
+系统提示符的测试
+
+用PydanticAI的FunctionModel记录模型实际收到的系统提示符，检查没有历史的第一轮和有历史的后续轮次
+使用的都是本次请求的系统提示符，且只出现一次。
+
+用法:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from datetime import datetime
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 导入web_server前设置，避免创建数据库文件和读取真实的模型配置
+os.environ.setdefault("MCP_CONVERSATION_STORE", "memory")
+os.environ.setdefault("MCP_LLM_API_MODEL_NAME", "test")
+os.environ.setdefault("MCP_LLM_API_KEY", "test")
+
+from pydantic_ai.messages import ModelRequest, ModelResponse, SystemPromptPart, TextPart  # noqa: E402
+from pydantic_ai.models.function import FunctionModel  # noqa: E402
+
+import web_server  # noqa: E402
+from conversation_store import ChatMessage, Conversation, MemoryConversationStore  # noqa: E402
+from stream_runs import StreamRun  # noqa: E402
+
+DEFAULT_PROMPT = "配置中的系统提示符"
+
+
+def recording_model(received: list):
+    """记录每次模型请求中所有系统提示符的模型"""
+
+    def answer(messages, info):
+        received.append([part.content for message in messages if isinstance(message, ModelRequest)
+                         for part in message.parts if isinstance(part, SystemPromptPart)])
+        return ModelResponse(parts=[TextPart("回答")])
+
+    return FunctionModel(answer)
+
+
+class SystemPromptTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.received = []
+        self.agent = web_server.create_agent(recording_model(self.received), [], DEFAULT_PROMPT)
+
+    async def ask(self, query: str, system_prompt, message_history=None) -> StreamRun:
+        run = StreamRun()
+        async for _ in web_server.generate_answer(self.agent, query, system_prompt, message_history or [], run):
+            pass
+        self.assertIsNone(run.error)
+        return run
+
+    async def test_first_turn_uses_request_prompt(self):
+        await self.ask("你好", "请求的系统提示符")
+        self.assertEqual(self.received, [["请求的系统提示符"]])
+
+    async def test_first_turn_without_prompt_uses_default(self):
+        await self.ask("你好", None)
+        self.assertEqual(self.received, [[DEFAULT_PROMPT]])
+
+    async def test_turn_with_history_uses_same_prompt_once(self):
+        store = MemoryConversationStore()
+        now = datetime.now()
+        store.create(Conversation(id="c", title="测试", created_at=now, updated_at=now))
+        first = await self.ask("问题1", "请求的系统提示符")
+        store.append_messages("c", [
+            ChatMessage(role="user", content="问题1"),
+            ChatMessage(role="assistant", content=first.answer, model_messages=first.model_messages),
+        ], now)
+
+        with mock.patch.object(web_server, "conversation_store", store):
+            history = web_server.build_message_history("c", 10, "请求的系统提示符", token_budget=0)
+        await self.ask("问题2", "请求的系统提示符", history)
+
+        self.assertEqual(self.received, [["请求的系统提示符"], ["请求的系统提示符"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
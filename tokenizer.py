@@ -0,0 +1,68 @@
+from typing import Callable, Optional
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# tiktoken使用的编码，未安装tiktoken或加载失败时按字符估算
+TOKENIZER_ENCODING = os.getenv("MCP_TOKENIZER_ENCODING", "cl100k_base")
+
+# 每条消息的固定开销（角色、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 中日韩字符通常每个字符至少一个token，其余文本大约每4个字符一个token
+_CJK = re.compile(r"[　-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]")
+
+
+def estimate_tokens(text: str) -> int:
+    """不依赖分词器的token估算"""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _load_encoder() -> Optional[Callable[[str], int]]:
+    try:
+        import tiktoken
+    except ImportError:
+        logger.info("未安装tiktoken，按字符数估算token（pip install tiktoken）")
+        return None
+    try:
+        encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        logger.warning(f"加载tiktoken编码 {TOKENIZER_ENCODING} 失败，按字符数估算token: {str(e)}")
+        return None
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+_encoder: Optional[Callable[[str], int]] = None
+_encoder_loaded = False
+
+
+def _get_encoder() -> Optional[Callable[[str], int]]:
+    global _encoder, _encoder_loaded
+    if not _encoder_loaded:
+        _encoder = _load_encoder()
+        _encoder_loaded = True
+    return _encoder
+
+
+def count_tokens(text: str) -> int:
+    """
+    统计文本的token数
+
+    安装了tiktoken时使用本地分词器精确计数，否则使用estimate_tokens估算。
+    """
+    if not text:
+        return 0
+    encoder = _get_encoder()
+    if encoder is None:
+        return estimate_tokens(text)
+    return encoder(text)
+
+
+def tokenizer_name() -> str:
+    """当前使用的分词方式，用于监控"""
+    return f"tiktoken:{TOKENIZER_ENCODING}" if _get_encoder() is not None else "estimate"
@@ -0,0 +1,191 @@
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Any, Dict, Iterable, List, Optional, Set
+import fnmatch
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# 未在toolCache中指定时使用的默认值
+DEFAULT_TOOL_CACHE_TTL = 300.0
+DEFAULT_TOOL_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# 当前请求中命中缓存的调用键，由流式接口设置，用于给tool_result事件标记cached
+tool_cache_hits: ContextVar[Optional[Set[str]]] = ContextVar("tool_cache_hits", default=None)
+
+
+def cache_key(tool_name: str, args: Dict[str, Any]) -> str:
+    """工具名加规范化参数，参数顺序不同的相同调用得到相同的键"""
+    return tool_name + ":" + json.dumps(args or {}, sort_keys=True, ensure_ascii=False,
+                                        separators=(",", ":"), default=str)
+
+
+class ToolResultCache:
+    """
+    单个MCP服务器的工具结果缓存
+
+    只缓存名称匹配tools中任一模式（fnmatch语法）的工具的成功结果，
+    按TTL过期，并按估算字节数做LRU淘汰。
+    """
+
+    def __init__(self, tools: Iterable[str], ttl: float = DEFAULT_TOOL_CACHE_TTL,
+                 max_bytes: int = DEFAULT_TOOL_CACHE_MAX_BYTES):
+        self.patterns = list(tools)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # key -> (结果, 估算字节数, 过期时间)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_config(cls, cache_config: Dict[str, Any]) -> "ToolResultCache":
+        """
+        根据服务器配置中的toolCache创建缓存
+
+        Args:
+            cache_config: 形如{"tools": ["search*"], "ttl": 600, "maxBytes": 1048576}
+        """
+        return cls(
+            cache_config.get("tools", []),
+            ttl=float(cache_config.get("ttl", DEFAULT_TOOL_CACHE_TTL)),
+            max_bytes=int(cache_config.get("maxBytes", DEFAULT_TOOL_CACHE_MAX_BYTES))
+        )
+
+    def matches(self, tool_name: str) -> bool:
+        return any(fnmatch.fnmatchcase(tool_name, pattern) for pattern in self.patterns)
+
+    def get(self, key: str) -> Any:
+        """
+        读取缓存的结果
+
+        Raises:
+            KeyError: 未命中或已过期
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            raise KeyError(key)
+        result, size, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            raise KeyError(key)
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key: str, result: Any):
+        """写入结果，无法序列化或单条超过上限的结果不缓存"""
+        try:
+            size = len(json.dumps(result, ensure_ascii=False).encode("utf-8"))
+        except (TypeError, ValueError):
+            return
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (result, size, time.monotonic() + self.ttl)
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class CachingMCPServer:
+    """
+    在MCP服务器前加一层工具结果缓存
+
+    只拦截call_tool，其余属性和方法直接转发给被包装的服务器。
+    服务器进程的启停仍由ServerHandle管理，缓存配置变化时只需重新包装，不会重启服务器。
+    """
+
+    def __init__(self, server: Any, cache: ToolResultCache):
+        self.server = server
+        self.cache = cache
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.server, name)
+
+    def __repr__(self) -> str:
+        return f"CachingMCPServer({self.server!r})"
+
+    async def call_tool(self, tool_name: str, arguments: Dict[str, Any]) -> Any:
+        if not self.cache.matches(tool_name):
+            return await self.server.call_tool(tool_name, arguments)
+
+        key = cache_key(tool_name, arguments)
+        try:
+            result = self.cache.get(key)
+        except KeyError:
+            pass
+        else:
+            hits = tool_cache_hits.get()
+            if hits is not None:
+                hits.add(key)
+            return result
+
+        result = await self.server.call_tool(tool_name, arguments)
+        self.cache.put(key, result)
+        return result
+
+
+class ToolCacheRegistry:
+    """按服务器名称管理工具结果缓存，配置更新时保留未变化的缓存"""
+
+    def __init__(self):
+        self._caches: Dict[str, ToolResultCache] = {}
+        self._configs: Dict[str, str] = {}
+
+    def configure(self, servers_config: Dict[str, Dict[str, Any]], invalidate: Iterable[str] = ()):
+        """
+        根据新配置更新缓存
+
+        Args:
+            servers_config: 新配置中的mcpServers
+            invalidate: 进程被重启的服务器名称，其缓存结果一并清除
+        """
+        invalidate = set(invalidate)
+        caches, configs = {}, {}
+        for name, server_config in servers_config.items():
+            cache_config = server_config.get("toolCache")
+            if not cache_config or not cache_config.get("tools"):
+                continue
+            spec = json.dumps(cache_config, sort_keys=True)
+            if name in self._caches and self._configs.get(name) == spec and name not in invalidate:
+                caches[name] = self._caches[name]
+            else:
+                caches[name] = ToolResultCache.from_config(cache_config)
+                logger.info(f"MCP服务器 {name} 启用工具结果缓存: {caches[name].patterns}")
+            configs[name] = spec
+        self._caches, self._configs = caches, configs
+
+    def wrap(self, name: str, server: Any) -> Any:
+        """为配置了toolCache的服务器加上缓存，其余服务器原样返回"""
+        cache = self._caches.get(name)
+        return CachingMCPServer(server, cache) if cache is not None else server
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: cache.stats() for name, cache in self._caches.items()}
+
+    def names(self) -> List[str]:
+        return list(self._caches)
@@ -0,0 +1,113 @@
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import asyncio
+import logging
+import os
+import time
+
+from mcp import types
+
+logger = logging.getLogger(__name__)
+
+# 工具列表的缓存时间（秒），0表示只在收到变更通知或服务器重启时刷新
+TOOL_CATALOG_TTL = float(os.getenv("MCP_TOOL_CATALOG_TTL", "300"))
+
+
+class ToolCatalog:
+    """
+    单个MCP服务器的工具列表缓存
+
+    pydantic-ai在每次模型请求和每次工具调用前都会重新列出所有服务器的工具。
+    缓存只在服务器重启、收到tools/list_changed通知或超过TTL时才重新向服务器请求。
+    """
+
+    def __init__(self, ttl: float = TOOL_CATALOG_TTL):
+        self.ttl = ttl
+        self.tools: Optional[List[Any]] = None
+        self.fetched_at: Optional[float] = None
+        self.refreshes = 0
+        self._fetched_monotonic = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    @property
+    def fresh(self) -> bool:
+        if self.tools is None:
+            return False
+        return self.ttl <= 0 or time.monotonic() - self._fetched_monotonic < self.ttl
+
+    def invalidate(self):
+        self.tools = None
+
+    async def get(self, fetch: Callable[[], Awaitable[List[Any]]]) -> List[Any]:
+        """返回缓存的工具列表，过期时调用fetch刷新；并发的刷新只请求一次"""
+        if self.fresh:
+            return self.tools
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.fresh:
+                tools = await fetch()
+                self.tools = tools
+                self.fetched_at = time.time()
+                self._fetched_monotonic = time.monotonic()
+                self.refreshes += 1
+            return self.tools
+
+    def describe(self) -> List[Dict[str, Any]]:
+        """工具元数据，用于/api/tools"""
+        return [
+            {
+                "name": tool.name,
+                "description": tool.description,
+                "parameters": tool.parameters_json_schema,
+            }
+            for tool in self.tools or []
+        ]
+
+
+def watch_tool_changes(server: Any, callback: Callable[[], None]) -> bool:
+    """
+    在服务器的客户端会话上监听tools/list_changed通知
+
+    pydantic-ai没有提供注册通知回调的接口，这里包装会话的消息处理函数；
+    连接池会对每个副本分别监听。
+
+    Returns:
+        是否成功挂上监听，失败时只能依靠TTL刷新
+    """
+    watched = False
+    for replica in getattr(server, "replicas", [server]):
+        client = getattr(replica, "_client", None)
+        original = getattr(client, "_message_handler", None)
+        if original is None:
+            continue
+
+        async def handler(message, original=original):
+            if (isinstance(message, types.ServerNotification)
+                    and isinstance(message.root, types.ToolListChangedNotification)):
+                callback()
+            await original(message)
+
+        client._message_handler = handler
+        watched = True
+    return watched
+
+
+class CatalogMCPServer:
+    """
+    用ToolCatalog应答list_tools的MCP服务器包装
+
+    其余属性和方法直接转发给被包装的服务器。
+    """
+
+    def __init__(self, server: Any, catalog: ToolCatalog):
+        self.server = server
+        self.catalog = catalog
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.server, name)
+
+    def __repr__(self) -> str:
+        return f"CatalogMCPServer({self.server!r})"
+
+    async def list_tools(self) -> List[Any]:
+        return await self.catalog.get(self.server.list_tools)
@@ -0,0 +1,390 @@
+from collections import OrderedDict, deque
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+import asyncio
+import fnmatch
+import hashlib
+import itertools
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# 未在toolResultLimits中匹配到的工具结果的字符数上限，0表示不限制
+TOOL_RESULT_MAX_CHARS = int(os.getenv("MCP_TOOL_RESULT_MAX_CHARS", "0"))
+# 超过上限的结果在tool_result事件中的预览字符数
+TOOL_RESULT_PREVIEW_CHARS = int(os.getenv("MCP_TOOL_RESULT_PREVIEW_CHARS", "500"))
+# 完整结果的保存目录、保留时间（秒）和总字节数上限
+TOOL_RESULT_DIR = os.getenv("MCP_TOOL_RESULT_DIR", "tool_results")
+TOOL_RESULT_TTL = float(os.getenv("MCP_TOOL_RESULT_TTL", "3600"))
+TOOL_RESULT_STORE_MAX_BYTES = int(os.getenv("MCP_TOOL_RESULT_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# 截断后保留的开头部分占上限的比例，其余留给结尾
+_HEAD_RATIO = 2 / 3
+# 逐块编码、计算哈希和写入完整结果时每块的字符数
+_CHUNK_CHARS = 64 * 1024
+_RESULT_ID = re.compile(r"^[0-9a-f]{32}$")
+_EXTENSIONS = {".txt": "text/plain; charset=utf-8", ".json": "application/json"}
+
+
+def result_chunks(result: Any) -> Iterator[str]:
+    """
+    工具结果的文本形式，逐块生成
+
+    字符串结果按_CHUNK_CHARS切片；其他结果用JSONEncoder.iterencode逐段编码，结果与json.dumps相同，
+    但不生成完整的JSON文本。包含图片等二进制内容的结果在迭代中抛出TypeError。
+    """
+    if isinstance(result, str):
+        for start in range(0, len(result), _CHUNK_CHARS):
+            yield result[start:start + _CHUNK_CHARS]
+        return
+    pieces, size = [], 0
+    for piece in json.JSONEncoder(ensure_ascii=False).iterencode(result):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= _CHUNK_CHARS:
+            yield "".join(pieces)
+            pieces, size = [], 0
+    if pieces:
+        yield "".join(pieces)
+
+
+class SpilledResult:
+    """写入磁盘的完整结果：id、字符数，以及内存中保留的开头和结尾"""
+
+    def __init__(self, result_id: str, size: int, head: str, tail: str):
+        self.result_id = result_id
+        self.size = size
+        self.head = head
+        self.tail = tail
+
+
+def truncate_text(spilled: SpilledResult, limit: int) -> str:
+    """保留开头和结尾，中间换成说明省略字数和完整结果地址的标记"""
+    head = int(limit * _HEAD_RATIO)
+    omitted = spilled.size - head - len(spilled.tail)
+    marker = (f"\n\n…（结果过长，省略了中间{omitted}个字符，"
+              f"完整结果见 /api/tool-results/{spilled.result_id}）…\n\n")
+    return spilled.head[:head] + marker + spilled.tail
+
+
+class TruncatedResult(str):
+    """
+    截断后的工具结果文本
+
+    交给模型和保存到历史时与普通字符串相同，另外带有完整结果的id、原始字符数和预览，
+    流式接口据此把tool_result事件的内容换成预览。工具结果缓存保存的也是这个对象，命中缓存时同样可以得到预览。
+    """
+
+    def __new__(cls, text: str, result_id: str, size: int, preview: str):
+        result = super().__new__(cls, text)
+        result.result_id = result_id
+        result.size = size
+        result.preview = preview
+        return result
+
+
+class ToolResultLimits:
+    """
+    单个MCP服务器的工具结果字符数上限
+
+    patterns按配置顺序匹配工具名称（fnmatch语法），第一个匹配的模式决定上限，
+    都不匹配时使用default。
+    """
+
+    def __init__(self, patterns: Dict[str, int], default: int = TOOL_RESULT_MAX_CHARS):
+        self.patterns = patterns
+        self.default = default
+        self.truncated = 0
+        self.chars_in = 0
+        self.chars_out = 0
+
+    @classmethod
+    def from_config(cls, server_config: Dict[str, Any]) -> "ToolResultLimits":
+        """
+        根据服务器配置中的toolResultLimits创建
+
+        Args:
+            server_config: 服务器配置，toolResultLimits形如{"list_files": 8000, "*": 30000}
+        """
+        patterns = {pattern: int(chars) for pattern, chars in (server_config.get("toolResultLimits") or {}).items()}
+        return cls(patterns)
+
+    @property
+    def enabled(self) -> bool:
+        return self.default > 0 or any(chars > 0 for chars in self.patterns.values())
+
+    def limit_for(self, tool_name: str) -> Optional[int]:
+        """工具结果的字符数上限，None表示不限制"""
+        for pattern, chars in self.patterns.items():
+            if fnmatch.fnmatchcase(tool_name, pattern):
+                return chars if chars > 0 else None
+        return self.default if self.default > 0 else None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "default": self.default,
+            "patterns": dict(self.patterns),
+            "truncated": self.truncated,
+            "chars_in": self.chars_in,
+            "chars_out": self.chars_out,
+        }
+
+
+class ToolResultStore:
+    """
+    超过上限的完整工具结果，保存在磁盘上供/api/tool-results/{id}读取
+
+    每个结果一个文件，文件名是内容的哈希，相同的结果只保留一份。按保留时间过期，并按总字节数淘汰最早的结果。
+    多进程部署时各进程共用目录，读取不依赖写入的进程；淘汰只处理本进程写入的结果，
+    其他进程写入的过期文件在读取时或启动时清理。
+    """
+
+    def __init__(self, directory: str = TOOL_RESULT_DIR, ttl: float = TOOL_RESULT_TTL,
+                 max_bytes: int = TOOL_RESULT_STORE_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # result_id -> (文件路径, 字节数, 过期时间)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._swept = False
+        self.stored = 0
+        self.reused = 0
+        self.evictions = 0
+
+    async def put(self, chunks: Iterable[str], limit: int, media_type: str = "text/plain") -> Optional[SpilledResult]:
+        """
+        保存超过上限的完整结果
+
+        逐块编码、计算哈希并写入临时文件，内存中只保留开头和结尾，在线程中进行，不阻塞事件循环。
+        结果已经存在时丢弃临时文件，只延长保留时间。
+
+        Args:
+            chunks: 结果文本的分块，见result_chunks
+            limit: 字符数上限，不超过上限的结果不写文件
+
+        Returns:
+            超过上限时返回SpilledResult，否则返回None
+        """
+        extension = ".json" if media_type == "application/json" else ".txt"
+        written_result = await asyncio.to_thread(self._write, chunks, limit, extension)
+        if written_result is None:
+            return None
+        spilled, path, size, written = written_result
+        result_id = spilled.result_id
+        if result_id in self._entries:
+            self._remove_entry(result_id)
+        self._entries[result_id] = (path, size, time.monotonic() + self.ttl)
+        self._bytes += size
+        if written:
+            self.stored += 1
+        else:
+            self.reused += 1
+        self._evict()
+        return spilled
+
+    def _write(self, chunks: Iterable[str], limit: int,
+               extension: str) -> Optional[Tuple[SpilledResult, str, int, bool]]:
+        chunks = iter(chunks)
+        pending, buffered = [], 0
+        for chunk in chunks:
+            pending.append(chunk)
+            buffered += len(chunk)
+            if buffered > limit:
+                break
+        else:
+            return None
+
+        if not self._swept:
+            os.makedirs(self.directory, exist_ok=True)
+            self._sweep()
+            self._swept = True
+        head_chars = max(int(limit * _HEAD_RATIO), TOOL_RESULT_PREVIEW_CHARS)
+        tail_chars = limit - int(limit * _HEAD_RATIO)
+        head = "".join(pending)[:head_chars]
+        tail: deque = deque()
+        tail_size = 0
+        size = 0
+        data_size = 0
+        # 哈希包含扩展名，内容相同的文本结果和JSON结果分别保存
+        digest = hashlib.sha256(extension.encode())
+        # 先写临时文件，得到哈希后再改名，其他进程不会读到写了一半的文件
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in itertools.chain(pending, chunks):
+                    data = chunk.encode("utf-8")
+                    digest.update(data)
+                    f.write(data)
+                    size += len(chunk)
+                    data_size += len(data)
+                    tail.append(chunk)
+                    tail_size += len(chunk)
+                    while tail and tail_size - len(tail[0]) >= tail_chars:
+                        tail_size -= len(tail.popleft())
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+        result_id = digest.hexdigest()[:32]
+        spilled = SpilledResult(result_id, size, head, "".join(tail)[-tail_chars:] if tail_chars > 0 else "")
+        path = os.path.join(self.directory, result_id + extension)
+        try:
+            # 已经存在（本进程或其他进程写入过）时只更新修改时间，保留时间从现在重新计算
+            os.utime(path)
+        except FileNotFoundError:
+            os.replace(temp_path, path)
+            return spilled, path, data_size, True
+        os.remove(temp_path)
+        return spilled, path, data_size, False
+
+    def _sweep(self):
+        """删除之前的进程留下的过期文件"""
+        deadline = time.time() - self.ttl
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < deadline:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._entries:
+            result_id, (path, size, expires_at) = next(iter(self._entries.items()))
+            if self._bytes <= self.max_bytes and expires_at > now:
+                break
+            self._remove(result_id)
+            self.evictions += 1
+
+    def _remove(self, result_id: str):
+        path = self._remove_entry(result_id)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _remove_entry(self, result_id: str) -> str:
+        path, size, _ = self._entries.pop(result_id)
+        self._bytes -= size
+        return path
+
+    def get(self, result_id: str) -> Optional[Tuple[str, str]]:
+        """
+        完整结果的文件路径和媒体类型
+
+        Returns:
+            (文件路径, 媒体类型)，不存在或已过期时返回None
+        """
+        if not _RESULT_ID.match(result_id):
+            return None
+        self._evict()
+        for extension, media_type in _EXTENSIONS.items():
+            path = os.path.join(self.directory, result_id + extension)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if mtime + self.ttl < time.time():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                return None
+            return path, media_type
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "directory": self.directory,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "ttl": self.ttl,
+            "stored": self.stored,
+            "reused": self.reused,
+            "evictions": self.evictions,
+        }
+
+
+class TruncatingMCPServer:
+    """
+    截断超过上限的工具结果，其余属性转发给被包装的服务器
+
+    完整结果逐块写入ToolResultStore，不生成完整的JSON文本和编码后的字节，
+    模型、对话历史、流式事件和工具结果缓存只保存截断后的TruncatedResult。
+    MCP客户端仍会把完整结果解码到内存中，调用期间的内存峰值仍包含一份完整结果。
+    """
+
+    def __init__(self, server: Any, limits: ToolResultLimits, store: ToolResultStore):
+        self.server = server
+        self.limits = limits
+        self.store = store
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.server, name)
+
+    def __repr__(self) -> str:
+        return f"TruncatingMCPServer({self.server!r})"
+
+    async def call_tool(self, tool_name: str, arguments: Dict[str, Any]) -> Any:
+        result = await self.server.call_tool(tool_name, arguments)
+        limit = self.limits.limit_for(tool_name)
+        if limit is None:
+            return result
+        media_type = "text/plain" if isinstance(result, str) else "application/json"
+        try:
+            spilled = await self.store.put(result_chunks(result), limit, media_type)
+        except (TypeError, ValueError):
+            # 包含图片等二进制内容的结果不截断
+            return result
+        if spilled is None:
+            return result
+
+        del result
+        truncated = TruncatedResult(truncate_text(spilled, limit), spilled.result_id, spilled.size,
+                                    spilled.head[:TOOL_RESULT_PREVIEW_CHARS])
+        self.limits.truncated += 1
+        self.limits.chars_in += spilled.size
+        self.limits.chars_out += len(truncated)
+        logger.info(f"工具 {tool_name} 的结果有{spilled.size}个字符，截断为{limit}个字符，完整结果: {spilled.result_id}")
+        return truncated
+
+
+class ToolResultLimitRegistry:
+    """按服务器名称管理工具结果上限，所有服务器共用一个完整结果存储"""
+
+    def __init__(self, store: Optional[ToolResultStore] = None):
+        self.store = store or ToolResultStore()
+        self._limits: Dict[str, ToolResultLimits] = {}
+
+    def configure(self, servers_config: Dict[str, Dict[str, Any]]):
+        limits = {}
+        for name, server_config in servers_config.items():
+            configured = ToolResultLimits.from_config(server_config)
+            if not configured.enabled:
+                continue
+            existing = self._limits.get(name)
+            if existing is not None and existing.patterns == configured.patterns \
+                    and existing.default == configured.default:
+                configured = existing
+            limits[name] = configured
+        self._limits = limits
+
+    def wrap(self, name: str, server: Any) -> Any:
+        """为设置了上限的服务器加上截断，其余服务器原样返回"""
+        limits = self._limits.get(name)
+        return TruncatingMCPServer(server, limits, self.store) if limits is not None else server
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "store": self.store.stats(),
+            "servers": {name: limits.stats() for name, limits in self._limits.items()},
+        }
@@ -0,0 +1,115 @@
+from typing import Any, Dict, Optional
+import asyncio
+import fnmatch
+import logging
+import os
+
+from pydantic_ai import ModelRetry
+
+logger = logging.getLogger(__name__)
+
+# 未在toolTimeouts中匹配到的工具调用的超时时间（秒），0表示不限制
+TOOL_TIMEOUT = float(os.getenv("MCP_TOOL_TIMEOUT", "0"))
+
+
+class ToolTimeouts:
+    """
+    单个MCP服务器的工具调用超时
+
+    patterns按配置顺序匹配工具名称（fnmatch语法），第一个匹配的模式决定超时时间，
+    都不匹配时使用default。
+    """
+
+    def __init__(self, patterns: Dict[str, float], default: float = TOOL_TIMEOUT):
+        self.patterns = patterns
+        self.default = default
+        self.calls = 0
+        self.timeouts = 0
+
+    @classmethod
+    def from_config(cls, server_config: Dict[str, Any]) -> "ToolTimeouts":
+        """
+        根据服务器配置中的toolTimeouts创建
+
+        Args:
+            server_config: 服务器配置，toolTimeouts形如{"search": 20, "*": 60}
+        """
+        patterns = {pattern: float(seconds) for pattern, seconds in (server_config.get("toolTimeouts") or {}).items()}
+        return cls(patterns)
+
+    @property
+    def enabled(self) -> bool:
+        return self.default > 0 or any(seconds > 0 for seconds in self.patterns.values())
+
+    def timeout_for(self, tool_name: str) -> Optional[float]:
+        """工具调用的超时时间，None表示不限制"""
+        for pattern, seconds in self.patterns.items():
+            if fnmatch.fnmatchcase(tool_name, pattern):
+                return seconds if seconds > 0 else None
+        return self.default if self.default > 0 else None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "default": self.default,
+            "patterns": dict(self.patterns),
+            "calls": self.calls,
+            "timeouts": self.timeouts,
+        }
+
+
+class TimeoutMCPServer:
+    """
+    为每次工具调用加上超时，其余属性转发给被包装的服务器
+
+    超时后取消调用并像MCP工具返回错误时一样抛出ModelRetry，由模型决定换一种方式或直接回答。
+    """
+
+    def __init__(self, server: Any, timeouts: ToolTimeouts):
+        self.server = server
+        self.timeouts = timeouts
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.server, name)
+
+    def __repr__(self) -> str:
+        return f"TimeoutMCPServer({self.server!r})"
+
+    async def call_tool(self, tool_name: str, arguments: Dict[str, Any]) -> Any:
+        timeout = self.timeouts.timeout_for(tool_name)
+        if timeout is None:
+            return await self.server.call_tool(tool_name, arguments)
+        self.timeouts.calls += 1
+        try:
+            return await asyncio.wait_for(self.server.call_tool(tool_name, arguments), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts.timeouts += 1
+            logger.warning(f"工具 {tool_name} 调用超过{timeout:g}秒，已取消")
+            raise ModelRetry(f"工具 {tool_name} 调用超时（{timeout:g}秒），请尝试其他方式或直接回答")
+
+
+class ToolTimeoutRegistry:
+    """按服务器名称管理工具调用超时，配置更新时保留未变化的服务器的计数"""
+
+    def __init__(self):
+        self._timeouts: Dict[str, ToolTimeouts] = {}
+
+    def configure(self, servers_config: Dict[str, Dict[str, Any]]):
+        timeouts = {}
+        for name, server_config in servers_config.items():
+            configured = ToolTimeouts.from_config(server_config)
+            if not configured.enabled:
+                continue
+            existing = self._timeouts.get(name)
+            if existing is not None and existing.patterns == configured.patterns \
+                    and existing.default == configured.default:
+                configured = existing
+            timeouts[name] = configured
+        self._timeouts = timeouts
+
+    def wrap(self, name: str, server: Any) -> Any:
+        """为设置了超时的服务器加上超时，其余服务器原样返回"""
+        timeouts = self._timeouts.get(name)
+        return TimeoutMCPServer(server, timeouts) if timeouts is not None else server
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: timeouts.stats() for name, timeouts in self._timeouts.items()}
@@ -1,17 +1,17 @@
-from contextlib import AsyncExitStack
-from typing import Dict, List, Optional, Any, Union
+from typing import AsyncIterator, Callable, Dict, List, Optional, Any, Tuple, Union
 import logging
 import json
 import os
 import asyncio
+import time
 import uvicorn
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-from pydantic_ai import Agent
-from pydantic_ai.mcp import MCPServerHTTP, MCPServerStdio
+from pydantic import BaseModel, Field
+from pydantic_ai import Agent, RunContext
+from pydantic_ai.mcp import MCPServerStdio
 from pydantic_ai.models.openai import OpenAIModel
 from pydantic_ai.providers.openai import OpenAIProvider
 from pydantic_ai.messages import (
@@ -20,6 +20,7 @@ from pydantic_ai.messages import (
     FunctionToolResultEvent,
     PartDeltaEvent,
     PartStartEvent,
+    TextPart,
     TextPartDelta,
     ToolCallPartDelta,
 )
@@ -27,7 +28,39 @@ from dotenv import load_dotenv
 import uuid
 from datetime import datetime
 import shutil
-from pydantic_ai.messages import ModelRequest, UserPromptPart, ModelResponse, TextPart
+from admission import AdmissionController, AdmissionRejected
+from agent_runtime import AgentRuntime, ServerHandle, ServerRegistry
+from http_clients import DEFAULT_LLM_BASE_URL, HTTPClientPool, PooledMCPServerHTTP
+from mcp_pool import MCPServerPool
+from shared_state import CONFIG_POLL_INTERVAL, WORKERS, create_shared_state
+from tool_cache import ToolCacheRegistry, cache_key, tool_cache_hits
+from tool_catalog import CatalogMCPServer
+from tool_timeouts import ToolTimeoutRegistry
+from tool_results import ToolResultLimitRegistry, TruncatedResult
+from tokenizer import tokenizer_name
+from summarizer import ConversationSummarizer
+from response_cache import CachedResponse, ResponseCache, response_key
+from stream_runs import (
+    DEADLINE_ERROR,
+    STREAM_RESUME_GRACE,
+    StreamRun,
+    StreamRunRegistry,
+    Subscription,
+    TrackedMCPServer,
+    encode_event,
+    read_until,
+    request_deadline,
+    time_remaining,
+)
+from history import HISTORY_TOKEN_BUDGET, encode_turn, message_tokens, to_model_messages, window_by_tokens
+from conversation_lock import ConversationBusy, ConversationLease, ConversationLocks
+from conversation_store import (
+    CachedConversationStore,
+    ChatMessage,
+    Conversation,
+    ConversationSummary,
+    create_conversation_store,
+)
 
 # 设置日志
 logging.basicConfig(level=logging.INFO)
@@ -58,9 +91,66 @@ model_settings = {
 # MCP服务器配置路径
 MCP_CONFIG_PATH = "mcp_server_config.json"
 
-# 全局agent对象
-agent = None
-mcp_stack = AsyncExitStack()
+# 默认系统提示符
+DEFAULT_SYSTEM_PROMPT = """你是一个人工智能助手，擅长使用工具解决问题，请用中文回答用户的问题。
+
+你的回答将被渲染为Markdown格式，因此你可以：
+- 使用**加粗**或*斜体*等Markdown语法来强调重要内容
+- 使用`代码块`展示代码，并指定语言来启用语法高亮，例如：
+```python
+def hello():
+    print("Hello, world!")
+```
+- 使用表格、列表、标题等各种Markdown元素来组织信息
+- 插入超链接：[链接文本](URL)
+
+请充分利用这些格式来提供清晰、结构化的回答。
+"""
+
+# 当前提供服务的Agent运行时，配置更新时整体替换
+agent_runtime: Optional[AgentRuntime] = None
+
+# 正在运行的MCP服务器，配置更新时按名称和配置比对，只启停有变化的服务器
+server_registry = ServerRegistry()
+
+# 全局、按模型和按MCP服务器的并发限制
+admission = AdmissionController()
+
+# 同一对话的请求串行处理
+conversation_locks = ConversationLocks()
+
+# 各MCP服务器的工具结果缓存（在mcp_server_config.json中按服务器用toolCache开启）
+tool_cache_registry = ToolCacheRegistry()
+
+# 各MCP服务器的工具调用超时（MCP_TOOL_TIMEOUT，或在mcp_server_config.json中按服务器用toolTimeouts设置）
+tool_timeout_registry = ToolTimeoutRegistry()
+
+# 各MCP服务器的工具结果上限（MCP_TOOL_RESULT_MAX_CHARS，或在mcp_server_config.json中按服务器用toolResultLimits设置）
+tool_result_registry = ToolResultLimitRegistry()
+
+# 完全相同的问题的回答缓存（设置MCP_RESPONSE_CACHE_SIZE后启用）
+response_cache = ResponseCache()
+
+# 进行中的Agent运行，相同的请求订阅同一个运行（设置MCP_COALESCE_REQUESTS后启用）
+stream_runs = StreamRunRegistry()
+
+# 按上游复用的HTTP客户端（LLM接口和HTTP MCP服务器），不随Agent重启重建
+http_client_pool = HTTPClientPool()
+
+# 正在排空的旧运行时和其他后台任务（保留引用防止被垃圾回收）
+draining_runtimes = set()
+background_tasks_refs = set()
+
+# 同一时间只允许一个重启任务（在事件循环中按需创建）
+restart_lock: Optional[asyncio.Lock] = None
+
+# 重启耗时统计
+restart_stats = {
+    "restarts": 0,
+    "failures": 0,
+    "last_duration": None,
+    "last_restart_time": None,
+}
 
 # 全局变量来存储MCP配置
 mcp_config = {}
@@ -68,33 +158,23 @@ mcp_config = {}
 # 标记需要重启的状态
 agent_restart_required = False
 
-# 配置更新状态追踪
-config_update_status = {
-    "updating": False,
-    "last_update_time": None,
-    "success": None,
-    "message": "",
-    "update_id": None
-}
-
-# 对话历史存储
-conversation_history = {}
+# 进程间共享状态：配置更新状态和配置版本（多进程部署时保存在本地SQLite中）
+shared_state = create_shared_state()
+CONFIG_STATUS_KEY = "config_update_status"
+CONFIG_VERSION_KEY = "config_version"
+WORKER_STATUS_PREFIX = "worker_status:"
 
+# 本进程已应用的配置版本
+applied_config_version = 0
 
-class ChatMessage(BaseModel):
-    """聊天消息模型"""
-    role: str  # "user" 或 "assistant"
-    content: str
-    timestamp: datetime = datetime.now()
+# 多进程模式下监听配置版本变化的后台任务
+config_watcher_task = None
 
+# 对话历史存储
+conversation_store = create_conversation_store()
 
-class Conversation(BaseModel):
-    """对话模型"""
-    id: str
-    title: str
-    messages: List[ChatMessage] = []
-    created_at: datetime = datetime.now()
-    updated_at: datetime = datetime.now()
+# 长对话的后台滚动摘要（设置MCP_SUMMARY_TOKEN_THRESHOLD后启用）
+conversation_summarizer = ConversationSummarizer(conversation_store)
 
 
 class QueryRequest(BaseModel):
@@ -102,8 +182,11 @@ class QueryRequest(BaseModel):
     query: str
     conversation_id: Optional[str] = None
     history_turns: int = 5  # 默认引用5轮历史对话
+    history_token_budget: Optional[int] = None  # 按token预算选取历史，设置后忽略history_turns
+    use_cache: bool = True  # 为False时不使用缓存的回答（新的回答仍会写入缓存）
     system_prompt: Optional[str] = None  # 改为可选字段
     use_default_system_prompt: bool = True  # 是否使用配置文件中的默认系统提示符
+    deadline: Optional[float] = Field(None, gt=0)  # 整个请求的最长时间（秒），不设置时使用服务端的默认值
 
 
 class QueryResponse(BaseModel):
@@ -111,11 +194,13 @@ class QueryResponse(BaseModel):
     answer: str
     conversation_id: str
     usage: Optional[Dict] = None
+    cached: bool = False  # 回答是否来自响应缓存
 
 
 class ConversationListResponse(BaseModel):
-    """对话列表响应"""
-    conversations: List[Conversation]
+    """对话列表响应（仅包含摘要，按更新时间倒序分页）"""
+    conversations: List[ConversationSummary]
+    next_cursor: Optional[str] = None
 
 
 class ConversationResponse(BaseModel):
@@ -151,371 +236,496 @@ def load_mcp_servers_from_config(config_path: str = MCP_CONFIG_PATH) -> List:
     Returns:
         MCP服务器实例列表
     """
+    return list(load_named_mcp_servers_from_config(config_path).values())
+
+
+def create_mcp_server(server_name: str, server_config: Dict[str, Any]):
+    """
+    根据单个服务器的配置创建MCPServerStdio或MCPServerHTTP实例
+
+    stdio服务器配置了poolSize大于1时，创建由多个相同子进程组成的MCPServerPool。
+
+    Args:
+        server_name: 服务器名称
+        server_config: mcpServers中该服务器的配置
+
+    Returns:
+        MCP服务器实例，配置中既没有command也没有url时返回None
+    """
+    pool_size = int(server_config.get("poolSize", 1))
+    # 处理基于命令行的MCP服务器
+    if "command" in server_config:
+        command = server_config.get("command")
+        args = server_config.get("args", [])
+        env = server_config.get("env", {})
+
+        # 创建环境变量字典，合并当前环境变量
+        environment = os.environ.copy()
+        environment.update(env)
+
+        # 检查命令是否为绝对路径，如果不是，则在PATH中查找
+        if not os.path.isabs(command) and os.path.sep not in command:
+            # 使用shutil.which查找可执行文件的完整路径
+            cmd_path = shutil.which(
+                command, path=environment.get('PATH'))
+            if cmd_path:
+                logger.info(f"命令 '{command}' 在PATH中找到: {cmd_path}")
+                command = cmd_path
+            else:
+                logger.warning(
+                    f"命令 '{command}' 不是绝对路径且在PATH中未找到，尝试直接使用")
+
+        if pool_size > 1:
+            return MCPServerPool(server_name, [
+                MCPServerStdio(command=command, args=args, env=environment)
+                for _ in range(pool_size)
+            ])
+
+        return MCPServerStdio(
+            command=command,
+            args=args,
+            env=environment
+        )
+
+    # 处理基于HTTP的MCP服务器
+    if "url" in server_config:
+        if pool_size > 1:
+            logger.warning(f"MCP服务器 {server_name} 是HTTP服务器，poolSize只对stdio服务器生效，已忽略")
+        return PooledMCPServerHTTP(url=server_config.get("url"), client_pool=http_client_pool)
+
+    logger.warning(f"MCP服务器 {server_name} 的配置缺少command或url，已忽略")
+    return None
+
+
+def load_named_mcp_servers_from_config(config_path: str = MCP_CONFIG_PATH) -> Dict[str, Any]:
+    """
+    从配置文件加载MCP服务器配置，并按服务器名称返回实例
+
+    Args:
+        config_path: 配置文件路径
+
+    Returns:
+        服务器名称到MCP服务器实例的字典
+    """
     try:
         with open(config_path, "r", encoding="utf-8") as f:
             config_data = json.load(f)
 
-        servers = []
+        servers = {}
         mcp_servers_config = config_data.get("mcpServers", {})
 
         for server_name, server_config in mcp_servers_config.items():
-            # 处理基于命令行的MCP服务器
-            if "command" in server_config:
-                command = server_config.get("command")
-                args = server_config.get("args", [])
-                env = server_config.get("env", {})
-
-                # 创建环境变量字典，合并当前环境变量
-                environment = os.environ.copy()
-                environment.update(env)
-
-                # 检查命令是否为绝对路径，如果不是，则在PATH中查找
-                if not os.path.isabs(command) and os.path.sep not in command:
-                    # 使用shutil.which查找可执行文件的完整路径
-                    cmd_path = shutil.which(
-                        command, path=environment.get('PATH'))
-                    if cmd_path:
-                        logger.info(f"命令 '{command}' 在PATH中找到: {cmd_path}")
-                        command = cmd_path
-                    else:
-                        logger.warning(
-                            f"命令 '{command}' 不是绝对路径且在PATH中未找到，尝试直接使用")
-
-                server = MCPServerStdio(
-                    command=command,
-                    args=args,
-                    env=environment
-                )
-                servers.append(server)
-
-            # 处理基于HTTP的MCP服务器
-            elif "url" in server_config:
-                url = server_config.get("url")
-                server = MCPServerHTTP(url=url)
-                servers.append(server)
+            server = create_mcp_server(server_name, server_config)
+            if server is not None:
+                servers[server_name] = server
 
         logger.info(f"已从{config_path}加载{len(servers)}个MCP服务器配置")
         return servers
     except FileNotFoundError:
         logger.warning(f"配置文件{config_path}不存在，返回空列表")
-        return []
+        return {}
     except json.JSONDecodeError:
         logger.error(f"配置文件{config_path}格式错误，无法解析JSON")
-        return []
+        return {}
     except Exception as e:
         logger.error(f"加载MCP服务器配置时发生错误: {str(e)}")
-        return []
-
+        return {}
 
-async def initialize_agent():
-    """初始化Agent和MCP服务器"""
-    global agent, mcp_stack, model_settings, mcp_config
 
-    # 创建模型
-    model = OpenAIModel(
+def create_model() -> OpenAIModel:
+    """根据环境变量创建模型，HTTP客户端在重启之间复用"""
+    base_url = os.getenv("MCP_LLM_API_BASE_URL")
+    return OpenAIModel(
         os.getenv("MCP_LLM_API_MODEL_NAME"),
         provider=OpenAIProvider(
-            base_url=os.getenv("MCP_LLM_API_BASE_URL"),
-            api_key=os.getenv("MCP_LLM_API_KEY")
+            base_url=base_url,
+            api_key=os.getenv("MCP_LLM_API_KEY"),
+            http_client=http_client_pool.get(base_url or DEFAULT_LLM_BASE_URL)
         ),
     )
 
-    # 加载MCP服务器
-    mcp_servers = load_mcp_servers_from_config()
 
-    # 从配置文件加载系统提示符
+def load_mcp_config() -> Dict[str, Any]:
+    """从配置文件加载配置并刷新全局配置，读取失败时返回空配置"""
+    global mcp_config
+
     try:
         with open(MCP_CONFIG_PATH, "r", encoding="utf-8") as f:
             mcp_config = json.load(f)
-            system_prompt = mcp_config.get("defaultSystemPrompt", """你是一个人工智能助手，擅长使用工具解决问题，请用中文回答用户的问题。
-    
-你的回答将被渲染为Markdown格式，因此你可以：
-- 使用**加粗**或*斜体*等Markdown语法来强调重要内容
-- 使用`代码块`展示代码，并指定语言来启用语法高亮，例如：
-```python
-def hello():
-    print("Hello, world!")
-```
-- 使用表格、列表、标题等各种Markdown元素来组织信息
-- 插入超链接：[链接文本](URL)
-
-请充分利用这些格式来提供清晰、结构化的回答。
-""")
+        return mcp_config
+    except FileNotFoundError:
+        logger.warning(f"配置文件{MCP_CONFIG_PATH}不存在，使用空配置")
     except Exception as e:
-        logger.warning(f"读取配置文件中的系统提示符时出错: {str(e)}，使用默认提示符")
-        system_prompt = """你是一个人工智能助手，擅长使用工具解决问题，请用中文回答用户的问题。
-    
-你的回答将被渲染为Markdown格式，因此你可以：
-- 使用**加粗**或*斜体*等Markdown语法来强调重要内容
-- 使用`代码块`展示代码，并指定语言来启用语法高亮，例如：
-```python
-def hello():
-    print("Hello, world!")
-```
-- 使用表格、列表、标题等各种Markdown元素来组织信息
-- 插入超链接：[链接文本](URL)
+        logger.warning(f"读取配置文件时出错: {str(e)}，使用空配置")
+    return {}
 
-请充分利用这些格式来提供清晰、结构化的回答。
-"""
 
-    # 创建Agent
-    agent = Agent(model, mcp_servers=mcp_servers,
-                  system_prompt=system_prompt, model_settings=model_settings)
+async def build_agent_runtime() -> Tuple[AgentRuntime, Dict[str, List[str]]]:
+    """
+    按当前配置创建Agent，只启动新增或配置有变化的MCP服务器，配置未变化的服务器直接复用
+
+    新的服务器并行启动，启动失败的服务器会被隔离并在后台重试，Agent先使用可用的服务器提供服务。
+
+    Returns:
+        (已启动的Agent运行时, 服务器变化明细)
+
+    Raises:
+        Exception: 创建模型或Agent失败
+    """
+    config = load_mcp_config()
+    system_prompt = config.get("defaultSystemPrompt", DEFAULT_SYSTEM_PROMPT)
+
+    servers_config = config.get("mcpServers", {})
+    handles, diff = server_registry.plan(servers_config, create_mcp_server)
+    logger.info(
+        f"MCP服务器变化: 新增{diff['added']}, 变更{diff['changed']}, "
+        f"移除{diff['removed']}, 复用{diff['unchanged']}")
+    # 重启过的服务器的缓存结果不再可信
+    tool_cache_registry.configure(servers_config, invalidate=diff["changed"])
+    tool_timeout_registry.configure(servers_config)
+    tool_result_registry.configure(servers_config)
+    admission.configure_servers(servers_config)
+
+    model = admission.wrap_model(create_model())
+    conversation_summarizer.model = model
+
+    def agent_factory(available: List[ServerHandle]) -> Agent:
+        # 工具列表缓存 -> 登记到运行（每步并发上限） -> 超时 -> 工具结果缓存 -> 结果截断 -> 并发限制 -> 服务器，
+        # 命中缓存的调用不占用并发名额，等待并发名额的时间计入超时，缓存保存的是截断后的结果，命中时不再写完整结果
+        mcp_servers = [
+            CatalogMCPServer(
+                TrackedMCPServer(tool_timeout_registry.wrap(handle.name, tool_cache_registry.wrap(
+                    handle.name, tool_result_registry.wrap(
+                        handle.name, admission.wrap_server(handle.name, handle.server))))),
+                handle.catalog)
+            for handle in available
+        ]
+        return create_agent(model, mcp_servers, system_prompt)
+
+    runtime = AgentRuntime(handles, agent_factory, applied_config_version)
+    await runtime.start()
+    server_registry.commit(handles)
+    return runtime, diff
+
 
-    # 启动MCP服务器
-    await mcp_stack.enter_async_context(agent.run_mcp_servers())
+async def initialize_agent():
+    """初始化Agent和MCP服务器"""
+    global agent_runtime
+
+    agent_runtime, _ = await build_agent_runtime()
     logger.info("Agent和MCP服务器已初始化")
 
 
+def run_in_background(coro):
+    """创建后台任务并保留引用，任务结束后自动释放"""
+    task = asyncio.create_task(coro)
+    background_tasks_refs.add(task)
+    task.add_done_callback(background_tasks_refs.discard)
+    return task
+
+
+async def drain_runtime(runtime: AgentRuntime):
+    """排空并关闭旧的Agent运行时"""
+    draining_runtimes.add(runtime)
+    try:
+        await runtime.drain_and_close()
+    finally:
+        draining_runtimes.discard(runtime)
+
+
+def get_restart_lock() -> asyncio.Lock:
+    """获取重启锁，需要在事件循环中创建以兼容Python 3.9"""
+    global restart_lock
+
+    if restart_lock is None:
+        restart_lock = asyncio.Lock()
+    return restart_lock
+
+
+def deadline_timeout(deadline: Optional[float]) -> Optional[float]:
+    """
+    请求剩余的时间，作为排队和等待对话的超时
+
+    Raises:
+        HTTPException: 504，已经超过截止时间
+    """
+    timeout = time_remaining(deadline)
+    if timeout == 0:
+        raise HTTPException(status_code=504, detail=DEADLINE_ERROR)
+    return timeout
+
+
+async def admit_request(deadline: Optional[float] = None) -> float:
+    """
+    为对话请求申请并发名额，最多等到请求的截止时间
+
+    Returns:
+        获得名额的时间，释放时传给release_request
+
+    Raises:
+        HTTPException: 429，排队已满或排队超时；504，排队期间超过截止时间
+    """
+    try:
+        await admission.requests.acquire(deadline_timeout(deadline))
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail=f"服务繁忙（{e.reason}），请{e.retry_after}秒后重试",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=DEADLINE_ERROR)
+    return time.monotonic()
+
+
+def release_request(admitted_at: float):
+    """释放admit_request申请的名额"""
+    admission.requests.release(time.monotonic() - admitted_at)
+
+
+async def lock_conversation(conversation_id: str, deadline: Optional[float] = None) -> ConversationLease:
+    """
+    获取对话的处理权，同一对话的请求按MCP_CONVERSATION_POLICY处理，最多等到请求的截止时间
+
+    Raises:
+        HTTPException: 409，对话正在处理其他请求（reject策略）、等待期间被新请求取消（cancel策略）或等待超时；
+            504，等待期间超过截止时间
+    """
+    try:
+        return await conversation_locks.acquire(conversation_id, deadline_timeout(deadline))
+    except ConversationBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=DEADLINE_ERROR)
+
+
+def get_agent_runtime() -> AgentRuntime:
+    """
+    获取当前提供服务的Agent运行时
+
+    如果上次重启失败，会在后台重试，当前请求继续使用现有的运行时。
+
+    Raises:
+        HTTPException: Agent尚未初始化
+    """
+    if agent_restart_required and not get_restart_lock().locked():
+        run_in_background(restart_agent_task_with_status(
+            read_config_update_status().get("update_id")))
+
+    if agent_runtime is None:
+        raise HTTPException(status_code=500, detail="Agent未初始化")
+    return agent_runtime
+
+
 @app.on_event("startup")
 async def startup_event():
     """应用启动时的事件处理"""
+    global applied_config_version, config_watcher_task
+
+    applied_config_version = shared_state.get(CONFIG_VERSION_KEY, 0)
     await initialize_agent()
 
+    if WORKERS > 1:
+        config_watcher_task = asyncio.create_task(watch_config_version())
+
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """应用关闭时的事件处理"""
-    await mcp_stack.aclose()
+    if config_watcher_task:
+        config_watcher_task.cancel()
+    runtimes = list(draining_runtimes)
+    if agent_runtime:
+        runtimes.append(agent_runtime)
+    for runtime in runtimes:
+        await runtime.drain_and_close(timeout=5)
     logger.info("已关闭所有MCP服务器")
+    await conversation_summarizer.aclose()
+    await http_client_pool.aclose()
+    conversation_store.close()
+    shared_state.close()
+
+
+def read_config_update_status() -> Dict[str, Any]:
+    """读取（所有工作进程共享的）配置更新状态"""
+    return shared_state.get(CONFIG_STATUS_KEY) or {
+        "updating": False,
+        "last_update_time": None,
+        "success": None,
+        "message": "",
+        "update_id": None
+    }
+
+
+def set_config_update_status(update_id: Optional[str], updating: bool, success: Optional[bool],
+                             message: str, force: bool = False):
+    """
+    更新配置更新状态
+
+    Args:
+        update_id: 本次更新ID
+        updating: 是否正在更新
+        success: 更新结果，进行中为None
+        message: 状态描述
+        force: 为False时只有当前状态属于同一次更新才写入，避免旧的更新覆盖新的状态
+    """
+    status = {
+        "updating": updating,
+        "last_update_time": datetime.now(),
+        "success": success,
+        "message": message,
+        "update_id": update_id
+    }
+    if force:
+        shared_state.set(CONFIG_STATUS_KEY, status)
+    else:
+        shared_state.set_if(CONFIG_STATUS_KEY, status, "update_id", update_id)
+
+
+def report_restart_status(update_id: Optional[str], primary: bool, updating: bool,
+                          success: Optional[bool], message: str):
+    """
+    记录重启进度：发起更新的进程写入全局状态，每个工作进程另外记录自己的结果
+
+    Args:
+        update_id: 本次更新ID
+        primary: 是否为发起配置更新的进程
+        updating: 是否正在更新
+        success: 更新结果，进行中为None
+        message: 状态描述
+    """
+    if primary:
+        set_config_update_status(update_id, updating, success, message)
+    if WORKERS > 1:
+        shared_state.set(f"{WORKER_STATUS_PREFIX}{os.getpid()}", {
+            "updating": updating,
+            "last_update_time": datetime.now(),
+            "success": success,
+            "message": message,
+            "update_id": update_id,
+            "config_version": applied_config_version,
+            "servers": agent_runtime.server_status() if agent_runtime else {}
+        })
 
 
 # 后台重启Agent任务，带有状态更新
-async def restart_agent_task_with_status(update_id: str):
-    """在后台重启Agent和MCP服务器的任务，并更新状态"""
-    global agent, mcp_stack, agent_restart_required, model_settings, mcp_config, config_update_status
+async def restart_agent_task_with_status(update_id: str, primary: bool = True):
+    """
+    在后台以蓝绿方式重启Agent和MCP服务器，并更新状态
 
-    try:
+    新的Agent和MCP服务器在旧实例继续服务的同时启动并做健康检查，成功后原子地替换全局引用，
+    旧实例等待进行中的请求结束后再关闭。新实例启动失败时继续使用旧实例。
+
+    Args:
+        update_id: 配置更新ID
+        primary: 是否为发起配置更新的进程，其他工作进程只记录自身的重启结果
+    """
+    global agent_runtime, agent_restart_required
+
+    async with get_restart_lock():
         # 重置标志
         agent_restart_required = False
+        start = time.monotonic()
 
-        # 更新状态到"正在关闭旧服务"
-        if config_update_status.get("update_id") == update_id:
-            config_update_status = {
-                "updating": True,
-                "last_update_time": datetime.now(),
-                "success": None,
-                "message": "正在关闭现有MCP服务器...",
-                "update_id": update_id
-            }
-
-        # 先保存旧的stack引用，然后创建新的stack
-        old_stack = mcp_stack
-        mcp_stack = AsyncExitStack()
-
-        # 先安全地关闭旧的stack
-        try:
-            logger.info("开始关闭旧的MCP服务器...")
-            await old_stack.aclose()
-            logger.info("旧的MCP服务器已成功关闭")
-        except Exception as e:
-            logger.warning(f"关闭旧MCP服务器时出错(可以忽略): {str(e)}")
-            # 等待一段时间，确保资源被释放
-            await asyncio.sleep(2)
-
-        # 更新状态为"正在创建新服务"
-        if config_update_status.get("update_id") == update_id:
-            config_update_status = {
-                "updating": True,
-                "last_update_time": datetime.now(),
-                "success": None,
-                "message": "正在创建新的MCP服务器...",
-                "update_id": update_id
-            }
-
-        # 创建新Agent实例
         try:
-            # 创建模型
-            model = OpenAIModel(
-                os.getenv("MCP_LLM_API_MODEL_NAME"),
-                provider=OpenAIProvider(
-                    base_url=os.getenv("MCP_LLM_API_BASE_URL"),
-                    api_key=os.getenv("MCP_LLM_API_KEY")
-                ),
-            )
+            report_restart_status(update_id, primary, True, None,
+                                  "正在启动有变化的MCP服务器...")
 
-            # 从配置文件加载系统提示符
-            try:
-                with open(MCP_CONFIG_PATH, "r", encoding="utf-8") as f:
-                    mcp_config = json.load(f)
-                    system_prompt = mcp_config.get("defaultSystemPrompt", """你是一个人工智能助手，擅长使用工具解决问题，请用中文回答用户的问题。
-            
-你的回答将被渲染为Markdown格式，因此你可以：
-- 使用**加粗**或*斜体*等Markdown语法来强调重要内容
-- 使用`代码块`展示代码，并指定语言来启用语法高亮，例如：
-```python
-def hello():
-    print("Hello, world!")
-```
-- 使用表格、列表、标题等各种Markdown元素来组织信息
-- 插入超链接：[链接文本](URL)
+            new_runtime, diff = await build_agent_runtime()
 
-请充分利用这些格式来提供清晰、结构化的回答。
-""")
-            except Exception as e:
-                logger.warning(f"读取配置文件中的系统提示符时出错: {str(e)}，使用默认提示符")
-                system_prompt = """你是一个人工智能助手，擅长使用工具解决问题，请用中文回答用户的问题。
-            
-你的回答将被渲染为Markdown格式，因此你可以：
-- 使用**加粗**或*斜体*等Markdown语法来强调重要内容
-- 使用`代码块`展示代码，并指定语言来启用语法高亮，例如：
-```python
-def hello():
-    print("Hello, world!")
-```
-- 使用表格、列表、标题等各种Markdown元素来组织信息
-- 插入超链接：[链接文本](URL)
+            # 替换全局引用，之后的新请求都会使用新的运行时
+            old_runtime = agent_runtime
+            agent_runtime = new_runtime
 
-请充分利用这些格式来提供清晰、结构化的回答。
-"""
+            duration = time.monotonic() - start
+            restart_stats["restarts"] += 1
+            restart_stats["last_duration"] = duration
+            restart_stats["last_restart_time"] = datetime.now()
+            logger.info(f"已切换到新的Agent和MCP服务器，耗时{duration:.2f}秒")
 
-            # 更新状态为"正在加载MCP服务器"
-            if config_update_status.get("update_id") == update_id:
-                config_update_status = {
-                    "updating": True,
-                    "last_update_time": datetime.now(),
-                    "success": None,
-                    "message": "正在加载MCP服务器...",
-                    "update_id": update_id
-                }
-
-            # 加载MCP服务器
-            mcp_servers = load_mcp_servers_from_config()
-            logger.info(f"已加载 {len(mcp_servers)} 个MCP服务器配置")
-
-            # 更新状态为"正在启动服务"
-            if config_update_status.get("update_id") == update_id:
-                config_update_status = {
-                    "updating": True,
-                    "last_update_time": datetime.now(),
-                    "success": None,
-                    "message": "正在启动服务器...",
-                    "update_id": update_id
-                }
-
-            # 创建新Agent
-            new_agent = Agent(model, mcp_servers=mcp_servers,
-                              system_prompt=system_prompt, model_settings=model_settings)
-
-            # 启动新的MCP服务器
-            await mcp_stack.enter_async_context(new_agent.run_mcp_servers())
-
-            # 等待一段时间，确保服务器完全启动
-            await asyncio.sleep(2)
-
-            # 更新全局agent引用
-            agent = new_agent
-            logger.info("已重启Agent和MCP服务器")
-
-            # 更新成功状态，确保只在updateID匹配时更新状态
-            if config_update_status.get("update_id") == update_id:
-                config_update_status = {
-                    "updating": False,
-                    "last_update_time": datetime.now(),
-                    "success": True,
-                    "message": "配置更新并重启成功",
-                    "update_id": update_id
-                }
+            # 旧运行时在后台排空后关闭
+            if old_runtime is not None:
+                run_in_background(drain_runtime(old_runtime))
+
+            unavailable = [
+                handle.name for handle in new_runtime.servers if not handle.is_available]
+            message = (f"配置更新成功，耗时{duration:.2f}秒（新增{len(diff['added'])}个、变更{len(diff['changed'])}个、"
+                       f"移除{len(diff['removed'])}个、复用{len(diff['unchanged'])}个MCP服务器）")
+            if unavailable:
+                message += f"，以下服务器启动失败，正在后台重试: {', '.join(unavailable)}"
+            report_restart_status(update_id, primary, False, True, message)
 
         except Exception as e:
-            logger.error(f"创建新Agent时发生错误: {str(e)}")
+            logger.error(f"重启Agent时发生错误: {str(e)}")
             agent_restart_required = True  # 标记需要再次尝试重启
+            restart_stats["failures"] += 1
 
             # 更新失败状态，确保只在updateID匹配时更新状态
-            if config_update_status.get("update_id") == update_id:
-                config_update_status = {
-                    "updating": False,
-                    "last_update_time": datetime.now(),
-                    "success": False,
-                    "message": f"创建新Agent时发生错误: {str(e)}",
-                    "update_id": update_id
-                }
+            report_restart_status(update_id, primary, False, False,
+                                  f"重启Agent时发生错误，继续使用原有配置: {str(e)}")
 
-    except Exception as e:
-        logger.error(f"重启Agent时发生错误: {str(e)}")
-        agent_restart_required = True  # 标记需要再次尝试重启
 
-        # 更新失败状态，确保只在updateID匹配时更新状态
-        if config_update_status.get("update_id") == update_id:
-            config_update_status = {
-                "updating": False,
-                "last_update_time": datetime.now(),
-                "success": False,
-                "message": f"重启Agent时发生错误: {str(e)}",
-                "update_id": update_id
-            }
+async def watch_config_version():
+    """多进程模式下轮询共享的配置版本，其他工作进程更新配置后在本进程重启Agent"""
+    global applied_config_version
+
+    while True:
+        await asyncio.sleep(CONFIG_POLL_INTERVAL)
+        try:
+            version = shared_state.get(CONFIG_VERSION_KEY, 0)
+            if version == applied_config_version:
+                continue
+            applied_config_version = version
+            logger.info(f"检测到配置版本变为{version}，重启本进程的Agent")
+            await restart_agent_task_with_status(
+                read_config_update_status().get("update_id"), primary=False)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"检查配置版本时发生错误: {str(e)}")
 
 
 # 为了向前兼容保留的函数
 async def restart_agent_task():
     """向前兼容的Agent重启函数"""
-    global config_update_status
     # 生成一个临时ID并调用带状态的重启函数
     temp_id = str(uuid.uuid4())
     await restart_agent_task_with_status(temp_id)
 
 
-@app.post("/api/query", response_model=QueryResponse)
-async def query(request: QueryRequest) -> QueryResponse:
+def ensure_conversation(conversation_id: Optional[str]) -> str:
     """
-    处理用户查询
+    确认会话存在，如果没有提供ID或ID无效，创建新会话
 
     Args:
-        request: 包含查询内容的请求
+        conversation_id: 请求中的会话ID
 
     Returns:
-        查询结果
+        可用的会话ID
     """
-    global agent, agent_restart_required, model_settings, conversation_history, mcp_config, config_update_status
+    if conversation_id and conversation_store.exists(conversation_id):
+        return conversation_id
 
-    # 检查是否正在更新配置
-    if config_update_status.get("updating"):
-        raise HTTPException(
-            status_code=503,
-            detail="服务器正在更新配置并重启中，请稍后再试"
-        )
+    now = datetime.now()
+    conversation = Conversation(
+        id=str(uuid.uuid4()),
+        title=f"新对话 {now.strftime('%Y-%m-%d %H:%M')}",
+        created_at=now,
+        updated_at=now
+    )
+    conversation_store.create(conversation)
+    return conversation.id
 
-    # 检查是否需要重启
-    if agent_restart_required:
-        await restart_agent_task_with_status(config_update_status.get("update_id"))
-        if agent_restart_required:  # 如果重启失败
-            raise HTTPException(status_code=503, detail="系统正在重启中，请稍后再试")
 
-    if not agent:
-        raise HTTPException(status_code=500, detail="Agent未初始化")
+def resolve_system_prompt(request: QueryRequest) -> Optional[str]:
+    """
+    确定本次请求使用的系统提示符
 
-    # 处理会话ID
-    conversation_id = request.conversation_id
-    if not conversation_id or conversation_id not in conversation_history:
-        # 如果没有提供ID或ID无效，创建新会话
-        now = datetime.now()
-        conversation_id = str(uuid.uuid4())
-        conversation = Conversation(
-            id=conversation_id,
-            title=f"新对话 {now.strftime('%Y-%m-%d %H:%M')}"
-        )
-        conversation_history[conversation_id] = conversation
-
-    # 获取历史消息
-    message_history = []
-    if request.history_turns > 0:
-        # 复制最近N轮对话（每轮包含用户和助手的消息）
-        messages = conversation_history[conversation_id].messages
-        turns_count = min(request.history_turns, len(
-            messages) // 2)  # 每轮包含用户和助手两条消息
-        if turns_count > 0:
-            # 获取最近的N轮对话
-            recent_messages = messages[-turns_count*2:]
-            for msg in recent_messages:
-                # 转换为PydanticAI消息格式
-                if msg.role == "user":
-                    message_history.append(ModelRequest(
-                        parts=[UserPromptPart(msg.content)]))
-                elif msg.role == "assistant":
-                    message_history.append(ModelResponse(
-                        parts=[TextPart(msg.content)]))
+    优先使用配置文件中的defaultSystemPrompt，未配置或读取出错时使用请求中的系统提示符，
+    都没有时使用Agent自带的默认系统提示符，保证有历史的轮次与第一轮使用相同的系统提示符
+    """
+    global mcp_config
 
-    # 处理系统提示符
     system_prompt = None
     if request.use_default_system_prompt:
         # 从配置文件中获取系统提示符
@@ -530,265 +740,682 @@ async def query(request: QueryRequest) -> QueryResponse:
     # 如果配置文件中没有系统提示符或出错，使用请求中的系统提示符
     if not system_prompt:
         system_prompt = request.system_prompt
+    if not system_prompt:
+        system_prompt = (mcp_config or {}).get("defaultSystemPrompt", DEFAULT_SYSTEM_PROMPT)
+    return system_prompt
+
 
+# 按token预算选取历史时第一次读取的消息条数，不够时加倍读取
+HISTORY_FETCH_MESSAGES = 16
+
+
+def build_message_history(conversation_id: str, history_turns: int,
+                          system_prompt: Optional[str] = None,
+                          token_budget: Optional[int] = None) -> List:
+    """
+    读取最近的对话并转换为PydanticAI消息格式
+
+    保存了原生消息的轮次会带上其中的工具调用和工具结果，模型可以直接复用之前的工具输出。
+    指定token预算时按预算选取最近的完整轮次，每条消息的token数随消息保存，
+    只需读取预算窗口附近的消息，与对话总长度无关。
+    对话较早的部分已被压缩时，只从摘要之后的消息中选取，摘要放在历史开头并计入token预算。
+
+    Args:
+        conversation_id: 会话ID
+        history_turns: 引用的历史轮数（每轮包含用户和助手两条消息）
+        system_prompt: 本次请求的系统提示符，历史不为空时放在最前面
+        token_budget: 历史的token预算，为空时使用MCP_HISTORY_TOKEN_BUDGET，不大于0时按轮数选取
+
+    Returns:
+        PydanticAI消息列表
+    """
+    if token_budget is None:
+        token_budget = HISTORY_TOKEN_BUDGET
+    if token_budget <= 0 and history_turns <= 0:
+        return []
+
+    # 已被摘要覆盖的消息不再放入历史
+    history_summary = conversation_store.get_history_summary(conversation_id)
+    available = None
+    summary_text = None
+    if history_summary is not None:
+        conversation = conversation_store.get_summary(conversation_id)
+        available = conversation.message_count - history_summary.covered if conversation else 0
+        summary_text = history_summary.content
+
+    def fetch(limit: int) -> List[ChatMessage]:
+        if available is not None:
+            limit = min(limit, available)
+        return conversation_store.get_recent_messages(conversation_id, limit)
+
+    if token_budget > 0:
+        if history_summary is not None:
+            token_budget -= history_summary.tokens
+        limit = HISTORY_FETCH_MESSAGES
+        while True:
+            recent = fetch(limit)
+            messages, exhausted = window_by_tokens(recent, token_budget)
+            if exhausted or len(recent) < limit:
+                break
+            limit *= 2
+        return to_model_messages(messages, system_prompt, summary_text)
+
+    messages = fetch(history_turns * 2)
+    return to_model_messages(messages, system_prompt, summary_text)
+
+
+def append_to_conversation(conversation_id: str, messages: List[ChatMessage], query: str):
+    """
+    追加消息到会话历史，并在第一轮对话完成时使用用户问题作为标题
+
+    Args:
+        conversation_id: 会话ID
+        messages: 需要追加的消息
+        query: 本轮用户问题
+    """
+    summary = conversation_store.get_summary(conversation_id)
+    if summary is None:
+        logger.warning(f"会话 {conversation_id} 已不存在，跳过写入历史")
+        return
+
+    # 写入前计算token数，之后按token预算选取历史时不需要重新分词
+    for message in messages:
+        message_tokens(message)
+
+    title = None
+    # 如果还没有设置标题，使用第一个用户问题作为标题
+    if summary.title.startswith("新对话") and summary.message_count + len(messages) == 2:
+        # 截断标题，保持在合理长度
+        title = query[:30] + "..." if len(query) > 30 else query
+
+    conversation_store.append_messages(
+        conversation_id, messages, datetime.now(), title=title)
+
+    # 一轮对话完成后在后台检查是否需要压缩较早的历史
+    if messages[-1].role == "assistant":
+        conversation_summarizer.schedule(conversation_id)
+
+
+def usage_to_dict(usage: Any) -> Optional[Dict]:
+    """将PydanticAI的用量对象转换为字典，转换失败时返回None"""
     try:
-        # 执行查询，添加系统提示符
-        run_kwargs = {
-            "model_settings": model_settings,
-            "message_history": message_history if message_history else None
-        }
+        if hasattr(usage, "dict"):
+            return usage.dict()
+        elif hasattr(usage, "__dict__"):
+            return dict(usage.__dict__)
+        return dict(usage)
+    except Exception as e:
+        logger.warning(f"处理usage数据时出错: {str(e)}")
+        return None
+
+
+def response_cache_key(request: QueryRequest, system_prompt: Optional[str],
+                       message_history: List, runtime: AgentRuntime) -> Optional[str]:
+    """本次请求的响应缓存键，响应缓存和请求合并都未启用时返回None"""
+    if not (response_cache.enabled or stream_runs.enabled):
+        return None
+    model = getattr(runtime.agent, "model", None)
+    return response_key(request.query, system_prompt, message_history,
+                        getattr(model, "model_name", ""), model_settings, runtime.config_version)
+
+
+def lookup_response(key: Optional[str], request: QueryRequest) -> Optional[CachedResponse]:
+    """查找缓存的回答，未启用、请求要求跳过缓存或未命中时返回None"""
+    if key is None:
+        return None
+    if not request.use_cache:
+        response_cache.bypassed += 1
+        return None
+    try:
+        return response_cache.get(key)
+    except KeyError:
+        return None
 
-        # 如果有系统提示符，添加到参数中
-        if system_prompt:
-            run_kwargs["system_prompt"] = system_prompt
 
-        result = await agent.run(
-            request.query,
-            **run_kwargs
-        )
+@app.post("/api/query", response_model=QueryResponse)
+async def query(request: QueryRequest, http_request: Request) -> QueryResponse:
+    """
+    处理用户查询
 
-        # 添加用户消息到历史
-        conversation_history[conversation_id].messages.append(
-            ChatMessage(role="user", content=request.query)
-        )
+    Args:
+        request: 包含查询内容的请求
+        http_request: 原始HTTP请求，用于发现客户端断开
 
-        # 添加助手回复到历史
-        conversation_history[conversation_id].messages.append(
-            ChatMessage(role="assistant", content=result.output)
-        )
+    Returns:
+        查询结果
+    """
+    global model_settings, mcp_config
 
-        # 更新对话的最后修改时间
-        conversation_history[conversation_id].updated_at = datetime.now()
-
-        # 如果还没有设置标题，使用第一个用户问题作为标题
-        if conversation_history[conversation_id].title.startswith("新对话") and len(conversation_history[conversation_id].messages) == 2:
-            # 截断标题，保持在合理长度
-            title = request.query[:30] + \
-                "..." if len(request.query) > 30 else request.query
-            conversation_history[conversation_id].title = title
-
-        print(result.output)
-        print(result.usage())
-        # 返回结果
-        usage_data = None
-        if hasattr(result, "usage"):
-            try:
-                usage_obj = result.usage()
-                if hasattr(usage_obj, "dict"):
-                    usage_data = usage_obj.dict()
-                elif hasattr(usage_obj, "__dict__"):
-                    usage_data = usage_obj.__dict__
-                else:
-                    usage_data = dict(usage_obj)
-            except Exception as e:
-                logger.warning(f"处理usage数据时出错: {str(e)}")
+    # 截止时间从收到请求开始计算，排队和等待对话的时间也计算在内
+    deadline = request_deadline(request.deadline)
+
+    # 配置更新期间继续使用当前的Agent，新的Agent就绪后才会切换
+    runtime = get_agent_runtime()
+
+    # 处理会话ID
+    conversation_id = ensure_conversation(request.conversation_id)
+
+    # 处理系统提示符
+    system_prompt = resolve_system_prompt(request)
+
+    # 同一对话的请求依次处理：从读取历史到写入回复期间持有该对话
+    lease = await lock_conversation(conversation_id, deadline)
+    # 响应在等待结束后才发送，cancel策略可以直接取消处理请求的任务
+    lease.set_owner(asyncio.current_task())
+    try:
+        # 获取历史消息
+        message_history = build_message_history(
+            conversation_id, request.history_turns, system_prompt,
+            request.history_token_budget)
+
+        # 完全相同的问题直接使用缓存的回答
+        response_key_ = response_cache_key(request, system_prompt, message_history, runtime)
+        cached = lookup_response(response_key_, request)
+        if cached is not None:
+            append_to_conversation(conversation_id, [
+                ChatMessage(role="user", content=request.query),
+                ChatMessage(role="assistant", content=cached.answer, model_messages=cached.model_messages)
+            ], request.query)
+            return QueryResponse(
+                answer=cached.answer,
+                conversation_id=conversation_id,
+                usage=cached.usage,
+                cached=True
+            )
+
+        # 相同的问题正在生成时直接等待其结果，否则开始新的运行
+        run = stream_runs.join(response_key_)
+        if run is None:
+            run = await start_run(runtime, response_key_, deadline, lambda agent, run: generate_answer(
+                agent, request.query, system_prompt, message_history, run))
+        lease.bind_run(run)
+
+        # 客户端断开后不再等待，没有其他请求等待同一运行时取消运行；
+        # 合并到其他请求的运行不会在本请求的截止时间取消，到期时自己停止等待
+        subscription = Subscription(run)
+        subscription.watch(http_request.receive)
+        expired = False
+        try:
+            await asyncio.wait_for(run.wait(), time_remaining(deadline) if run.outlives(deadline) else None)
+        except asyncio.TimeoutError:
+            expired = True
+        finally:
+            subscription.close("deadline" if expired else "superseded" if lease.superseded else "disconnect")
+
+        if expired:
+            raise HTTPException(status_code=504, detail=DEADLINE_ERROR)
+        if run.error is not None:
+            raise HTTPException(status_code=500, detail=f"处理查询时发生错误: {run.error}")
+        if run.cancel_reason == "deadline":
+            raise HTTPException(status_code=504, detail=DEADLINE_ERROR)
+        if run.cancelled:
+            raise HTTPException(status_code=409, detail=f"运行已取消: {run.cancel_reason}")
+
+        # 将用户消息和助手回复一次性写入历史
+        append_to_conversation(conversation_id, [
+            ChatMessage(role="user", content=request.query),
+            ChatMessage(role="assistant", content=run.answer, model_messages=run.model_messages)
+        ], request.query)
 
         return QueryResponse(
-            answer=result.output,
+            answer=run.answer,
             conversation_id=conversation_id,
-            usage=usage_data
+            usage=run.usage
         )
+    except HTTPException:
+        raise
+    except asyncio.CancelledError:
+        if not lease.superseded:
+            raise
+        raise HTTPException(status_code=409, detail="该请求已被同一对话的新请求取消")
     except Exception as e:
         logger.error(f"处理查询时发生错误: {str(e)}")
         raise HTTPException(status_code=500, detail=f"处理查询时发生错误: {str(e)}")
+    finally:
+        lease.release()
+
+
+async def start_run(runtime: AgentRuntime, key: Optional[str], deadline: Optional[float],
+                    generate: Callable[[Agent, StreamRun], AsyncIterator[str]],
+                    prepare: Optional[Callable[[], None]] = None) -> StreamRun:
+    """
+    申请对话请求的并发名额，在后台任务中开始一次Agent运行
+
+    调用方应已持有对话（先持有对话再排队申请名额，等待其他轮次时不占用名额）。
+    运行期间持有运行时（配置更新时旧的MCP服务器会等待运行结束再关闭）和并发名额，
+    运行结束后释放；正常完成的回答写入响应缓存。运行开始前出错时立即释放名额。
+
+    Args:
+        runtime: 当前的Agent运行时
+        key: 响应缓存键，用于合并相同的请求
+        deadline: 截止时间（request_deadline的结果），到期时取消运行及其中的模型请求和工具调用
+        generate: 接收Agent和运行对象、生成NDJSON事件的函数
+        prepare: 获得名额后、开始运行前执行，例如写入本轮的用户消息
+
+    Raises:
+        HTTPException: 429，排队已满或排队超时；504，排队期间超过截止时间
+    """
+    admitted_at = await admit_request(deadline)
+    try:
+        if prepare is not None:
+            prepare()
+        agent = runtime.acquire()
+    except BaseException:
+        release_request(admitted_at)
+        raise
+    run = StreamRun(key, deadline=deadline)
+
+    def on_finish(run: StreamRun):
+        stream_runs.finish(run)
+        runtime.release()
+        release_request(admitted_at)
+        if key is not None and run.model_messages is not None:
+            response_cache.put(key, CachedResponse(
+                answer=run.answer, model_messages=run.model_messages, usage=run.usage))
+
+    stream_runs.add(run)
+    run.start(generate(agent, run), on_finish)
+    return run
+
+
+def create_agent(model: Any, mcp_servers: List[Any], default_system_prompt: str) -> Agent:
+    """
+    创建Agent，系统提示符按请求决定
+
+    agent.run和agent.iter不接受system_prompt参数，本次请求的系统提示符通过deps传入（见build_run_kwargs），
+    没有历史的第一轮由这里的动态系统提示符放进第一条请求；有历史时PydanticAI不再添加系统提示符，
+    由build_message_history放在历史开头，两种情况下模型收到的是同一个系统提示符。
+
+    Args:
+        model: 模型
+        mcp_servers: 包装后的MCP服务器
+        default_system_prompt: 请求没有指定系统提示符时使用的系统提示符
+    """
+    agent = Agent(model, mcp_servers=mcp_servers, deps_type=Optional[str], model_settings=model_settings)
+
+    @agent.system_prompt
+    def request_system_prompt(ctx: RunContext[Optional[str]]) -> str:
+        return ctx.deps or default_system_prompt
+
+    return agent
+
+
+def build_run_kwargs(system_prompt: Optional[str], message_history: List) -> Dict[str, Any]:
+    """agent.run和agent.iter的参数，系统提示符作为deps交给create_agent中的动态系统提示符"""
+    return {
+        "model_settings": model_settings,
+        "message_history": message_history if message_history else None,
+        "deps": system_prompt,
+    }
+
+
+async def generate_answer(agent: Agent, query: str, system_prompt: Optional[str],
+                          message_history: List, run: StreamRun) -> AsyncIterator[Dict[str, Any]]:
+    """
+    一次性执行查询（/api/query），结束后以流式事件给出完整回答
+
+    相同问题的流式请求订阅这个运行时，会在生成结束后一次收到全部内容。
+    """
+    try:
+        result = await agent.run(query, **build_run_kwargs(system_prompt, message_history))
+    except Exception as e:
+        logger.error(f"处理查询时发生错误: {str(e)}")
+        run.error = str(e)
+        yield {"type": "error", "error": str(e)}
+        return
+
+    run.answer = result.output
+    run.model_messages = encode_turn(result.new_messages())
+    run.usage = usage_to_dict(result.usage())
+    logger.debug("查询完成，回答%d个字符，用量: %s", len(result.output), run.usage)
+    yield {"type": "content", "content": result.output}
+    yield {"type": "end"}
+
+
+async def generate_stream(agent: Agent, query: str, system_prompt: Optional[str],
+                          message_history: List, run: StreamRun) -> AsyncIterator[Dict[str, Any]]:
+    """
+    流式执行查询，逐个生成事件（start事件由各订阅者自己发送，编码也由订阅者完成）
+
+    生成的回答文本记录在run.answer上，正常完成时同时记录本轮的PydanticAI消息和用量。
+    每个文本片段都会经过这里，循环内只做必要的工作：节点日志只在DEBUG级别输出类型名，
+    不格式化节点和消息历史的内容。
+    """
+    debug = logger.isEnabledFor(logging.DEBUG)
+    try:
+        logger.info("开始流式生成回复，查询长度: %d，历史消息: %d", len(query), len(message_history))
+
+        # 准备运行参数
+        run_kwargs = build_run_kwargs(system_prompt, message_history)
+
+        # 记录本次请求中命中工具结果缓存的调用，用于标记tool_result事件
+        cache_hits = set()
+        tool_cache_hits.set(cache_hits)
+        tool_call_keys = {}
+
+        # 使用iter方法和节点迭代器模式进行流式输出
+        async with agent.iter(query, **run_kwargs) as agent_run:
+            async for node in agent_run:
+                if debug:
+                    logger.debug("处理节点: %s", type(node).__name__)
+                try:
+                    if agent.is_model_request_node(node):
+                        # 对于模型请求节点，流式输出模型生成的文本
+                        async with node.stream(agent_run.ctx) as request_stream:
+                            async for event in request_stream:
+                                if isinstance(event, PartDeltaEvent):
+                                    if not isinstance(event.delta, TextPartDelta):
+                                        continue
+                                    content = event.delta.content_delta
+                                elif isinstance(event, PartStartEvent) and isinstance(event.part, TextPart):
+                                    # 文本片段的第一段内容在PartStartEvent中
+                                    content = event.part.content
+                                else:
+                                    continue
+                                if content:
+                                    run.append_text(content)
+                                    yield {"type": "content", "content": content}
+                    elif agent.is_call_tools_node(node):
+                        async with node.stream(agent_run.ctx) as handle_stream:
+                            async for event in handle_stream:
+                                if isinstance(event, FunctionToolCallEvent):
+                                    tool_call_keys[event.part.tool_call_id] = cache_key(
+                                        event.part.tool_name, event.part.args_as_dict())
+                                    yield {
+                                        "type": "tool_call",
+                                        "tool_name": event.part.tool_name,
+                                        "args": event.part.args,
+                                        "tool_call_id": event.part.tool_call_id
+                                    }
+                                elif isinstance(event, FunctionToolResultEvent):
+                                    tool_result = {
+                                        "type": "tool_result",
+                                        "tool_call_id": event.tool_call_id,
+                                        "result": event.result.content
+                                    }
+                                    key = tool_call_keys.get(event.tool_call_id)
+                                    if key in cache_hits:
+                                        tool_result["cached"] = True
+                                    content = event.result.content
+                                    if isinstance(content, TruncatedResult):
+                                        # 被截断的工具结果只发送预览
+                                        tool_result.update(result=content.preview, truncated=True,
+                                                           result_id=content.result_id, size=content.size)
+                                    yield tool_result
+                    elif agent.is_end_node(node):
+                        # 到达结束节点时，最终结果与流式输出的文本不同才发送final事件
+                        final_result = agent_run.result.output if agent_run.result is not None else ""
+                        if final_result and final_result != run.answer:
+                            run.answer = final_result
+                            yield {"type": "final", "content": final_result}
+                except Exception as inner_e:
+                    logger.error("处理%s节点时发生错误: %s", type(node).__name__, inner_e)
+                    # 继续处理下一个节点，不中断整个流程
+                    continue
+
+            if agent_run.result is not None:
+                run.model_messages = encode_turn(agent_run.result.new_messages())
+                run.usage = usage_to_dict(agent_run.result.usage())
+
+        # 发送完成标记
+        yield {"type": "end"}
+        logger.info("流式生成回复完成，回答%d个字符", len(run.answer))
+
+    except Exception as e:
+        logger.exception("流式生成过程中发生错误: %s", e)
+        run.error = str(e)
+        # 发送错误信息
+        yield {"type": "error", "error": str(e)}
+
+
+async def replay_cached_response(conversation_id: str, cached: CachedResponse) -> AsyncIterator[bytes]:
+    """以与正常生成相同的NDJSON事件回放缓存的回答"""
+    yield encode_event({"type": "start", "conversation_id": conversation_id})
+    yield encode_event({"type": "content", "content": cached.answer})
+    yield encode_event({"type": "end", "cached": True})
+
+
+async def deadline_exceeded_stream(conversation_id: str) -> AsyncIterator[bytes]:
+    """运行开始前已经超过截止时间的流式响应"""
+    yield encode_event({"type": "start", "conversation_id": conversation_id})
+    yield encode_event({"type": "error", "reason": "deadline", "error": DEADLINE_ERROR})
+
+
+def turn_finisher(run: StreamRun, conversation_id: str, query: str,
+                  lease: ConversationLease) -> Callable[[bool], None]:
+    """
+    返回结束本轮对话的函数：把回答写入对话历史并释放对话，多次调用只执行一次
+
+    客户端断开后运行可能仍在继续（等待续传或还有其他订阅者），此时推迟到运行结束后执行，
+    写入完整的回答，且在此之前同一对话的新请求不会开始；cancel策略下新请求会取消等待续传的运行
+    （见ConversationLease.bind_run）。被新请求取消或超过本请求的截止时间时立即执行，写入已生成的部分回答。
+    """
+    finished = False
+
+    def finish_turn(_run: Optional[StreamRun] = None):
+        nonlocal finished
+        if finished:
+            return
+        finished = True
+        # 无论成功还是失败，都确保更新会话历史
+        try:
+            # 如果响应不为空，则添加到会话历史
+            if run.answer:
+                append_to_conversation(conversation_id, [
+                    ChatMessage(role="assistant", content=run.answer, model_messages=run.model_messages)
+                ], query)
+        except Exception as hist_error:
+            logger.error(f"更新会话历史时出错: {str(hist_error)}")
+        lease.release()
+
+    def finish(expired: bool = False):
+        if run.done or lease.superseded or expired:
+            finish_turn()
+            return
+        run.when_done(finish_turn)
+
+    return finish
+
+
+async def subscribe_stream(run: StreamRun, conversation_id: str, http_request: Request,
+                           lease: ConversationLease, finish: Callable[[bool], None],
+                           deadline: Optional[float] = None) -> AsyncIterator[bytes]:
+    """
+    把运行产生的事件转发给一个流式请求，结束后把回答写入该请求的对话
+
+    相同问题的多个请求订阅同一个运行，各自发送自己的会话ID并写入各自的对话历史。
+    连续的文本片段按MCP_STREAM_BATCH_WINDOW_MS合并后发送。
+    客户端断开后立即离开运行，MCP_STREAM_RESUME_GRACE秒内没有续传且没有其他订阅者时运行被取消。
+    运行按开始它的请求的截止时间取消，合并进来的请求在自己的截止时间先到时发送deadline错误并离开运行。
+    """
+    # cancel策略取消的是转发事件的任务；处理函数返回响应之前没有登记任务，新请求只取消运行（见bind_run）
+    lease.set_owner(asyncio.current_task())
+    subscription = Subscription(run, STREAM_RESUME_GRACE)
+    subscription.watch(http_request.receive)
+    chunks = run.read()
+    if run.outlives(deadline):
+        chunks = read_until(chunks, deadline)
+    expired = False
+    try:
+        # 发送开始标记、会话ID和运行ID（用于续传和显式取消）
+        yield encode_event({"type": "start", "conversation_id": conversation_id, "run_id": run.run_id})
+        if lease.superseded:
+            # 开始转发之前已被同一对话的新请求取消（运行还有其他订阅者时不会被取消）
+            yield encode_event({"type": "cancelled", "reason": "superseded"})
+            return
+        async for chunk in chunks:
+            if not subscription.active:
+                break
+            yield chunk
+    except asyncio.TimeoutError:
+        expired = True
+        yield encode_event({"type": "error", "reason": "deadline", "error": DEADLINE_ERROR})
+    except asyncio.CancelledError:
+        if not lease.superseded:
+            raise
+        yield encode_event({"type": "cancelled", "reason": "superseded"})
+    finally:
+        lease.set_owner(None)
+        subscription.close("deadline" if expired else "superseded" if lease.superseded else "disconnect")
+        finish(expired)
+
+
+async def resume_stream(run: StreamRun, start: int, http_request: Request) -> AsyncIterator[bytes]:
+    """从序号start开始转发运行的事件，断开后同样等待下一次续传"""
+    subscription = Subscription(run, STREAM_RESUME_GRACE)
+    subscription.watch(http_request.receive)
+    try:
+        yield encode_event({"type": "start", "run_id": run.run_id, "from": start})
+        async for chunk in run.read(start):
+            if not subscription.active:
+                break
+            yield chunk
+    finally:
+        subscription.close()
 
 
 @app.post("/api/stream")
-async def query_stream(request: QueryRequest):
+async def query_stream(request: QueryRequest, http_request: Request):
     """
     处理用户查询并以流式方式返回结果
 
     Args:
         request: 包含查询内容的请求
+        http_request: 原始HTTP请求，用于发现客户端断开
 
     Returns:
         流式响应
     """
-    global agent, agent_restart_required, model_settings, conversation_history, mcp_config, config_update_status
+    global model_settings, mcp_config
 
-    # 检查是否正在更新配置
-    if config_update_status.get("updating"):
-        raise HTTPException(
-            status_code=503,
-            detail="服务器正在更新配置并重启中，请稍后再试"
-        )
+    # 截止时间从收到请求开始计算，排队和等待对话的时间也计算在内
+    deadline = request_deadline(request.deadline)
 
-    # 检查是否需要重启
-    if agent_restart_required:
-        await restart_agent_task_with_status(config_update_status.get("update_id"))
-        if agent_restart_required:  # 如果重启失败
-            raise HTTPException(status_code=503, detail="系统正在重启中，请稍后再试")
+    # 配置更新期间继续使用当前的Agent，新的Agent就绪后才会切换
+    runtime = get_agent_runtime()
 
-    if not agent:
-        raise HTTPException(status_code=500, detail="Agent未初始化")
+    # 处理系统提示符
+    system_prompt = resolve_system_prompt(request)
 
     # 处理会话ID
-    conversation_id = request.conversation_id
-    if not conversation_id or conversation_id not in conversation_history:
-        # 如果没有提供ID或ID无效，创建新会话
-        now = datetime.now()
-        conversation_id = str(uuid.uuid4())
-        conversation = Conversation(
-            id=conversation_id,
-            title=f"新对话 {now.strftime('%Y-%m-%d %H:%M')}"
+    conversation_id = ensure_conversation(request.conversation_id)
+
+    # 同一对话的请求依次处理：从读取历史到写入回复期间持有该对话
+    lease: Optional[ConversationLease] = None
+    try:
+        lease = await lock_conversation(conversation_id, deadline)
+
+        # 获取历史消息（在添加本轮用户消息之前读取）
+        message_history = build_message_history(
+            conversation_id, request.history_turns, system_prompt,
+            request.history_token_budget)
+
+        # 完全相同的问题直接使用缓存的回答
+        response_key_ = response_cache_key(request, system_prompt, message_history, runtime)
+        cached = lookup_response(response_key_, request)
+
+        # 添加用户消息到历史，命中缓存时连同回答一起写入
+        turn = [ChatMessage(role="user", content=request.query)]
+        if cached is not None:
+            turn.append(ChatMessage(role="assistant", content=cached.answer,
+                                    model_messages=cached.model_messages))
+
+        def record_turn():
+            append_to_conversation(conversation_id, turn, request.query)
+
+        # 相同的问题正在生成时订阅该运行（不占用并发名额），否则排队申请名额后开始新的运行，
+        # 获得名额后才写入用户消息，排队失败时不会留下没有回答的问题
+        run = stream_runs.join(response_key_) if cached is None else None
+        if cached is None and run is None:
+            run = await start_run(runtime, response_key_, deadline, lambda agent, run: generate_stream(
+                agent, request.query, system_prompt, message_history, run), prepare=record_turn)
+        else:
+            record_turn()
+        if run is not None:
+            # cancel策略下新请求可能在流式响应开始转发之前到达，此时需要直接取消运行
+            lease.bind_run(run)
+    except HTTPException as e:
+        if lease is not None:
+            lease.release()
+        if e.status_code != 504:
+            raise
+        # 等待对话或排队期间超过截止时间，与运行中超时一样以deadline错误结束（本轮没有写入对话）
+        return StreamingResponse(deadline_exceeded_stream(conversation_id), media_type="text/event-stream")
+    except BaseException:
+        if lease is not None:
+            lease.release()
+        raise
+
+    if cached is not None:
+        lease.release()
+        return StreamingResponse(
+            replay_cached_response(conversation_id, cached),
+            media_type="text/event-stream"
         )
-        conversation_history[conversation_id] = conversation
 
-    # 添加用户消息到历史
-    conversation_history[conversation_id].messages.append(
-        ChatMessage(role="user", content=request.query)
+    # 客户端提前断开时转发生成器可能不会执行到finally，通过后台任务保证结束本轮对话
+    finish = turn_finisher(run, conversation_id, request.query, lease)
+    finish_tasks = BackgroundTasks()
+    finish_tasks.add_task(finish)
+
+    # 返回流式响应
+    return StreamingResponse(
+        subscribe_stream(run, conversation_id, http_request, lease, finish, deadline),
+        media_type="text/event-stream",
+        background=finish_tasks
     )
 
-    # 获取历史消息
-    message_history = []
-    if request.history_turns > 0:
-        # 复制最近N轮对话（不包括刚添加的用户消息）
-        # 排除最新的用户消息
-        messages = conversation_history[conversation_id].messages[:-1]
-        turns_count = min(request.history_turns, len(
-            messages) // 2)  # 每轮包含用户和助手两条消息
-        if turns_count > 0:
-            # 获取最近的N轮对话
-            recent_messages = messages[-turns_count*2:]
-            for msg in recent_messages:
-                # 转换为PydanticAI消息格式
-                if msg.role == "user":
-                    message_history.append(ModelRequest(
-                        parts=[UserPromptPart(msg.content)]))
-                elif msg.role == "assistant":
-                    message_history.append(ModelResponse(
-                        parts=[TextPart(msg.content)]))
 
-    # 处理系统提示符
-    system_prompt = None
-    if request.use_default_system_prompt:
-        # 从配置文件中获取系统提示符
-        try:
-            if not mcp_config:
-                with open(MCP_CONFIG_PATH, "r", encoding="utf-8") as f:
-                    mcp_config = json.load(f)
-            system_prompt = mcp_config.get("defaultSystemPrompt")
-        except Exception as e:
-            logger.warning(f"读取配置文件中的系统提示符时出错: {str(e)}，使用默认提示符")
+@app.get("/api/stream/{run_id}")
+async def resume_query_stream(run_id: str, http_request: Request, from_: int = Query(0, alias="from", ge=0)):
+    """
+    断线后续传流式响应
 
-    # 如果配置文件中没有系统提示符或出错，使用请求中的系统提示符
-    if not system_prompt:
-        system_prompt = request.system_prompt
+    运行在服务端继续进行（断开后等待MCP_STREAM_RESUME_GRACE秒），结束后保留MCP_STREAM_RETENTION秒。
+    回答仍由原请求写入对话历史。
 
-    # 完整响应内容
-    full_response = ""
+    Args:
+        run_id: start事件中的运行ID
+        from_: 第一个要接收的事件序号，通常是已收到的最后一个事件的seq加1
+    """
+    run = stream_runs.resume(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="运行不存在或已过期")
+    return StreamingResponse(resume_stream(run, from_, http_request), media_type="text/event-stream")
 
-    # 定义流式生成器
-    async def generate_stream():
-        nonlocal full_response
 
-        try:
-            # 使用run_stream方法进行流式生成
-            logger.info(f"开始流式生成回复，查询: {request.query}")
-
-            # 发送开始标记和会话ID
-            yield json.dumps({"type": "start", "conversation_id": conversation_id}) + "\n"
-
-            # 准备运行参数
-            run_kwargs = {
-                "model_settings": model_settings,
-                "message_history": message_history if message_history else None
-            }
-
-            # 如果有系统提示符，添加到参数中
-            if system_prompt:
-                run_kwargs["system_prompt"] = system_prompt
-
-            # 使用iter方法和节点迭代器模式进行流式输出
-            logger.info(f"消息历史: {message_history}")  # 记录消息历史以便调试
-            async with agent.iter(request.query, **run_kwargs) as run:
-                async for node in run:
-                    logger.info(f"处理节点类型: {type(node).__name__}")
-                    try:
-                        if agent.is_model_request_node(node):
-                            # 对于模型请求节点，我们可以流式输出模型生成的消息
-                            logger.info(f"处理模型请求节点: {node}")
-                            async with node.stream(run.ctx) as request_stream:
-                                async for event in request_stream:
-                                    if hasattr(event, 'delta') and hasattr(event.delta, 'content_delta'):
-                                        content = event.delta.content_delta
-                                        if content:
-                                            full_response += content
-                                            yield json.dumps({"type": "content", "content": content}) + "\n"
-                        elif agent.is_call_tools_node:
-                            logger.info(f"处理工具调用节点: {node}")
-                            async with node.stream(run.ctx) as handle_stream:
-                                async for event in handle_stream:
-                                    if isinstance(event, FunctionToolCallEvent):
-                                        yield json.dumps({
-                                            "type": "tool_call",
-                                            "tool_name": event.part.tool_name,
-                                            "args": event.part.args,
-                                            "tool_call_id": event.part.tool_call_id
-                                        }) + "\n"
-                                    elif isinstance(event, FunctionToolResultEvent):
-                                        yield json.dumps({
-                                            "type": "tool_result",
-                                            "tool_call_id": event.tool_call_id,
-                                            "result": event.result.content
-                                        }) + "\n"
-                        elif agent.is_end_node(node):
-                            # 当到达结束节点时，我们可以获取最终结果
-                            logger.info(f"处理结束节点: {node}")
-                            final_result = run.result.output if hasattr(
-                                run, 'result') and hasattr(run.result, 'output') else ""
-                            if final_result and final_result != full_response:
-                                full_response = final_result
-                                yield json.dumps({"type": "final", "content": final_result}) + "\n"
-                        else:
-                            # 记录其他类型的节点
-                            logger.info(
-                                f"未处理的节点类型: {type(node).__name__}, 内容: {node}")
-                    except Exception as inner_e:
-                        logger.error(
-                            f"处理节点时发生错误: {str(inner_e)}, 节点类型: {type(node).__name__}, 节点内容: {node}")
-                        # 继续处理下一个节点，不中断整个流程
-                        continue
-
-            # 发送完成标记
-            yield json.dumps({"type": "end"}) + "\n"
+@app.post("/api/stream/{run_id}/cancel")
+async def cancel_stream(run_id: str):
+    """
+    取消进行中的运行
 
-        except Exception as e:
-            import traceback
-            logger.error(f"流式生成过程中发生错误: {str(e)}")
-            logger.error(f"错误详情: {traceback.format_exc()}")
-            # 发送错误信息
-            yield json.dumps({"type": "error", "error": str(e)}) + "\n"
-        finally:
-            # 无论成功还是失败，都确保更新会话历史
-            try:
-                # 如果响应不为空，则添加到会话历史
-                if full_response:
-                    # 将完整的响应添加到对话历史
-                    conversation_history[conversation_id].messages.append(
-                        ChatMessage(role="assistant", content=full_response)
-                    )
-
-                    # 更新对话的最后修改时间
-                    conversation_history[conversation_id].updated_at = datetime.now(
-                    )
-
-                    # 如果还没有设置标题，使用第一个用户问题作为标题
-                    if conversation_history[conversation_id].title.startswith("新对话") and len(conversation_history[conversation_id].messages) == 2:
-                        # 截断标题，保持在合理长度
-                        title = request.query[:30] + \
-                            "..." if len(request.query) > 30 else request.query
-                        conversation_history[conversation_id].title = title
-            except Exception as hist_error:
-                logger.error(f"更新会话历史时出错: {str(hist_error)}")
-
-            logger.info("流式生成回复完成或中断")
+    不论有多少请求订阅该运行都会取消，订阅者收到cancelled事件，已生成的部分回答写入对话历史。
+    运行已经结束时cancelled为false。
 
-    # 返回流式响应
-    return StreamingResponse(
-        generate_stream(),
-        media_type="text/event-stream"
-    )
+    Args:
+        run_id: start事件中的运行ID
+    """
+    run = stream_runs.get(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="运行不存在或已过期")
+    return {"run_id": run_id, "cancelled": run.cancel("request")}
+
+
+@app.get("/api/tool-results/{result_id}")
+async def get_tool_result(result_id: str):
+    """
+    获取被截断的工具结果的完整内容
+
+    完整结果保存MCP_TOOL_RESULT_TTL秒，直接从磁盘流式返回。
+
+    Args:
+        result_id: tool_result事件中的result_id，也出现在模型收到的截断标记中
+    """
+    stored = tool_result_registry.store.get(result_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail="工具结果不存在或已过期")
+    path, media_type = stored
+    return FileResponse(path, media_type=media_type)
 
 
 @app.post("/api/config/update", response_model=ConfigUpdateResponse)
@@ -803,7 +1430,7 @@ async def update_config(request: ConfigUpdateRequest, background_tasks: Backgrou
     Returns:
         更新结果
     """
-    global mcp_config, agent_restart_required, config_update_status
+    global mcp_config, agent_restart_required, applied_config_version
 
     try:
         # 验证配置格式
@@ -815,13 +1442,7 @@ async def update_config(request: ConfigUpdateRequest, background_tasks: Backgrou
 
         # 设置更新状态
         update_id = str(uuid.uuid4())
-        config_update_status = {
-            "updating": True,
-            "last_update_time": datetime.now(),
-            "success": None,
-            "message": "配置更新进行中...",
-            "update_id": update_id
-        }
+        set_config_update_status(update_id, True, None, "配置更新进行中...", force=True)
 
         # 保存配置到文件
         with open(MCP_CONFIG_PATH, "w", encoding="utf-8") as f:
@@ -830,6 +1451,9 @@ async def update_config(request: ConfigUpdateRequest, background_tasks: Backgrou
         # 更新全局配置
         mcp_config = request.config
 
+        # 递增共享配置版本，通知其他工作进程重启各自的Agent
+        applied_config_version = shared_state.incr(CONFIG_VERSION_KEY)
+
         # 标记需要重启
         agent_restart_required = True
 
@@ -844,19 +1468,40 @@ async def update_config(request: ConfigUpdateRequest, background_tasks: Backgrou
     except Exception as e:
         logger.error(f"更新配置时发生错误: {str(e)}")
         # 更新失败状态
-        config_update_status = {
-            "updating": False,
-            "last_update_time": datetime.now(),
-            "success": False,
-            "message": f"更新配置时发生错误: {str(e)}",
-            "update_id": config_update_status.get("update_id")
-        }
+        set_config_update_status(read_config_update_status().get("update_id"), False, False,
+                                 f"更新配置时发生错误: {str(e)}", force=True)
         return ConfigUpdateResponse(
             success=False,
             message=f"更新配置时发生错误: {str(e)}"
         )
 
 
+@app.get("/api/tools")
+async def get_tools():
+    """
+    获取各MCP服务器提供的工具（只读）
+
+    返回缓存的工具列表，缓存过期时向服务器重新获取
+
+    Returns:
+        按服务器名称分组的工具名称、描述和参数JSON Schema
+    """
+    runtime = get_agent_runtime()
+    servers = {}
+    for handle in runtime.servers:
+        if handle.is_available:
+            try:
+                await handle.catalog.get(handle.server.list_tools)
+            except Exception as e:
+                logger.warning(f"获取MCP服务器 {handle.name} 的工具列表时出错: {str(e)}")
+        servers[handle.name] = {
+            "available": handle.is_available,
+            "fetched_at": datetime.fromtimestamp(handle.catalog.fetched_at) if handle.catalog.fetched_at else None,
+            "tools": handle.catalog.describe()
+        }
+    return {"servers": servers}
+
+
 @app.get("/api/config")
 async def get_config():
     """
@@ -889,56 +1534,98 @@ async def get_config_update_status():
     Returns:
         当前配置更新状态
     """
-    global config_update_status
-    return config_update_status
+    status = dict(read_config_update_status())
+    # 本进程各MCP服务器的状态
+    status["servers"] = agent_runtime.server_status() if agent_runtime else {}
+    if WORKERS > 1:
+        # 多进程模式下附带每个工作进程的重启结果
+        status["workers"] = {
+            key[len(WORKER_STATUS_PREFIX):]: value
+            for key, value in shared_state.get_prefix(WORKER_STATUS_PREFIX).items()
+        }
+    return status
+
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """
+    获取运行时指标
+
+    Returns:
+        各组件的统计数据
+    """
+    metrics = {
+        "agent_restart": {
+            **restart_stats,
+            "active_requests": agent_runtime.active_requests if agent_runtime else 0,
+            "draining_runtimes": len(draining_runtimes),
+        }
+    }
+    if isinstance(conversation_store, CachedConversationStore):
+        metrics["conversation_cache"] = conversation_store.stats()
+    metrics["http_clients"] = http_client_pool.stats()
+    metrics["tool_cache"] = tool_cache_registry.stats()
+    metrics["tool_timeouts"] = tool_timeout_registry.stats()
+    metrics["tool_results"] = tool_result_registry.stats()
+    metrics["response_cache"] = response_cache.stats()
+    metrics["stream_runs"] = stream_runs.stats()
+    metrics["admission"] = admission.stats()
+    metrics["conversation_locks"] = conversation_locks.stats()
+    metrics["history"] = {
+        "tokenizer": tokenizer_name(),
+        "default_token_budget": HISTORY_TOKEN_BUDGET,
+        "summarizer": conversation_summarizer.stats(),
+    }
+    return metrics
 
 
 # 对话管理相关端点
 @app.get("/api/conversations", response_model=ConversationListResponse)
-async def get_conversations():
-    """获取所有对话列表"""
-    global conversation_history
-
-    # 按更新时间排序
-    sorted_conversations = sorted(
-        conversation_history.values(),
-        key=lambda x: x.updated_at,
-        reverse=True
-    )
+async def get_conversations(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None
+):
+    """
+    分页获取对话摘要列表
+
+    Args:
+        limit: 每页数量
+        cursor: 上一页返回的next_cursor，为空时返回第一页
+
+    Returns:
+        对话摘要列表和下一页游标
+    """
+    try:
+        summaries, next_cursor = conversation_store.list_summaries(limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    return ConversationListResponse(conversations=sorted_conversations)
+    return ConversationListResponse(conversations=summaries, next_cursor=next_cursor)
 
 
 @app.get("/api/conversations/{conversation_id}", response_model=ConversationResponse)
 async def get_conversation(conversation_id: str):
     """获取特定对话"""
-    global conversation_history
-
-    if conversation_id not in conversation_history:
+    conversation = conversation_store.get(conversation_id)
+    if conversation is None:
         raise HTTPException(status_code=404, detail="对话不存在")
 
-    return ConversationResponse(conversation=conversation_history[conversation_id])
+    return ConversationResponse(conversation=conversation)
 
 
 @app.delete("/api/conversations/{conversation_id}", response_model=SuccessResponse)
 async def delete_conversation(conversation_id: str):
     """删除特定对话"""
-    global conversation_history
-
-    if conversation_id not in conversation_history:
+    if not conversation_store.delete(conversation_id):
         raise HTTPException(status_code=404, detail="对话不存在")
 
-    del conversation_history[conversation_id]
-
     return SuccessResponse(success=True, message="对话已删除")
 
 
 @app.delete("/api/conversations", response_model=SuccessResponse)
 async def delete_all_conversations():
     """删除所有对话"""
-    global conversation_history
-
-    conversation_history = {}
+    conversation_store.clear()
 
     return SuccessResponse(success=True, message="所有对话已删除")
 
@@ -946,8 +1633,6 @@ async def delete_all_conversations():
 @app.post("/api/conversations", response_model=ConversationResponse)
 async def create_conversation():
     """创建新对话"""
-    global conversation_history
-
     # 生成唯一ID
     conversation_id = str(uuid.uuid4())
 
@@ -960,8 +1645,8 @@ async def create_conversation():
         updated_at=now
     )
 
-    # 保存到历史记录
-    conversation_history[conversation_id] = conversation
+    # 保存到存储
+    conversation_store.create(conversation)
 
     return ConversationResponse(conversation=conversation)
 
@@ -969,16 +1654,13 @@ async def create_conversation():
 @app.put("/api/conversations/{conversation_id}/title", response_model=ConversationResponse)
 async def update_conversation_title(conversation_id: str, request: dict):
     """更新对话标题"""
-    global conversation_history
-
-    if conversation_id not in conversation_history:
-        raise HTTPException(status_code=404, detail="对话不存在")
-
     title = request.get("title", "新对话")
-    conversation_history[conversation_id].title = title
-    conversation_history[conversation_id].updated_at = datetime.now()
+    conversation = conversation_store.update_title(
+        conversation_id, title, datetime.now())
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="对话不存在")
 
-    return ConversationResponse(conversation=conversation_history[conversation_id])
+    return ConversationResponse(conversation=conversation)
 
 # 挂载静态文件
 app.mount("/", StaticFiles(directory="static", html=True), name="static")
@@ -986,5 +1668,10 @@ app.mount("/", StaticFiles(directory="static", html=True), name="static")
 
 if __name__ == "__main__":
     # 默认运行在8000端口
-    uvicorn.run("web_server:app", host="0.0.0.0", port=8000,
-                reload=True, timeout_keep_alive=60)
+    if WORKERS > 1:
+        # 多进程模式不支持自动重载，各工作进程通过共享状态同步对话和配置
+        uvicorn.run("web_server:app", host="0.0.0.0", port=8000,
+                    workers=WORKERS, timeout_keep_alive=60)
+    else:
+        uvicorn.run("web_server:app", host="0.0.0.0", port=8000,
+                    reload=True, timeout_keep_alive=60)